@@ -12,8 +12,11 @@ __version__ = '0.1'
 
 from . import get_input_catalog
 from . import create_blend_generator
+from . import blend_batch
 from . import create_observing_generator
 from . import draw_blends
+from . import galaxy_library
+from . import blend_dataset
 from . import measure
 from . import config
 from . import compute_metrics
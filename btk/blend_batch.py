@@ -0,0 +1,191 @@
+import collections.abc
+import numpy as np
+import astropy.table
+
+
+def get_array(catalog):
+    """Returns structured `numpy.ndarray` with the entries of a catalog given
+    as an `astropy.table.Table` or a structured array."""
+    if isinstance(catalog, astropy.table.Table):
+        catalog = catalog.as_array()
+    return np.asarray(np.ma.getdata(catalog))
+
+
+class Blend_batch(object):
+    """Catalog of all objects in a batch of blends, stored as one structured
+    numpy array ordered by blend, along with the offset of each blend in it.
+
+    Indexing the batch with a blend index returns a view of the entries of that
+    blend, so values written to it are written to the batch catalog. Columns
+    that are computed for all objects (e.g. pixel centers, sizes) are
+    preallocated as fields and filled with a single vectorized write.
+
+    Attributes:
+        data: `numpy.ndarray` with structured dtype of the objects in the
+            batch.
+        offsets: Index in data of the first entry of each blend, followed by
+            the total number of entries.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = np.asarray(offsets, dtype=int)
+
+    @classmethod
+    def from_tables(cls, blend_list, fields=()):
+        """Returns Blend_batch with the entries of input blend catalogs.
+
+        The catalogs are concatenated as structured arrays, or stacked as
+        astropy tables if they do not have the same columns. If blend_list is
+        a `Blend_list` whose tables were never accessed, its batch is used and
+        no table is built. Otherwise the tables that were accessed (and may
+        have been changed) are used, along with the batch entries of the
+        other blends.
+
+        Args:
+            blend_list: List of catalogs with entries corresponding to one
+                blend.
+            fields: List of (name, dtype) of fields to add to the catalog,
+                initialized to zero. Fields already in the catalogs are not
+                added.
+
+        Returns:
+            `Blend_batch` of the input blend catalogs.
+        """
+        if isinstance(blend_list, Blend_list):
+            if not blend_list.is_accessed():
+                return blend_list.blend_batch.add_fields(fields)
+            blend_list = blend_list.get_catalogs()
+        arrays = [get_array(blend) for blend in blend_list]
+        number_of_objects = [len(array) for array in arrays]
+        if len(set(array.dtype for array in arrays)) == 1:
+            data = np.concatenate(arrays)
+        else:
+            data = get_array(astropy.table.vstack(
+                [astropy.table.Table(blend) for blend in blend_list]))
+        return cls.from_catalog(data, number_of_objects, fields=fields)
+
+    @classmethod
+    def from_catalog(cls, batch_catalog, number_of_objects, fields=()):
+        """Returns Blend_batch with the entries of a catalog of all blends in
+        the batch, ordered by blend.
+
+        Args:
+            batch_catalog: Catalog with entries of all blends in the batch, as
+                an `astropy.table.Table` or a structured array.
+            number_of_objects: Number of objects in each blend of the batch.
+            fields: List of (name, dtype) of fields to add to the catalog,
+                initialized to zero. Fields already in the catalog are not
+                added.
+        """
+        offsets = np.concatenate(([0], np.cumsum(number_of_objects)))
+        return cls(get_array(batch_catalog), offsets).add_fields(fields)
+
+    def add_fields(self, fields):
+        """Returns copy of the batch with fields added to the catalog.
+
+        Args:
+            fields: List of (name, dtype) of fields to add to the catalog,
+                initialized to zero. Fields already in the catalog are not
+                added.
+        """
+        names = self.data.dtype.names
+        dtype = self.data.dtype.descr + [
+            (name, np.dtype(field_dtype).str)
+            for name, field_dtype in fields if name not in names]
+        data = np.zeros(len(self.data), dtype=dtype)
+        for name in names:
+            data[name] = self.data[name]
+        return Blend_batch(data, self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def number_of_objects(self):
+        """Returns `numpy.ndarray` with the number of objects in each blend."""
+        return np.diff(self.offsets)
+
+    @property
+    def blend_index(self):
+        """Returns `numpy.ndarray` with index of the blend of each object."""
+        return np.repeat(np.arange(len(self)), self.number_of_objects)
+
+    def get_blends(self, start, stop):
+        """Returns Blend_batch with blends from start to stop. The catalog of
+        the returned batch is a view of this batch catalog.
+
+        Args:
+            start: Index of first blend.
+            stop: Index after the last blend.
+        """
+        stop = min(stop, len(self))
+        offsets = self.offsets[start:stop + 1]
+        return Blend_batch(self.data[offsets[0]:offsets[-1]],
+                           offsets - offsets[0])
+
+    def to_tables(self):
+        """Returns `Blend_list` of `astropy.table.Table` with catalog of each
+        blend, built when they are first accessed.
+
+        The tables are copies, so changes to them do not change the batch.
+        """
+        return Blend_list(self)
+
+
+class Blend_list(collections.abc.Sequence):
+    """List of catalogs of the blends of a `Blend_batch`.
+
+    The catalog of a blend is the input table, or an `astropy.table.Table`
+    copied from the batch catalog the first time it is accessed, so that no
+    table is built for blends whose catalog is not read as a table. Functions
+    that take a `Blend_batch` (e.g. `Blend_batch.from_tables`) use the batch
+    directly if no table was accessed, and the accessed tables otherwise, so
+    that changes made to them are not lost.
+
+    Attributes:
+        blend_batch: `Blend_batch` of the blends.
+    """
+
+    def __init__(self, blend_batch, tables=None):
+        """
+        Args:
+            blend_batch: `Blend_batch` of the blends.
+            tables: List of the catalog of each blend, with the entries of
+                blend_batch. If None, tables are copied from blend_batch.
+        """
+        self.blend_batch = blend_batch
+        if tables is None:
+            tables = [None] * len(blend_batch)
+        self._tables = list(tables)
+        self._accessed = [False] * len(self._tables)
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Blend index out of range")
+        if self._tables[index] is None:
+            self._tables[index] = astropy.table.Table(self.blend_batch[index])
+        self._accessed[index] = True
+        return self._tables[index]
+
+    def is_accessed(self):
+        """Returns True if the table of any blend was accessed, and may have
+        been changed."""
+        return any(self._accessed)
+
+    def get_catalogs(self):
+        """Returns list of the catalog of each blend, given as the table if it
+        was accessed, and as a view of the batch entries otherwise."""
+        return [table if accessed else self.blend_batch[i]
+                for i, (table, accessed) in enumerate(
+                    zip(self._tables, self._accessed))]
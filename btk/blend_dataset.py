@@ -0,0 +1,577 @@
+import os
+import json
+import hashlib
+import collections
+import warnings
+import dill
+import numpy as np
+import btk.blend_batch
+import btk.draw_blends
+
+# Arrays of images of each blend written to a dataset, if in the draw output.
+IMAGE_NAMES = ['blend_images', 'isolated_images', 'blend_images_noiseless']
+# Parameters of btk.config.Simulation_params saved in the dataset metadata.
+PARAMETER_NAMES = ['catalog_name', 'survey_name', 'bands', 'stamp_size',
+                   'pixel_scale', 'max_number', 'batch_size', 'seed',
+                   'add_noise']
+# Maximum size in bytes of the images of the blends of a chunk, so that the
+# chunk buffered by `Dataset_writer` fits in memory.
+MAX_CHUNK_BYTES = 256 * 2**20
+
+
+def get_chunk_name(directory, name, chunk, compress):
+    """Returns name of the file of an array of a chunk of a dataset.
+
+    Args:
+        directory: Directory of the dataset the chunk was written to.
+        name: Name of the array, e.g. 'blend_images' or 'catalog/i_ab'.
+        chunk (int): Index of the chunk in the dataset it was written to.
+        compress (bool): If True the chunk is a compressed npz file.
+    """
+    extension = '.npz' if compress else '.npy'
+    return os.path.join(directory, name, '{0:07d}'.format(chunk) + extension)
+
+
+def write_metadata(path, metadata):
+    """Writes the metadata of a dataset, replacing the previous metadata only
+    once it is written so that it is never left partially written."""
+    filename = os.path.join(path, 'metadata.json')
+    with open(filename + '.tmp', 'w') as outfile:
+        json.dump(metadata, outfile, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def get_parameters(Args):
+    """Returns dict of the parameters in PARAMETER_NAMES of Args that can be
+    saved to json."""
+    parameters = {}
+    for name in PARAMETER_NAMES:
+        value = getattr(Args, name, None)
+        if isinstance(value, (tuple, list)):
+            value = list(value)
+        elif isinstance(value, np.generic):
+            value = value.item()
+        elif not isinstance(value, (int, float, bool, type(None))):
+            value = str(value)
+        parameters[name] = value
+    return parameters
+
+
+class Dataset_writer(object):
+    """Writes batches of blends yielded by `btk.draw_blends.generate` to a
+    chunked dataset directory, with numpy only. Blends are read back with
+    `Blend_dataset` or `generate`.
+
+    Blends are copied to a buffer preallocated for one chunk, and written in
+    chunks of chunk_size blends, reduced so that the images of a chunk take
+    at most max_chunk_bytes. The memory used is then set by max_chunk_bytes,
+    not by the size of the dataset or of the blends. The dataset directory
+    contains:
+        <image name>/<chunk>.npz: Images of the blends of each chunk for each
+            image in IMAGE_NAMES yielded by the draw generator.
+        catalog/<column>/<chunk>.npz: Each column of the catalog of all
+            objects of the blends of the chunk (see
+            `btk.blend_batch.Blend_batch`).
+        offsets/<chunk>.npz: Index in the catalog chunk of the first object of
+            each blend, followed by the number of objects in the chunk.
+        obs_index/<chunk>.npz: Index of the observing conditions of each
+            blend.
+        obs_conditions/<index>.pkl: Observing conditions of the blends,
+            pickled with dill. Observing conditions are written once, the
+            first time blends are drawn with them.
+        metadata.json: Description of the dataset and of its chunks, updated
+            each time a chunk is written.
+    Chunks are written as compressed npz files, or as npy files that are
+    larger but can be memory-mapped if compress is False.
+
+    A dataset that was not closed (e.g. if the process writing it was killed)
+    can be reopened with resume, and blends are then added after its last
+    written chunk. Blends that were buffered but not written are lost, and
+    metadata['number_of_blends'] gives the number of blends in the dataset.
+
+    Attributes:
+        path: Directory of the dataset.
+        chunk_size: Number of blends in each chunk, set when the first batch
+            is added.
+        compress: If True chunks are compressed.
+        metadata: dict with the metadata of the dataset.
+    """
+
+    def __init__(self, path, Args, chunk_size=None, compress=True,
+                 resume=False, max_chunk_bytes=MAX_CHUNK_BYTES):
+        """Creates the dataset directory.
+
+        Args:
+            path: Directory to write the dataset to. It must not contain a
+                dataset already, unless resume is True.
+            Args: Class containing input parameters.
+            chunk_size (int): Maximum number of blends in each chunk. If None,
+                it is Args.batch_size.
+            compress (bool): If True chunks are written as compressed npz
+                files.
+            resume (bool): If True and path contains a dataset that is not
+                complete, blends are added to it. The dataset must have been
+                written with the same parameters and compress.
+            max_chunk_bytes (int): Maximum size in bytes of the images of the
+                blends of a chunk. Chunks have at least one blend.
+        """
+        self.path = path
+        self.chunk_size = int(chunk_size or Args.batch_size)
+        self.compress = compress
+        self.max_chunk_bytes = max_chunk_bytes
+        self._buffer = None
+        self._catalogs = []
+        self._buffered = 0
+        self._catalog_dtype = None
+        self._obs_digests = {}
+        if os.path.isfile(os.path.join(path, 'metadata.json')):
+            if not resume:
+                raise ValueError(f"Dataset already exists at {path}")
+            self._resume(Args)
+            return
+        os.makedirs(path, exist_ok=True)
+        self.metadata = {'chunk_size': self.chunk_size,
+                         'compress': compress,
+                         'parameters': get_parameters(Args),
+                         'images': {},
+                         'catalog_dtype': None,
+                         'number_of_blends': 0,
+                         'number_of_obs_conditions': 0,
+                         'chunks': [],
+                         'complete': False}
+        write_metadata(path, self.metadata)
+
+    def _resume(self, Args):
+        """Reads the metadata and observing conditions of the incomplete
+        dataset at path."""
+        with open(os.path.join(self.path, 'metadata.json')) as infile:
+            self.metadata = json.load(infile)
+        if self.metadata['complete']:
+            raise ValueError(f"Dataset at {self.path} is complete")
+        expected = {'compress': self.compress,
+                    'parameters': json.loads(json.dumps(
+                        get_parameters(Args)))}
+        for name, value in expected.items():
+            if self.metadata[name] != value:
+                raise ValueError("Dataset at {0} was written with a "
+                                 "different {1}: {2} == {3}".format(
+                                     self.path, name, self.metadata[name],
+                                     value))
+        if self.metadata['catalog_dtype'] is not None:
+            self._catalog_dtype = np.dtype(
+                [tuple(field) for field in self.metadata['catalog_dtype']])
+        for index in range(self.metadata['number_of_obs_conditions']):
+            filename = os.path.join(self.path, 'obs_conditions',
+                                    '{0:07d}.pkl'.format(index))
+            with open(filename, 'rb') as infile:
+                digest = hashlib.sha1(infile.read()).hexdigest()
+            self._obs_digests[digest] = index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_obs_index(self, obs_cond):
+        """Returns index of the observing conditions of a blend, writing them
+        to the dataset if they were not written before.
+
+        Observing conditions are identified by the digest of their pickle.
+        """
+        data = dill.dumps(obs_cond)
+        digest = hashlib.sha1(data).hexdigest()
+        if digest not in self._obs_digests:
+            index = len(self._obs_digests)
+            filename = os.path.join(self.path, 'obs_conditions',
+                                    '{0:07d}.pkl'.format(index))
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as outfile:
+                outfile.write(data)
+            self._obs_digests[digest] = index
+            self.metadata['number_of_obs_conditions'] = index + 1
+        return self._obs_digests[digest]
+
+    def append(self, draw_output, start=0):
+        """Adds the blends of a batch yielded by `btk.draw_blends.generate`
+        to the dataset, writing each chunk once it is full.
+
+        Args:
+            draw_output: dict yielded by `btk.draw_blends.generate`.
+            start (int): Index in the batch of the first blend to add.
+        """
+        blend_batch = draw_output['blend_batch']
+        names = [name for name in IMAGE_NAMES if name in draw_output]
+        if self._catalog_dtype is None:
+            self.metadata['images'] = {
+                name: {'shape': list(np.shape(draw_output[name])[1:]),
+                       'dtype': np.asarray(draw_output[name]).dtype.str}
+                for name in names}
+            self.metadata['catalog_dtype'] = blend_batch.data.dtype.descr
+            self._catalog_dtype = blend_batch.data.dtype
+        if set(names) != set(self.metadata['images']):
+            raise ValueError("Images of the batch do not match images of the "
+                             "dataset: {0} == {1}".format(
+                                 names, list(self.metadata['images'])))
+        if blend_batch.data.dtype != self._catalog_dtype:
+            raise ValueError("Catalog of the batch does not match catalog of "
+                             "the dataset")
+        if self._buffer is None:
+            self._allocate_buffer()
+        # observing conditions are often the same objects for all blends.
+        obs_indices = {}
+        obs_index = []
+        for obs_cond in draw_output['obs_condition'][start:]:
+            if id(obs_cond) not in obs_indices:
+                obs_indices[id(obs_cond)] = self.get_obs_index(obs_cond)
+            obs_index.append(obs_indices[id(obs_cond)])
+        obs_index = np.array(obs_index, dtype=int)
+        number_of_objects = blend_batch.number_of_objects
+        index = start
+        while index < len(blend_batch):
+            size = min(len(blend_batch) - index,
+                       self.chunk_size - self._buffered)
+            rows = slice(self._buffered, self._buffered + size)
+            for name in names:
+                self._buffer[name][rows] = draw_output[name][
+                    index:index + size]
+            self._buffer['obs_index'][rows] = obs_index[
+                index - start:index - start + size]
+            self._buffer['number_of_objects'][rows] = number_of_objects[
+                index:index + size]
+            self._catalogs.append(
+                blend_batch.get_blends(index, index + size).data.copy())
+            self._buffered += size
+            index += size
+            if self._buffered == self.chunk_size:
+                self.write_chunk()
+
+    def _allocate_buffer(self):
+        """Sets chunk_size so that the images of a chunk take at most
+        max_chunk_bytes and allocates the buffer of a chunk."""
+        images = self.metadata['images']
+        blend_bytes = sum(np.dtype(image['dtype']).itemsize *
+                          int(np.prod(image['shape']))
+                          for image in images.values())
+        self.chunk_size = max(1, min(self.chunk_size,
+                                     self.max_chunk_bytes // blend_bytes))
+        self.metadata['chunk_size'] = self.chunk_size
+        self._buffer = {name: np.empty([self.chunk_size] + image['shape'],
+                                       dtype=image['dtype'])
+                        for name, image in images.items()}
+        self._buffer['obs_index'] = np.empty(self.chunk_size, dtype=int)
+        self._buffer['number_of_objects'] = np.empty(self.chunk_size,
+                                                     dtype=int)
+
+    @property
+    def number_of_buffered_blends(self):
+        """Returns number of blends added but not written yet."""
+        return self._buffered
+
+    def write_chunk(self):
+        """Writes the buffered blends to a new chunk."""
+        size = self._buffered
+        chunk = len(self.metadata['chunks'])
+        arrays = {name: self._buffer[name][:size]
+                  for name in list(self.metadata['images']) + ['obs_index']}
+        arrays['offsets'] = np.concatenate(
+            ([0], np.cumsum(self._buffer['number_of_objects'][:size])))
+        catalog = np.concatenate(self._catalogs)
+        for column in catalog.dtype.names:
+            arrays['catalog/' + column] = catalog[column]
+        for name, array in arrays.items():
+            filename = get_chunk_name(self.path, name, chunk, self.compress)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            if self.compress:
+                np.savez_compressed(filename, array=array)
+            else:
+                np.save(filename, array)
+        self._buffered = 0
+        self._catalogs = []
+        self.metadata['chunks'].append({'directory': '', 'index': chunk,
+                                        'blends': int(size)})
+        self.metadata['number_of_blends'] += int(size)
+        write_metadata(self.path, self.metadata)
+
+    def close(self):
+        """Writes the buffered blends and marks the dataset as complete."""
+        if self._buffered > 0:
+            self.write_chunk()
+        self._buffer = None
+        self.metadata['complete'] = True
+        write_metadata(self.path, self.metadata)
+
+
+def merge_datasets(path, directories):
+    """Writes metadata of a dataset at path made of the chunks of complete
+    datasets in subdirectories of path, without copying them.
+
+    Args:
+        path: Directory of the merged dataset.
+        directories: Subdirectories of path with the datasets to merge, in
+            the order of their blends.
+
+    Returns:
+        dict with the metadata of the merged dataset.
+    """
+    metadata = None
+    for directory in directories:
+        with open(os.path.join(path, directory, 'metadata.json')) as infile:
+            dataset_metadata = json.load(infile)
+        if not dataset_metadata['complete']:
+            raise ValueError(f"Dataset {directory} is not complete")
+        if metadata is None:
+            metadata = dict(dataset_metadata, chunks=[], number_of_blends=0,
+                            number_of_obs_conditions=None)
+        for name in ['images', 'catalog_dtype', 'compress', 'parameters']:
+            if dataset_metadata[name] != metadata[name]:
+                raise ValueError(f"Dataset {directory} does not match {name} "
+                                 f"of dataset {directories[0]}")
+        for chunk in dataset_metadata['chunks']:
+            metadata['chunks'].append(dict(chunk, directory=os.path.join(
+                directory, chunk['directory'])))
+        metadata['number_of_blends'] += dataset_metadata['number_of_blends']
+    if metadata is None:
+        raise ValueError("No datasets to merge")
+    write_metadata(path, metadata)
+    return metadata
+
+
+def get_ranges(starts, stops):
+    """Returns concatenation of the ranges of integers between each start and
+    stop."""
+    lengths = np.asarray(stops) - np.asarray(starts)
+    ends = np.cumsum(lengths)
+    return (np.repeat(np.asarray(starts) - ends + lengths, lengths) +
+            np.arange(ends[-1] if len(ends) else 0))
+
+
+class Blend_dataset(object):
+    """Dataset written by `Dataset_writer` (or merged by `merge_datasets`),
+    from which blends are read without loading the whole dataset.
+
+    Chunks are memory-mapped when they are first read, so only the images and
+    catalog entries of the blends read are loaded from disk. Compressed
+    chunks are loaded in full, so datasets read in random order should be
+    written uncompressed. The arrays of the last CHUNK_CACHE_SIZE chunks
+    read are kept, and those of other chunks are dropped, which closes their
+    memory maps, so the memory and open files used do not grow with the
+    number of chunks.
+
+    Attributes:
+        path: Directory of the dataset.
+        metadata: dict with the metadata of the dataset.
+        chunk_offsets: Index of the first blend of each chunk, followed by the
+            number of blends in the dataset.
+    """
+    CHUNK_CACHE_SIZE = 8
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json')) as infile:
+            self.metadata = json.load(infile)
+        self.chunk_offsets = np.concatenate(
+            ([0], np.cumsum([chunk['blends']
+                             for chunk in self.metadata['chunks']]))).astype(
+                                 int)
+        self.catalog_dtype = np.dtype([tuple(field) for field in
+                                       self.metadata['catalog_dtype']])
+        self._chunks = collections.OrderedDict()
+        self._obs_conditions = {}
+
+    def __len__(self):
+        return int(self.chunk_offsets[-1])
+
+    @property
+    def image_names(self):
+        """Returns names of the images of each blend in the dataset."""
+        return list(self.metadata['images'])
+
+    def load(self, chunk, name):
+        """Returns array name of chunk, memory-mapped if not compressed."""
+        if chunk in self._chunks:
+            self._chunks.move_to_end(chunk)
+        else:
+            self._chunks[chunk] = {}
+            while len(self._chunks) > self.CHUNK_CACHE_SIZE:
+                self._chunks.popitem(last=False)
+        arrays = self._chunks[chunk]
+        if name in arrays:
+            return arrays[name]
+        chunk_metadata = self.metadata['chunks'][chunk]
+        filename = get_chunk_name(
+            os.path.join(self.path, chunk_metadata['directory']), name,
+            chunk_metadata['index'], self.metadata['compress'])
+        if self.metadata['compress']:
+            with np.load(filename) as data:
+                array = data['array']
+        else:
+            array = np.load(filename, mmap_mode='r')
+        arrays[name] = array
+        return array
+
+    def get_obs_condition(self, chunk, index):
+        """Returns observing conditions with index in the directory of the
+        chunk, loaded only once."""
+        key = (self.metadata['chunks'][chunk]['directory'], int(index))
+        if key not in self._obs_conditions:
+            filename = os.path.join(self.path, key[0], 'obs_conditions',
+                                    '{0:07d}.pkl'.format(key[1]))
+            with open(filename, 'rb') as infile:
+                self._obs_conditions[key] = dill.load(infile)
+        return self._obs_conditions[key]
+
+    def get_blends(self, indices, image_names=None):
+        """Returns images, catalog and observing conditions of the blends
+        with the input indices in the dataset.
+
+        Args:
+            indices: Indices of the blends to read, in the order they are
+                returned.
+            image_names: Names of the images to read. If None, all images in
+                the dataset are read.
+
+        Returns:
+            dict with an array of the blends for each image name,
+            `btk.blend_batch.Blend_batch` of the blends ('blend_batch') and
+            list of the observing conditions of each blend ('obs_condition').
+        """
+        indices = np.asarray(indices, dtype=int)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError("Blend indices must be between 0 and "
+                             "{0}".format(len(self)))
+        if image_names is None:
+            image_names = self.image_names
+        chunks = np.searchsorted(self.chunk_offsets, indices,
+                                 side='right') - 1
+        local_indices = indices - self.chunk_offsets[chunks]
+        output = {name: np.empty((len(indices),) + tuple(
+            self.metadata['images'][name]['shape']),
+            dtype=self.metadata['images'][name]['dtype'])
+            for name in image_names}
+        number_of_objects = np.empty(len(indices), dtype=int)
+        obs_index = np.empty(len(indices), dtype=int)
+        # all arrays of a chunk are read at once, so that each chunk is
+        # loaded once even if it is dropped from the cache afterwards.
+        catalogs = []
+        for chunk in np.unique(chunks):
+            selected, = np.where(chunks == chunk)
+            for name in image_names:
+                output[name][selected] = self.load(chunk, name)[
+                    local_indices[selected]]
+            offsets = self.load(chunk, 'offsets')
+            number_of_objects[selected] = np.diff(offsets)[
+                local_indices[selected]]
+            obs_index[selected] = self.load(chunk, 'obs_index')[
+                local_indices[selected]]
+            rows = get_ranges(offsets[local_indices[selected]],
+                              offsets[local_indices[selected] + 1])
+            catalog = np.empty(len(rows), dtype=self.catalog_dtype)
+            for column in self.catalog_dtype.names:
+                catalog[column] = self.load(chunk, 'catalog/' + column)[rows]
+            catalogs.append((selected, catalog))
+        batch_offsets = np.concatenate(([0], np.cumsum(number_of_objects)))
+        data = np.zeros(batch_offsets[-1], dtype=self.catalog_dtype)
+        for selected, catalog in catalogs:
+            data[get_ranges(batch_offsets[selected],
+                            batch_offsets[selected + 1])] = catalog
+        output['blend_batch'] = btk.blend_batch.Blend_batch(data,
+                                                            batch_offsets)
+        output['obs_condition'] = [self.get_obs_condition(chunk, index)
+                                   for chunk, index in zip(chunks, obs_index)]
+        return output
+
+    def check_parameters(self, Args):
+        """Raises ValueError if the dataset was drawn with different
+        parameters than those input."""
+        parameters = get_parameters(Args)
+        for name in ['survey_name', 'bands', 'stamp_size', 'pixel_scale',
+                     'max_number']:
+            if self.metadata['parameters'][name] != parameters[name]:
+                raise ValueError("dataset {0} does not match input {0}: "
+                                 "{1} == {2}".format(
+                                     name, self.metadata['parameters'][name],
+                                     parameters[name]))
+
+
+def get_batch_indices(Args, number_of_blends, shuffle, batch_index):
+    """Yields indices in the dataset of the blends of each batch, starting
+    with batch batch_index.
+
+    Blends are read in order, or in the order of a random permutation of the
+    dataset with shuffle, and read again once all blends were read. The
+    permutation of each pass over the dataset is drawn from Args.seed and the
+    index of the pass only.
+    """
+    start = batch_index * Args.batch_size
+    while True:
+        stop = start + Args.batch_size
+        positions = np.arange(start, stop)
+        passes = positions // number_of_blends
+        indices = positions % number_of_blends
+        if shuffle:
+            for dataset_pass in np.unique(passes):
+                permutation = np.random.default_rng(
+                    [Args.seed, int(dataset_pass)]).permutation(
+                        number_of_blends)
+                selected = passes == dataset_pass
+                indices[selected] = permutation[indices[selected]]
+        start = stop
+        yield indices
+
+
+def generate(Args, dataset, shuffle=False, add_noise=False, batch_index=0):
+    """Generates batches of blends read from a dataset, with the same output
+    as `btk.draw_blends.generate`.
+
+    If add_noise is True, noise is added to the noiseless blend images of the
+    dataset when they are read (see `btk.draw_blends.add_batch_noise`), so
+    that each pass over the dataset has new noise realizations, and the
+    noiseless images are output as 'blend_images_noiseless'.
+
+    Args:
+        Args: Class containing parameters to create blends. Batches have
+            Args.batch_size blends.
+        dataset: `Blend_dataset` or directory of the dataset to read.
+        shuffle (bool): If True blends are read in random order (see
+            `get_batch_indices`). A warning is raised if the chunks of the
+            dataset are compressed, since they are decompressed in full to
+            read each blend.
+        add_noise (bool): If True noise is added to the noiseless blend
+            images.
+        batch_index (int): Index of the first batch to read.
+
+    Yields:
+        Dictionary with blend images, isolated object images, blend catalog,
+        and observing conditions.
+    """
+    if not isinstance(dataset, Blend_dataset):
+        dataset = Blend_dataset(dataset)
+    dataset.check_parameters(Args)
+    if shuffle and dataset.metadata['compress']:
+        warnings.warn("Blends are read in random order from compressed "
+                      "chunks, which are decompressed in full for each "
+                      "batch. Write the dataset with compress=False to read "
+                      "blends from memory-mapped chunks.")
+    image_names = dataset.image_names
+    if add_noise:
+        if 'blend_images_noiseless' in image_names:
+            image_names.remove('blend_images')
+        elif dataset.metadata['parameters']['add_noise']:
+            raise ValueError("noise can only be added to datasets with "
+                             "noiseless blend images")
+        noise_rng = np.random.default_rng(Args.seed)
+    for indices in get_batch_indices(Args, len(dataset), shuffle,
+                                     batch_index):
+        output = dataset.get_blends(indices, image_names=image_names)
+        blend_batch = output['blend_batch']
+        output['blend_list'] = blend_batch.to_tables()
+        if add_noise:
+            noiseless = output.get('blend_images_noiseless',
+                                   output.get('blend_images'))
+            output['blend_images_noiseless'] = noiseless
+            output['blend_images'] = btk.draw_blends.add_batch_noise(
+                Args, noiseless, output['obs_condition'], noise_rng,
+                batch_index)
+        batch_index += 1
+        yield output
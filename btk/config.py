@@ -15,6 +15,17 @@ class Simulation_params(object):
             exposure time and the noise N is set by the expected fluctuations
             in the sky background during a full exposure.
         verbose: If true, prints description at multiple steps.
+        psf_tolerance(float): If not None, galaxies are rendered once for
+            bands with PSF images that differ by at most psf_tolerance times
+            the PSF peak, and scaled by the flux in each band.
+        batch_noise(bool): If True, noise is added to the blend images of
+            the whole batch at once (see `btk.draw_blends.add_noise`) instead
+            of while each blend is drawn, and the noiseless blend images are
+            kept in the output.
+        seed_per_blend(bool): If True, the random numbers of each blend are
+            derived from seed, the index of the batch and the index of the
+            blend in the batch only, so that blends do not depend on the
+            number of processes or on the batches generated before.
     """
 
     def __init__(self, catalog_name, max_number=2,
@@ -22,7 +33,8 @@ class Simulation_params(object):
                  survey_name="LSST",
                  seed=0, add_noise=True,
                  bands=('u', 'g', 'r', 'i', 'z', 'y'), min_snr=0.05,
-                 verbose=False, **kwargs):
+                 verbose=False, psf_tolerance=None, batch_noise=False,
+                 seed_per_blend=False, **kwargs):
         """Inits Simulation_params with input observing conditions and image
         parametrs."""
         self.__dict__.update(kwargs)
@@ -36,6 +48,9 @@ class Simulation_params(object):
         self.bands = bands
         self.min_snr = min_snr
         self.verbose = verbose
+        self.psf_tolerance = psf_tolerance
+        self.batch_noise = batch_noise
+        self.seed_per_blend = seed_per_blend
         if survey_name is "LSST":
             self.pixel_scale = 0.2
         elif survey_name is "DES":
@@ -1,5 +1,144 @@
+import inspect
 import numpy as np
 import warnings
+import btk.blend_batch
+import btk.get_input_catalog
+
+
+# Streams of random numbers drawn for each blend or batch when
+# Args.seed_per_blend is True (see `get_seed_sequence`).
+SAMPLING_STREAM = 0
+BATCH_SAMPLING_STREAM = 1
+OBS_STREAM = 2
+DRAW_STREAM = 3
+NOISE_STREAM = 4
+
+
+def get_seed_sequence(Args, batch_index, blend_index, stream):
+    """Returns `numpy.random.SeedSequence` of a stream of random numbers of a
+    blend, derived from (Args.seed, stream, batch_index, blend_index) only.
+
+    Random numbers drawn from it do not depend on the blends generated
+    before, or on the process the blend is generated in.
+
+    Args:
+        Args: Class containing input parameters.
+        batch_index (int): Index of the batch.
+        blend_index (int): Index of the blend in the batch. Streams drawn
+            once per batch use 0.
+        stream (int): Stream of random numbers, e.g. SAMPLING_STREAM.
+    """
+    return np.random.SeedSequence([Args.seed, stream, batch_index,
+                                   blend_index])
+
+
+def get_random_state(Args, batch_index, blend_index, stream):
+    """Returns state of a `numpy.random.RandomState` seeded with
+    `get_seed_sequence`, that can be set as the global numpy random state
+    with `numpy.random.set_state`.
+    """
+    seed_sequence = get_seed_sequence(Args, batch_index, blend_index, stream)
+    return np.random.RandomState(
+        np.random.MT19937(seed_sequence)).get_state()
+
+
+def set_random_state(Args, batch_index, blend_index, stream):
+    """Sets the global numpy random state to that of the stream of the
+    blend if Args.seed_per_blend is True (see `get_random_state`)."""
+    if getattr(Args, 'seed_per_blend', False):
+        np.random.set_state(get_random_state(Args, batch_index, blend_index,
+                                             stream))
+
+
+class Sampling_index(object):
+    """Index of catalog rows sorted by magnitude, built once per catalog so
+    that sampling functions do not scan the full catalog for each blend.
+
+    Rows brighter than a magnitude cut are found by a binary search on the
+    sorted magnitudes. The selected rows are returned in catalog order and are
+    cached, so repeated cuts cost O(1) and random draws from them are the same
+    as those from `np.where` on the catalog. Boolean masks of the catalog (e.g.
+    size cuts) can be added with `set_mask` and combined with magnitude cuts.
+
+    Attributes:
+        catalog: CatSim-like catalog the index is built for.
+        mag_name: Name of the magnitude column rows are sorted by.
+        order: Catalog row indices sorted by magnitude.
+        sorted_mag: Magnitudes in sorted order.
+        masks: dict of boolean masks of catalog rows.
+        cache: dict that sampling functions may use to store other structures
+            built once per catalog.
+    """
+
+    def __init__(self, catalog, mag_name='i_ab'):
+        self.catalog = catalog
+        self.mag_name = mag_name
+        mag = np.asarray(catalog[mag_name])
+        self.order = np.argsort(mag, kind='stable')
+        self.sorted_mag = mag[self.order]
+        self.masks = {}
+        self.cache = {}
+        self._rows = {}
+
+    def set_mask(self, name, mask):
+        """Adds boolean mask of catalog rows that can be input to get_rows.
+
+        Args:
+            name: Name of the mask.
+            mask: Boolean array with length of the catalog.
+        """
+        self.masks[name] = np.asarray(mask, dtype=bool)
+        for key in [k for k in self._rows if k[2] == name]:
+            del self._rows[key]
+
+    def get_rows(self, max_mag, inclusive=True, mask=None):
+        """Returns indices of catalog rows brighter than or equal to max_mag,
+        in catalog order.
+
+        Args:
+            max_mag: Magnitude cut.
+            inclusive: If True rows with magnitude equal to max_mag are
+                selected too.
+            mask: Name of mask (set with `set_mask`) that rows must satisfy.
+
+        Returns:
+            `numpy.ndarray` of catalog row indices.
+        """
+        key = (max_mag, inclusive, mask)
+        if key not in self._rows:
+            side = 'right' if inclusive else 'left'
+            stop = np.searchsorted(self.sorted_mag, max_mag, side=side)
+            rows = np.sort(self.order[:stop])
+            if mask is not None:
+                rows = rows[self.masks[mask][rows]]
+            self._rows[key] = rows
+        return self._rows[key]
+
+
+def has_column(catalog, name):
+    """Returns True if the catalog (astropy table or structured array) has a
+    column name."""
+    if hasattr(catalog, 'colnames'):
+        return name in catalog.colnames
+    return name in (catalog.dtype.names or ())
+
+
+def get_sampling_index(catalog, mag_name='i_ab'):
+    """Returns `Sampling_index` of the catalog, or dict of `Sampling_index`
+    of each type if catalog is a `btk.get_input_catalog.Multi_catalog`.
+
+    Returns None if the catalog (or the catalog of any type) does not have the
+    magnitude column, so that sampling functions select rows on the catalog.
+    """
+    if isinstance(catalog, btk.get_input_catalog.Multi_catalog):
+        if not all(has_column(catalog[name], mag_name)
+                   for name in catalog.types):
+            return None
+        return {name: Sampling_index(catalog[name], mag_name=mag_name)
+                for name in catalog.types}
+    if not has_column(catalog, mag_name):
+        return None
+    return Sampling_index(catalog, mag_name=mag_name)
 
 
 def get_random_center_shift(Args, number_of_objects, maxshift=None):
@@ -21,7 +160,7 @@ def get_random_center_shift(Args, number_of_objects, maxshift=None):
     return dx, dy
 
 
-def default_sampling(Args, catalog):
+def default_sampling(Args, catalog, sampling_index=None):
     """Applies default sampling to the input CatSim-like catalog and returns
     catalog with entries corresponding to a blend centered close to postage
     stamp center.
@@ -37,12 +176,17 @@ def default_sampling(Args, catalog):
     Args:
         Args: Class containing input parameters.
         catalog: CatSim-like catalog from which to sample galaxies.
+        sampling_index: `Sampling_index` of the catalog. If None, the
+            magnitude cut is computed on the catalog.
 
     Returns:
         Catalog with entries corresponding to one blend.
     """
     number_of_objects = np.random.randint(1, Args.max_number + 1)
-    q, = np.where(catalog['i_ab'] <= 25.3)
+    if sampling_index is not None:
+        q = sampling_index.get_rows(25.3)
+    else:
+        q, = np.where(catalog['i_ab'] <= 25.3)
     blend_catalog = catalog[np.random.choice(q, size=number_of_objects)]
     blend_catalog['ra'], blend_catalog['dec'] = 0., 0.
     dx, dy = get_random_center_shift(Args, number_of_objects)
@@ -51,34 +195,163 @@ def default_sampling(Args, catalog):
     return blend_catalog
 
 
-def generate(Args, catalog, sampling_function=None):
+def split_batch_catalog(batch_catalog, number_of_objects):
+    """Returns list of blend catalogs split from a catalog with the entries of
+    all blends in a batch.
+
+    The batch catalog is converted once to the structured array of a
+    `btk.blend_batch.Blend_batch`, and the catalog of each blend is only
+    built as a table if it is accessed (see `btk.blend_batch.Blend_list`).
+
+    Args:
+        batch_catalog: Catalog with entries of all blends in the batch, ordered
+            by blend.
+        number_of_objects: Number of objects in each blend of the batch.
+
+    Returns:
+        `btk.blend_batch.Blend_list` of catalogs with entries corresponding to
+        one blend.
+    """
+    return btk.blend_batch.Blend_list(btk.blend_batch.Blend_batch.from_catalog(
+        batch_catalog, number_of_objects))
+
+
+def default_batch_sampling(Args, catalog, sampling_index=None):
+    """Applies default sampling to the input CatSim-like catalog for all blends
+    in the batch at once.
+
+    The blends are sampled as in `default_sampling`, but the number of objects
+    per blend, the catalog entries and the center shifts of the whole batch are
+    each drawn with a single call. The entries are then gathered from the
+    catalog once and split into blend catalogs.
+
+    Args:
+        Args: Class containing input parameters.
+        catalog: CatSim-like catalog from which to sample galaxies.
+        sampling_index: `Sampling_index` of the catalog. If None, the
+            magnitude cut is computed on the catalog.
+
+    Returns:
+        List of Args.batch_size catalogs with entries corresponding to one
+        blend.
+    """
+    number_of_objects = np.random.randint(1, Args.max_number + 1,
+                                          size=Args.batch_size)
+    if sampling_index is not None:
+        q = sampling_index.get_rows(25.3)
+    else:
+        q, = np.where(catalog['i_ab'] <= 25.3)
+    total = number_of_objects.sum()
+    batch_catalog = catalog[np.random.choice(q, size=total)]
+    batch_catalog['ra'], batch_catalog['dec'] = get_random_center_shift(
+        Args, total)
+    return split_batch_catalog(batch_catalog, number_of_objects)
+
+
+def generate(Args, catalog, sampling_function=None,
+             batch_sampling_function=None, batch_index=0):
     """Generates a list of blend catalogs of length Args.batch_size. Each blend
     catalog has entries numbered between 1 and Args.max_number, corresponding
     to overlapping objects in the blend.
 
+    A `Sampling_index` of the catalog is built once and input to the default
+    sampling function and to batch_sampling_function. It is also input to
+    sampling_function if the function has a `sampling_index` argument, and
+    is not built otherwise. If the catalog does not have the magnitude column
+    of the index, None is input instead.
+
+    If batch_sampling_function is input, it is called once per batch to sample
+    all blends of the batch, instead of calling sampling_function once per
+    blend.
+
+    If catalog is a `btk.get_input_catalog.Multi_catalog`, sampling_index is
+    a dict of `Sampling_index` of the catalog of each type, and a sampling
+    function that supports it must be input (e.g.
+    `btk.utils.multi_catalog_batch_sampling_function`).
+
+    If catalog is a `btk.get_input_catalog.Catalog_reservoir`, blends of each
+    batch are sampled from the sample of the batch (see
+    `btk.get_input_catalog.Catalog_reservoir.get_catalog`), and the sampling
+    index is rebuilt when the sample is replaced.
+
+    Blends of each batch are yielded as a `btk.blend_batch.Blend_list`,
+    whose `btk.blend_batch.Blend_batch` holds the entries of all blends in
+    one structured array, and the blend catalogs are checked on that array.
+    Tables of the list that are accessed after they are yielded are used
+    instead of the array when the blends are drawn, so changes made to them
+    are drawn, while the array is used as is if no table is accessed.
+
+    If Args.seed_per_blend is True, the global numpy random state is set
+    before each blend is sampled (or before each batch with
+    batch_sampling_function) from the seed, the index of the batch and the
+    index of the blend (see `get_random_state`), so that a blend is the same
+    whichever batches are generated before it.
+
     Args:
         Args: Class containing input parameters.
+        catalog: CatSim-like catalog from which to sample galaxies.
         sampling_function: Function to sample input catalog from which to draw
                            blends.
+        batch_sampling_function: Function with arguments (Args, catalog,
+            sampling_index) that returns list of Args.batch_size blend
+            catalogs, e.g. `default_batch_sampling`.
+        batch_index (int): Index of the first batch to generate.
 
     Yields:
         Generator for parameters of each galaxy in blend.
     """
+    reservoir = None
+    if isinstance(catalog, btk.get_input_catalog.Catalog_reservoir):
+        reservoir, catalog = catalog, catalog.get_catalog(batch_index)
+    use_index = True
+    kwargs = {}
+    if sampling_function and not batch_sampling_function:
+        parameters = inspect.signature(sampling_function).parameters
+        use_index = 'sampling_index' in parameters
+    sampling_index = get_sampling_index(catalog) if use_index else None
+    if sampling_function and use_index:
+        kwargs['sampling_index'] = sampling_index
     while True:
-        blend_catalogs = []
-        for i in range(Args.batch_size):
-            if sampling_function:
-                blend_catalog = sampling_function(Args, catalog)
-            else:
-                blend_catalog = default_sampling(Args, catalog)
-                if Args.verbose:
-                    print("Default random sampling of objects from catalog")
-            if len(blend_catalog) > Args.max_number:
-                raise ValueError("Number of objects per blend must be less \
-                    than max_number: {0} <= {1}".format(
-                        len(blend_catalog), Args.max_number))
-            if (np.any(blend_catalog['ra'] > Args.stamp_size/2.) or
-                    np.any(blend_catalog['dec'] > Args.stamp_size/2.)):
-                warnings.warn('Object center lies outside the stamp')
-            blend_catalogs.append(blend_catalog)
+        if (reservoir is not None and
+                reservoir.get_catalog(batch_index) is not catalog):
+            catalog = reservoir.catalog
+            if use_index:
+                sampling_index = get_sampling_index(catalog)
+            if 'sampling_index' in kwargs:
+                kwargs['sampling_index'] = sampling_index
+        if batch_sampling_function:
+            set_random_state(Args, batch_index, 0, BATCH_SAMPLING_STREAM)
+            blend_catalogs = batch_sampling_function(
+                Args, catalog, sampling_index=sampling_index)
+            if len(blend_catalogs) != Args.batch_size:
+                raise ValueError("Batch sampling function must return \
+                    batch_size blend catalogs: {0} == {1}".format(
+                        len(blend_catalogs), Args.batch_size))
+        else:
+            blend_catalogs = []
+            for i in range(Args.batch_size):
+                set_random_state(Args, batch_index, i, SAMPLING_STREAM)
+                if sampling_function:
+                    blend_catalog = sampling_function(Args, catalog, **kwargs)
+                else:
+                    blend_catalog = default_sampling(
+                        Args, catalog, sampling_index=sampling_index)
+                    if Args.verbose:
+                        print("Default random sampling of objects from "
+                              "catalog")
+                blend_catalogs.append(blend_catalog)
+        if not isinstance(blend_catalogs, btk.blend_batch.Blend_list):
+            blend_catalogs = btk.blend_batch.Blend_list(
+                btk.blend_batch.Blend_batch.from_tables(blend_catalogs),
+                tables=blend_catalogs)
+        blend_batch = blend_catalogs.blend_batch
+        number_of_objects = blend_batch.number_of_objects.max()
+        if number_of_objects > Args.max_number:
+            raise ValueError("Number of objects per blend must be less \
+                than max_number: {0} <= {1}".format(
+                    number_of_objects, Args.max_number))
+        if (np.any(blend_batch.data['ra'] > Args.stamp_size/2.) or
+                np.any(blend_batch.data['dec'] > Args.stamp_size/2.)):
+            warnings.warn('Object center lies outside the stamp')
+        batch_index += 1
         yield blend_catalogs
@@ -1,4 +1,93 @@
+import collections
 import descwl
+import numpy as np
+import btk.create_blend_generator
+
+# Surveys built by `get_survey`, keyed by `get_survey_key`. The oldest entries
+# are removed once the cache holds more than SURVEY_CACHE_SIZE surveys.
+SURVEY_CACHE = collections.OrderedDict()
+SURVEY_CACHE_SIZE = 64
+# Psf_artifacts computed by `get_psf_artifacts`, keyed by PSF parameters.
+PSF_CACHE = collections.OrderedDict()
+PSF_CACHE_SIZE = 64
+
+
+class Psf_artifacts(object):
+    """Quantities of the PSF and sky background of observing conditions that
+    are used when drawing and measuring blends, each computed once.
+
+    Attributes:
+        psf_model: galsim model of the PSF.
+        pixel_scale: Pixel scale of the observing conditions.
+        mean_sky_level: Mean sky background level per pixel.
+        sky_rms: Square root of mean_sky_level.
+    """
+
+    def __init__(self, psf_model, pixel_scale, mean_sky_level):
+        self.psf_model = psf_model
+        self.pixel_scale = pixel_scale
+        self.mean_sky_level = mean_sky_level
+        self.sky_rms = mean_sky_level**0.5
+        self._moment_radius = None
+        self._stamps = {}
+
+    @property
+    def moment_radius(self):
+        """Returns PSF second moment size computed by galsim."""
+        if self._moment_radius is None:
+            self._moment_radius = self.psf_model.calculateMomentRadius()
+        return self._moment_radius
+
+    def get_stamp(self, size, scale=None):
+        """Returns read-only image of the PSF drawn on a size x size postage
+        stamp.
+
+        Args:
+            size: Number of pixels on each side of the stamp.
+            scale: Pixel scale of the stamp. If None, the pixel scale of the
+                observing conditions is used.
+        """
+        if scale is None:
+            scale = self.pixel_scale
+        key = (size, scale)
+        if key not in self._stamps:
+            stamp = self.psf_model.drawImage(scale=scale, nx=size,
+                                             ny=size).array
+            stamp.flags.writeable = False
+            self._stamps[key] = stamp
+        return self._stamps[key]
+
+
+def get_psf_artifacts(obs_cond):
+    """Returns `Psf_artifacts` of the observing conditions.
+
+    Artifacts are cached by (psf_model, pixel_scale, mean_sky_level), so that
+    copies of the same observing conditions share them. Artifacts precomputed
+    for the survey (see `Obs_grid`) are returned directly.
+
+    Args:
+        obs_cond: `descwl.survey.Survey` class describing observing
+            conditions.
+    """
+    psf_artifacts = getattr(obs_cond, 'btk_psf_artifacts', None)
+    if psf_artifacts is not None:
+        return psf_artifacts
+    try:
+        key = (obs_cond.psf_model, obs_cond.pixel_scale,
+               obs_cond.mean_sky_level)
+        hash(key)
+    except TypeError:
+        return Psf_artifacts(obs_cond.psf_model, obs_cond.pixel_scale,
+                             obs_cond.mean_sky_level)
+    if key in PSF_CACHE:
+        PSF_CACHE.move_to_end(key)
+        return PSF_CACHE[key]
+    psf_artifacts = Psf_artifacts(obs_cond.psf_model, obs_cond.pixel_scale,
+                                  obs_cond.mean_sky_level)
+    PSF_CACHE[key] = psf_artifacts
+    if len(PSF_CACHE) > PSF_CACHE_SIZE:
+        PSF_CACHE.popitem(last=False)
+    return psf_artifacts
 
 
 def default_obs_conditions(Args, band):
@@ -17,21 +106,234 @@ def default_obs_conditions(Args, band):
     return survey
 
 
-def generate(Args, obs_function=None):
+def make_survey(Args, band, survey):
+    """Returns `descwl.survey.Survey` with the input observing conditions and
+    the stamp size of the simulation.
+
+    Args:
+        Args: Class containing input parameters.
+        band: filter name of the observing conditions.
+        survey: dict of observing conditions.
+    """
+    survey = dict(survey)
+    survey['image_width'] = Args.stamp_size / survey['pixel_scale']
+    survey['image_height'] = Args.stamp_size / survey['pixel_scale']
+    descwl_survey = descwl.survey.Survey(no_analysis=True,
+                                         survey_name=Args.survey_name,
+                                         filter_band=band, **survey)
+    if descwl_survey.pixel_scale != Args.pixel_scale:
+        raise ValueError("observing condition pixel scale does not \
+            match input pixel scale: {0} == {1}".format(
+                descwl_survey.pixel_scale, Args.pixel_scale))
+    if descwl_survey.filter_band != band:
+        raise ValueError("observing condition band does not \
+            match input band: {0} == {1}".format(
+                descwl_survey.filter_band, band))
+    return descwl_survey
+
+
+def get_survey_key(Args, band, survey):
+    """Returns hashable key that identifies the observing conditions.
+
+    Args:
+        Args: Class containing input parameters.
+        band: filter name of the observing conditions.
+        survey: dict of observing conditions.
+    """
+    parameters = tuple(sorted((name, repr(value))
+                              for name, value in survey.items()))
+    return (Args.survey_name, band, Args.stamp_size, parameters)
+
+
+def get_survey(Args, band, survey):
+    """Returns `descwl.survey.Survey` with the input observing conditions,
+    built only once for each set of conditions.
+
+    The survey is tagged with its key (see `get_survey_key`) as attribute
+    btk_key. Since the same survey is returned for the same observing
+    conditions, it must not be modified: images are drawn on copies of it.
+
+    Args:
+        Args: Class containing input parameters.
+        band: filter name of the observing conditions.
+        survey: dict of observing conditions.
+    """
+    key = get_survey_key(Args, band, survey)
+    if key in SURVEY_CACHE:
+        SURVEY_CACHE.move_to_end(key)
+        return SURVEY_CACHE[key]
+    descwl_survey = make_survey(Args, band, survey)
+    descwl_survey.btk_key = key
+    SURVEY_CACHE[key] = descwl_survey
+    if len(SURVEY_CACHE) > SURVEY_CACHE_SIZE:
+        SURVEY_CACHE.popitem(last=False)
+    return descwl_survey
+
+
+class Obs_grid(object):
+    """Grid of observing conditions over seeing, sky brightness and exposure
+    time, used to simulate blends with different observing conditions within
+    a batch.
+
+    The default observing conditions of each band are modified by a factor of
+    the PSF FWHM, an offset of the sky brightness (in mag) and a factor of the
+    exposure time. A `descwl.survey.Survey` and its `Psf_artifacts` are built
+    for every node of the grid when the grid is created, so that conditions
+    sampled for each blend are looked up without building PSF models.
+
+    The conditions of each blend are drawn with the distribution function,
+    which takes (Args, number of blends) as input and returns a dict of arrays
+    fwhm_scale, sky_offset and exposure_scale. By default they are drawn
+    uniformly within the range of the grid. The survey at the nearest grid node
+    is used to draw the blend, while `get_psf_stamp` interpolates PSF stamps
+    between grid nodes.
+
+    Attributes:
+        fwhm_scale: Grid of factors of the PSF FWHM.
+        sky_offset: Grid of offsets of the sky brightness.
+        exposure_scale: Grid of factors of the exposure time.
+        surveys: dict of `descwl.survey.Survey` keyed by (band, index of
+            fwhm_scale, index of sky_offset, index of exposure_scale).
+    """
+
+    def __init__(self, Args, fwhm_scale=np.linspace(0.8, 1.2, 9),
+                 sky_offset=(0.,), exposure_scale=(1.,), distribution=None):
+        """Builds surveys at all nodes of the grid.
+
+        Args:
+            Args: Class containing input parameters.
+            fwhm_scale: Increasing grid of factors of the PSF FWHM.
+            sky_offset: Increasing grid of offsets of the sky brightness.
+            exposure_scale: Increasing grid of factors of the exposure time.
+            distribution: Function that returns parameters of each blend. If
+                None, parameters are drawn uniformly within the grid.
+        """
+        self.Args = Args
+        self.fwhm_scale = np.asarray(fwhm_scale, dtype=float)
+        self.sky_offset = np.asarray(sky_offset, dtype=float)
+        self.exposure_scale = np.asarray(exposure_scale, dtype=float)
+        self.distribution = distribution
+        self.surveys = {}
+        for band in Args.bands:
+            defaults = default_obs_conditions(Args, band)
+            for i, fwhm_scale in enumerate(self.fwhm_scale):
+                for j, sky_offset in enumerate(self.sky_offset):
+                    for k, exposure_scale in enumerate(self.exposure_scale):
+                        survey = dict(defaults)
+                        survey['zenith_psf_fwhm'] *= fwhm_scale
+                        survey['sky_brightness'] += sky_offset
+                        survey['exposure_time'] *= exposure_scale
+                        descwl_survey = make_survey(Args, band, survey)
+                        descwl_survey.btk_key = get_survey_key(Args, band,
+                                                               survey)
+                        psf_artifacts = Psf_artifacts(
+                            descwl_survey.psf_model,
+                            descwl_survey.pixel_scale,
+                            descwl_survey.mean_sky_level)
+                        # compute PSF size now instead of when drawing.
+                        psf_artifacts.moment_radius
+                        descwl_survey.btk_psf_artifacts = psf_artifacts
+                        self.surveys[(band, i, j, k)] = descwl_survey
+
+    def sample_parameters(self, number):
+        """Returns dict of arrays fwhm_scale, sky_offset and exposure_scale
+        with the observing conditions of number blends."""
+        if self.distribution:
+            return self.distribution(self.Args, number)
+        return {name: np.random.uniform(grid.min(), grid.max(), size=number)
+                for name, grid in [('fwhm_scale', self.fwhm_scale),
+                                   ('sky_offset', self.sky_offset),
+                                   ('exposure_scale', self.exposure_scale)]}
+
+    def get_surveys(self, parameters):
+        """Returns list with the surveys in each band at the grid node nearest
+        to the observing conditions of each blend.
+
+        Args:
+            parameters: dict of arrays fwhm_scale, sky_offset and
+                exposure_scale of each blend.
+        """
+        index = []
+        for name in ['fwhm_scale', 'sky_offset', 'exposure_scale']:
+            grid = getattr(self, name)
+            values = np.asarray(parameters[name], dtype=float)
+            index.append(np.abs(values[:, np.newaxis] - grid).argmin(axis=1))
+        return [[self.surveys[(band, i, j, k)] for band in self.Args.bands]
+                for i, j, k in zip(*index)]
+
+    def sample(self, number):
+        """Returns list with the surveys in each band of number blends with
+        randomly drawn observing conditions."""
+        return self.get_surveys(self.sample_parameters(number))
+
+    def get_psf_stamp(self, band, fwhm_scale, size):
+        """Returns PSF stamp for the input factor of the PSF FWHM, linearly
+        interpolated between the PSF stamps at the nearest grid nodes.
+
+        Args:
+            band: Name of the band.
+            fwhm_scale: Factor of the PSF FWHM.
+            size: Number of pixels on each side of the stamp.
+        """
+        grid = self.fwhm_scale
+        if len(grid) == 1:
+            return self.surveys[(band, 0, 0, 0)].btk_psf_artifacts.get_stamp(
+                size)
+        i = np.clip(np.searchsorted(grid, fwhm_scale) - 1, 0, len(grid) - 2)
+        weight = np.clip((fwhm_scale - grid[i]) / (grid[i + 1] - grid[i]),
+                         0, 1)
+        stamps = [self.surveys[(band, n, 0, 0)].btk_psf_artifacts.get_stamp(
+            size) for n in (i, i + 1)]
+        return (1 - weight) * stamps[0] + weight * stamps[1]
+
+
+def generate(Args, obs_function=None, obs_grid=None, batch_index=0):
     """Generates class with observing conditions in each band.
 
+    Surveys are reused for observing conditions that were already generated
+    (see `get_survey`). The default observing conditions are computed only
+    once. If obs_function has an attribute varies_per_batch set to True, a new
+    survey is built for each batch without being cached.
+
+    If obs_grid is input, observing conditions are drawn for each blend of the
+    batch (see `Obs_grid`), and a list with the surveys of each blend is
+    yielded instead.
+
+    If Args.seed_per_blend is True, the global numpy random state is set
+    from the seed and the index of the batch before the observing conditions
+    of each batch are drawn (see
+    `btk.create_blend_generator.get_random_state`).
+
     Args:
         Args: Class containing input parameters.
         obs_function: Function that outputs dict of observing conditions. If
             not provided then the default `descwl.survey.Survey` values for the
             corresponding Args.survey_name are used to create the
             observing_generator.
+        obs_grid: `Obs_grid` to draw observing conditions of each blend from.
+        batch_index (int): Index of the first batch to generate.
 
     Yields:
-        Generator with `descwl.survey.Survey` class for each band.
+        Generator with `descwl.survey.Survey` class for each band, or with a
+        list of them for each blend in the batch if obs_grid is input.
     """
+    if obs_grid is not None:
+        while True:
+            btk.create_blend_generator.set_random_state(
+                Args, batch_index, 0, btk.create_blend_generator.OBS_STREAM)
+            batch_index += 1
+            yield obs_grid.sample(Args.batch_size)
+    varies_per_batch = getattr(obs_function, 'varies_per_batch', False)
+    default_generator = None
     while True:
+        if not obs_function and default_generator is not None:
+            yield list(default_generator)
+            continue
         observing_generator = []
+        if obs_function:
+            btk.create_blend_generator.set_random_state(
+                Args, batch_index, 0, btk.create_blend_generator.OBS_STREAM)
+        batch_index += 1
         for band in Args.bands:
             if obs_function:
                 survey = obs_function(Args, band)
@@ -39,18 +341,11 @@ def generate(Args, obs_function=None):
                 survey = default_obs_conditions(Args, band)
                 if Args.verbose:
                     print("Default observing conditions selected")
-            survey['image_width'] = Args.stamp_size / survey['pixel_scale']
-            survey['image_height'] = Args.stamp_size / survey['pixel_scale']
-            descwl_survey = descwl.survey.Survey(no_analysis=True,
-                                                 survey_name=Args.survey_name,
-                                                 filter_band=band, **survey)
-            if descwl_survey.pixel_scale != Args.pixel_scale:
-                raise ValueError("observing condition pixel scale does not \
-                    match input pixel scale: {0} == {1}".format(
-                        descwl_survey.pixel_scale, Args.pixel_scale))
-            if descwl_survey.filter_band != band:
-                raise ValueError("observing condition band does not \
-                    match input band: {0} == {1}".format(
-                        descwl_survey.filter_band, band))
+            if varies_per_batch:
+                descwl_survey = make_survey(Args, band, survey)
+            else:
+                descwl_survey = get_survey(Args, band, survey)
             observing_generator.append(descwl_survey)
-        yield observing_generator
+        if not obs_function:
+            default_generator = observing_generator
+        yield list(observing_generator)
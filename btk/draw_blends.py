@@ -1,10 +1,20 @@
 import descwl
 import copy
+import collections
 import galsim
 import numpy as np
 import multiprocessing as mp
 from astropy.table import Column
-from itertools import chain, starmap
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+from multiprocessing.util import Finalize
+from itertools import chain
+import btk.get_input_catalog
+import btk.blend_batch
+import btk.create_blend_generator
+import btk.create_observing_generator
 
 
 def get_center_in_pixels(Args, blend_catalog):
@@ -36,8 +46,10 @@ def get_size(Args, catalog, i_obs_cond):
 
     Galaxy size is estimated as second moments size (r_sec) computed as
     described in A1 of Chang et.al 2012. The PSF second moment size, psf_r_sec,
-    is computed by galsim from the psf model in obs_cond in the i band.
+    is computed by galsim from the psf model in obs_cond in the i band, once
+    for each PSF (see `btk.create_observing_generator.get_psf_artifacts`).
     The object size is the defined as sqrt(r_sec**2 + 2*psf_r_sec**2).
+    If the catalog has a precomputed 'btk_r_sec' column, it is used as r_sec.
 
     Args:
         Args: Class containing input parameters.
@@ -48,148 +60,768 @@ def get_size(Args, catalog, i_obs_cond):
     Returns:
         `astropy.table.Column`s: size of the galaxy.
     """
-    f = catalog['fluxnorm_bulge']/(catalog['fluxnorm_disk']+catalog['fluxnorm_bulge'])
-    hlr_d = np.sqrt(catalog['a_d']*catalog['b_d'])
-    hlr_b = np.sqrt(catalog['a_b']*catalog['b_b'])
-    r_sec = np.hypot(hlr_d*(1-f)**0.5*4.66,
-                     hlr_b*f**0.5*1.46)
-    psf = i_obs_cond.psf_model
-    psf_r_sec = psf.calculateMomentRadius()
+    r_sec = btk.get_input_catalog.get_r_sec(catalog)
+    psf_r_sec = btk.create_observing_generator.get_psf_artifacts(
+        i_obs_cond).moment_radius
     size = np.sqrt(r_sec**2 + psf_r_sec**2) / Args.pixel_scale
     return Column(size, name='size')
 
 
-def draw_isolated(Args, galaxy, iso_obs):
-    """Returns `descwl.survey.Survey` class object that includes the rendered
-    object for an isolated galaxy.
+class Stamp_cache(object):
+    """Least recently used cache of images of isolated galaxies rendered by
+    descwl, so galaxies drawn again are not rendered again.
+
+    Images are cached by (galtileid, band, observing conditions key, sub-pixel
+    offset). The observing conditions key is the btk_key attribute of surveys
+    built by `btk.create_observing_generator`; galaxies drawn with other
+    surveys, or without a galtileid (e.g. entries of a
+    `btk.get_input_catalog.Multi_catalog` with galtileid 0), are not cached.
+
+    The pixel center of a cached galaxy (dx, dy) is rounded to
+    1/subpixel_steps of a pixel, so galaxies are drawn up to
+    1/(2 * subpixel_steps) pixels away from their center in each direction.
+    The galaxy is rendered with that sub-pixel offset at the pixel nearest
+    the postage stamp center (see `get_render_center`), and the image is
+    placed at the integer pixel offset between that pixel and the center of
+    the galaxy, whether it was just rendered or drawn from the cache. Images
+    therefore only depend on the key, and not on the galaxies drawn before or
+    on the process they are drawn in, so that runs with and without
+    multiprocessing (where each worker has its own copy of the cache) are
+    the same. Galaxies larger than half the postage stamp are truncated where
+    the image rendered at the center ends.
+
+    Cached images are the smallest boxes containing the non-zero pixels. The
+    least recently used images are removed once their total size exceeds
+    max_bytes.
+
+    Attributes:
+        hits: Number of galaxies drawn from the cache in this process. With
+            multiprocessing, galaxies drawn by the workers are not counted.
+        misses: Number of galaxies rendered by descwl in this process.
+        nbytes: Total size of cached images in bytes.
+    """
+
+    def __init__(self, max_bytes=2**28, subpixel_steps=10):
+        """
+        Args:
+            max_bytes: Maximum total size of cached images in bytes.
+            subpixel_steps: Number of sub-pixel offsets galaxy centers are
+                rounded to in each direction.
+        """
+        self.max_bytes = max_bytes
+        self.subpixel_steps = subpixel_steps
+        self.stamps = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+
+    def get_position(self, entry):
+        """Returns integer pixel center and sub-pixel offset index of the
+        galaxy in each direction."""
+        x, y = [int(np.round(entry[name] * self.subpixel_steps))
+                for name in ['dx', 'dy']]
+        return (x // self.subpixel_steps, y // self.subpixel_steps,
+                x % self.subpixel_steps, y % self.subpixel_steps)
+
+    def get_key(self, entry, band, obs_cond):
+        """Returns key of the galaxy image, or None if it cannot be cached."""
+        obs_key = getattr(obs_cond, 'btk_key', None)
+        if (obs_key is None or 'galtileid' not in entry.dtype.names or
+                entry['galtileid'] == 0):
+            return None
+        return (entry['galtileid'], band, obs_key,
+                self.get_position(entry)[2:])
+
+    def get_render_center(self, Args, entry):
+        """Returns ra and dec (in arcseconds, relative to the postage stamp
+        center) to render the galaxy at before it is cached: the pixel
+        nearest the postage stamp center, plus the sub-pixel offset of the
+        galaxy."""
+        center = (Args.stamp_size / Args.pixel_scale - 1) / 2
+        x0 = int(np.floor(center))
+        x, y = [x0 + step / self.subpixel_steps
+                for step in self.get_position(entry)[2:]]
+        return ((x - center) * Args.pixel_scale,
+                (y - center) * Args.pixel_scale)
+
+    def get(self, key, entry, image):
+        """Places cached image of the galaxy in image and returns slices of
+        the rows and columns it was placed in, or returns None if the image
+        is not in the cache.
+
+        Args:
+            key: Key of the galaxy image returned by `get_key`.
+            entry: Catalog entry of the galaxy.
+            image: Image to place the galaxy image in.
+        """
+        if key not in self.stamps:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.stamps.move_to_end(key)
+        return self.place(self.stamps[key], entry, image)
+
+    def place(self, item, entry, image):
+        """Places image of the galaxy in image and returns slices of the rows
+        and columns it was placed in.
+
+        Args:
+            item: Cached (stamp, row, column) returned by `add`.
+            entry: Catalog entry of the galaxy.
+            image: Image to place the galaxy image in.
+        """
+        stamp, row, col = item
+        x, y = self.get_position(entry)[:2]
+        row, col = row + y, col + x
+        rows = slice(max(row, 0), min(row + stamp.shape[0], image.shape[0]))
+        cols = slice(max(col, 0), min(col + stamp.shape[1], image.shape[1]))
+        if rows.start < rows.stop and cols.start < cols.stop:
+            image[rows, cols] = stamp[rows.start - row:rows.stop - row,
+                                      cols.start - col:cols.stop - col]
+        return rows, cols
+
+    def add(self, key, Args, image, footprint=None):
+        """Adds image of the galaxy rendered at `get_render_center` to the
+        cache, and returns the cached (stamp, row, column), or None if the
+        image is empty.
+
+        Args:
+            key: Key of the galaxy image returned by `get_key`.
+            Args: Class containing input parameters.
+            image: Rendered image of the galaxy.
+            footprint: Slices of rows and columns of image the galaxy was
+                rendered in. If None, the whole image is searched.
+        """
+        if footprint is None:
+            footprint = slice(0, image.shape[0]), slice(0, image.shape[1])
+        rows, = np.where(image[footprint].any(axis=1))
+        cols, = np.where(image[footprint].any(axis=0))
+        if len(rows) == 0:
+            return None
+        rows += footprint[0].start
+        cols += footprint[1].start
+        stamp = image[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].copy()
+        x0 = int(np.floor((Args.stamp_size / Args.pixel_scale - 1) / 2))
+        item = (stamp, rows[0] - x0, cols[0] - x0)
+        self.stamps[key] = item
+        self.nbytes += stamp.nbytes
+        while self.nbytes > self.max_bytes:
+            old_stamp = self.stamps.popitem(last=False)[1][0]
+            self.nbytes -= old_stamp.nbytes
+        return item
+
+
+class Footprint_image(galsim.Image):
+    """`galsim.Image` that records the bounds of the sub-images set in it.
+
+    descwl adds each rendered galaxy to the survey image over the bounds of
+    its truncated stamp, so the bounds recorded while a galaxy is rendered
+    contain all of its pixels.
+
+    Attributes:
+        btk_bounds: `galsim.BoundsI` with the union of the bounds set since
+            it was last reset to None.
+    """
+    btk_bounds = None
+
+    def __setitem__(self, *args):
+        super(Footprint_image, self).__setitem__(*args)
+        if len(args) == 2 and isinstance(args[0], galsim.BoundsI):
+            if self.btk_bounds is None:
+                self.btk_bounds = args[0]
+            else:
+                self.btk_bounds = self.btk_bounds + args[0]
+
+    def get_footprint(self):
+        """Returns slices of rows and columns of the array of the image
+        within btk_bounds, or None if no sub-image was set."""
+        if self.btk_bounds is None or not self.btk_bounds.isDefined():
+            return None
+        bounds = self.btk_bounds & self.bounds
+        if not bounds.isDefined():
+            return None
+        return (slice(bounds.ymin - self.ymin, bounds.ymax - self.ymin + 1),
+                slice(bounds.xmin - self.xmin, bounds.xmax - self.xmin + 1))
+
+
+def get_render_engine(Args, obs_cond, min_snr=None):
+    """Returns `descwl.render.Engine` that renders galaxies with the observing
+    conditions in obs_cond on a scratch image.
+
+    descwl renders galaxies into the image of the survey of the engine. The
+    engine is given a shallow copy of obs_cond with its own image, so that
+    obs_cond is not modified and the engine can be used for all galaxies
+    drawn in a band. The image is a `Footprint_image`, which records where
+    each galaxy is rendered.
 
     Args:
         Args: Class containing input parameters.
-        galaxy: `descwl.model.Galaxy` class that models galaxies.
-        iso_obs: `descwl.survey.Survey` class describing observing conditions.
-            The input galaxy is rendered and stored in here.
+        obs_cond: `descwl.survey.Survey` class describing observing conditions.
+        min_snr: S/N threshold of rendered pixels. If None, Args.min_snr is
+            used.
     """
-    if Args.verbose:
-        print("Draw isolated object")
-    iso_render_engine = descwl.render.Engine(
-        survey=iso_obs,
-        min_snr=Args.min_snr,
+    if min_snr is None:
+        min_snr = Args.min_snr
+    scratch_obs = copy.copy(obs_cond)
+    scratch_obs.image = Footprint_image(obs_cond.image.copy())
+    return descwl.render.Engine(
+        survey=scratch_obs,
+        min_snr=min_snr,
         truncate_radius=30,
         no_margin=False,
         verbose_render=False)
-    iso_render_engine.render_galaxy(
+
+
+def get_footprint(image):
+    """Returns slices of rows and columns of the smallest box that contains
+    the non-zero pixels of image, or None if all pixels are zero."""
+    rows, = np.where(image.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols, = np.where(image[rows[0]:rows[-1] + 1].any(axis=0))
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def draw_isolated(Args, galaxy, render_engine):
+    """Returns `galsim.Image` with the rendered object for an isolated galaxy.
+
+    The image is the scratch image of the render engine, which is overwritten
+    when the next galaxy is drawn. The footprint of the galaxy in the image,
+    the bounds of the truncated stamp descwl rendered it on (see
+    `Footprint_image`), is saved as attribute btk_footprint of the engine, so
+    that only that part of the image needs to be copied, summed, and set back
+    to zero before the next galaxy is drawn.
+
+    Args:
+        Args: Class containing input parameters.
+        galaxy: `descwl.model.Galaxy` class that models galaxies.
+        render_engine: `descwl.render.Engine` returned by `get_render_engine`.
+    """
+    if Args.verbose:
+        print("Draw isolated object")
+    image = render_engine.survey.image
+    footprint = getattr(render_engine, 'btk_footprint', None)
+    if footprint is not None:
+        image.array[footprint] = 0
+    render_engine.btk_footprint = None
+    image.btk_bounds = None
+    render_engine.render_galaxy(
         galaxy, variations_x=None, variations_s=None, variations_g=None,
         no_fisher=True, calculate_bias=False, no_analysis=True)
-    return iso_obs
+    if isinstance(image, Footprint_image) and image.btk_bounds is not None:
+        render_engine.btk_footprint = image.get_footprint()
+    else:
+        render_engine.btk_footprint = get_footprint(image.array)
+    return image
 
 
 def run_single_band(Args, blend_catalog,
-                    obs_cond, band):
+                    obs_cond, band, stamp_cache=None, iso_image=None):
     """Draws image of isolated galaxies along with the blend image in the
     single input band.
 
     The WLDeblending package (descwl) renders galaxies corresponding to the
     blend_catalog entries and with observing conditions determined by
-    obs_cond. The rendered objects are stored in the the observing conditions
-    class. So as to not overwrite images across different blends, we make a
-    copies of the obs_cond while drawing each galaxy. Images of isolated
-    galaxies are drawn with the WLDeblending and them summed to produce the
-    blend image.
-
-    A column 'not_drawn_{band}' is added to blend_catalog initialized as zero.
-    If a galaxy was not drawn by descwl, then this flag is set to 1.
+    obs_cond. The galaxies are rendered one at a time on a scratch image by a
+    single render engine (see `get_render_engine`), so obs_cond is not
+    modified. Images of isolated galaxies are drawn with the WLDeblending and
+    them summed to produce the blend image. Only the footprint of each galaxy
+    is copied and summed.
+
+    The field 'not_drawn_{band}' of blend_catalog is initialized as zero. If a
+    galaxy was not drawn by descwl, then this flag is set to 1.
     Args:
         Args: Class containing input parameters.
-        blend_catalog: Catalog with entries corresponding to one blend.
+        blend_catalog: Structured array with entries corresponding to one
+            blend (see `btk.blend_batch.Blend_batch`).
         obs_cond: `descwl.survey.Survey` class describing observing conditions.
         band(string): Name of band to draw images in.
+        stamp_cache: `Stamp_cache` to draw galaxies rendered before from. If
+            None, all galaxies are rendered.
+        iso_image: Array of zeros [Args.max_number, height, width] the
+            isolated galaxy images are written to. Only the footprint of each
+            galaxy is written. If None, a new array is returned.
 
     Returns:
         Images of blend and isolated galaxies as `numpy.ndarray`.
 
     """
-    blend_catalog.add_column(Column(np.zeros(len(blend_catalog)),
-                             name='not_drawn_' + band))
+    blend_catalog['not_drawn_' + band] = 0
     galaxy_builder = descwl.model.GalaxyBuilder(
         obs_cond, no_disk=False, no_bulge=False,
         no_agn=False, verbose_model=False)
+    render_engine = get_render_engine(Args, obs_cond)
     stamp_size = np.int(Args.stamp_size / Args.pixel_scale)
-    iso_image = np.zeros(
-        (Args.max_number, stamp_size, stamp_size))
+    if iso_image is None:
+        iso_image = np.zeros(
+            (Args.max_number, stamp_size, stamp_size))
     # define temporary galsim image to hold isolated galaxy images that will be summed
     blend_image_temp = galsim.Image(np.zeros((stamp_size, stamp_size)))
     for k, entry in enumerate(blend_catalog):
-        iso_obs = copy.deepcopy(obs_cond)
+        key = None
+        if stamp_cache is not None:
+            key = stamp_cache.get_key(entry, band, obs_cond)
         try:
-            galaxy = galaxy_builder.from_catalog(entry,
-                                                 entry['ra'],
-                                                 entry['dec'],
-                                                 band)
-            iso_render = draw_isolated(Args, galaxy, iso_obs)
-            iso_image[k] = iso_render.image.array
-            blend_image_temp += iso_render.image
+            if key is not None:
+                footprint = stamp_cache.get(key, entry, iso_image[k])
+                if footprint is None:
+                    ra, dec = stamp_cache.get_render_center(Args, entry)
+                    galaxy = galaxy_builder.from_catalog(entry, ra, dec, band)
+                    iso_render = draw_isolated(Args, galaxy, render_engine)
+                    item = stamp_cache.add(
+                        key, Args, iso_render.array,
+                        footprint=render_engine.btk_footprint)
+                    if item is not None:
+                        footprint = stamp_cache.place(item, entry,
+                                                      iso_image[k])
+            else:
+                galaxy = galaxy_builder.from_catalog(entry,
+                                                     entry['ra'],
+                                                     entry['dec'],
+                                                     band)
+                iso_render = draw_isolated(Args, galaxy, render_engine)
+                footprint = render_engine.btk_footprint
+                if footprint is not None:
+                    iso_image[k][footprint] = iso_render.array[footprint]
+            if footprint is not None:
+                blend_image_temp.array[footprint] += iso_image[k][footprint]
         except descwl.render.SourceNotVisible:
             if Args.verbose:
                 print("Source not visible")
             blend_catalog['not_drawn_' + band][k] = 1
             continue
-        if Args.add_noise:
+        if Args.add_noise and not getattr(Args, 'batch_noise', False):
             if Args.verbose:
                 print("Noise added to blend image")
             generator = galsim.random.BaseDeviate(
                 seed=np.random.randint(99999999))
             noise = galsim.PoissonNoise(
                 rng=generator,
-                sky_level=iso_obs.mean_sky_level)
+                sky_level=obs_cond.mean_sky_level)
             blend_image_temp.addNoise(noise)
     blend_image = blend_image_temp.array
     return blend_image, iso_image
 
 
-def run_mini_batch(Args, blend_list, obs_cond):
+def get_band_groups(Args, obs_cond):
+    """Returns list of lists of indices of bands with the same PSF, within
+    Args.psf_tolerance times the PSF peak, and the same pixel scale.
+
+    If Args.psf_tolerance is None, each band is in its own group.
+
+    Args:
+        Args: Class containing input parameters.
+        obs_cond (list): List of `descwl.survey.Survey` class describing
+            observing conditions in different bands.
+    """
+    psf_tolerance = getattr(Args, 'psf_tolerance', None)
+    if psf_tolerance is None:
+        return [[j] for j in range(len(Args.bands))]
+    size = np.int(Args.stamp_size / Args.pixel_scale)
+    psf_stamps = [btk.create_observing_generator.get_psf_artifacts(
+        survey).get_stamp(size) for survey in obs_cond]
+    groups = []
+    for j, psf_stamp in enumerate(psf_stamps):
+        for group in groups:
+            ref = group[0]
+            if (obs_cond[ref].pixel_scale == obs_cond[j].pixel_scale and
+                    np.abs(psf_stamp - psf_stamps[ref]).max() <=
+                    psf_tolerance * psf_stamps[ref].max()):
+                group.append(j)
+                break
+        else:
+            groups.append([j])
+    return groups
+
+
+def run_band_group(Args, blend_catalog, obs_conds, bands, iso_image=None):
+    """Draws image of isolated galaxies along with the blend image in bands
+    with the same PSF.
+
+    Each galaxy is rendered once by descwl in the first band without S/N
+    threshold, and scaled to each band by the ratio of its flux in that band
+    to the flux in the first band. As in descwl, pixels outside the bounding
+    box of pixels above the S/N threshold of the band (Args.min_snr) are set to
+    zero, and galaxies without such pixels are flagged as not drawn. Noise is
+    added to the blend images as in `run_single_band`.
+
+    Args:
+        Args: Class containing input parameters.
+        blend_catalog: Structured array with entries corresponding to one
+            blend (see `btk.blend_batch.Blend_batch`).
+        obs_conds: List of `descwl.survey.Survey` class describing observing
+            conditions in each band.
+        bands: Names of bands to draw images in.
+        iso_image: Array of zeros [Args.max_number, height, width, bands] the
+            isolated galaxy images are written to. Only the footprint of each
+            galaxy is written. If None, a new array is returned.
+
+    Returns:
+        Images of blend [height, width, bands] and isolated galaxies
+        [max_number, height, width, bands] as `numpy.ndarray`.
+    """
+    stamp_size = np.int(Args.stamp_size / Args.pixel_scale)
+    if iso_image is None:
+        iso_image = np.zeros(
+            (Args.max_number, stamp_size, stamp_size, len(bands)))
+    blend_image = np.zeros((stamp_size, stamp_size, len(bands)))
+    for band in bands:
+        blend_catalog['not_drawn_' + band] = 1
+    galaxy_builder = descwl.model.GalaxyBuilder(
+        obs_conds[0], no_disk=False, no_bulge=False,
+        no_agn=False, verbose_model=False)
+    render_engine = get_render_engine(Args, obs_conds[0], min_snr=0)
+    pixel_cut = [Args.min_snr * btk.create_observing_generator.
+                 get_psf_artifacts(survey).sky_rms for survey in obs_conds]
+    # footprint of each drawn galaxy in each band.
+    footprints = {}
+    for k, entry in enumerate(blend_catalog):
+        try:
+            galaxy = galaxy_builder.from_catalog(entry,
+                                                 entry['ra'],
+                                                 entry['dec'],
+                                                 bands[0])
+            image = draw_isolated(Args, galaxy, render_engine).array
+        except descwl.render.SourceNotVisible:
+            continue
+        footprint = render_engine.btk_footprint
+        if footprint is None:
+            continue
+        image = image[footprint]
+        row, col = footprint[0].start, footprint[1].start
+        flux = obs_conds[0].get_flux(entry[bands[0] + '_ab'])
+        for j, band in enumerate(bands):
+            band_image = image * (obs_conds[j].get_flux(entry[band + '_ab']) /
+                                  flux)
+            band_footprint = get_footprint(band_image > pixel_cut[j])
+            if band_footprint is None:
+                continue
+            rows, cols = band_footprint
+            footprints[k, j] = (slice(rows.start + row, rows.stop + row),
+                                slice(cols.start + col, cols.stop + col))
+            iso_image[k][footprints[k, j] + (j,)] = band_image[band_footprint]
+            blend_catalog['not_drawn_' + band][k] = 0
+    for j, band in enumerate(bands):
+        blend_image_temp = galsim.Image(np.zeros((stamp_size, stamp_size)))
+        for k in range(len(blend_catalog)):
+            if blend_catalog['not_drawn_' + band][k]:
+                continue
+            blend_image_temp.array[footprints[k, j]] += iso_image[k][
+                footprints[k, j] + (j,)]
+            if Args.add_noise and not getattr(Args, 'batch_noise', False):
+                generator = galsim.random.BaseDeviate(
+                    seed=np.random.randint(99999999))
+                noise = galsim.PoissonNoise(
+                    rng=generator,
+                    sky_level=obs_conds[j].mean_sky_level)
+                blend_image_temp.addNoise(noise)
+        blend_image[:, :, j] = blend_image_temp.array
+    return blend_image, iso_image
+
+
+def get_batch_fields(Args):
+    """Returns list of (name, dtype) of fields added to the blend catalogs
+    when drawing blends.
+
+    Args:
+        Args: Class containing input parameters.
+    """
+    fields = [('dx', np.float64), ('dy', np.float64), ('size', np.float64)]
+    fields += [('not_drawn_' + band, np.float64) for band in Args.bands]
+    return fields
+
+
+def is_per_blend(obs_cond):
+    """Returns True if obs_cond has a list of observing conditions in each
+    band for each blend (see `btk.create_observing_generator.Obs_grid`)."""
+    return isinstance(obs_cond[0], (list, tuple))
+
+
+def run_mini_batch(Args, blend_list, obs_cond, blend_images=None,
+                   isolated_images=None, stamp_cache=None, batch_index=None,
+                   start=0):
     """Returns isolated and blended images for bend catalogs in blend_list
 
 
     Function loops over blend_list and draws blend and isolated images in each
-    band. Even though blend_list was input to the function, we return it since,
-    the blend catalogs now include additional columns that flag if an object
-    was not drawn and object centers in pixel coordinates.
+    band. Bands with the same PSF are drawn together if Args.psf_tolerance is
+    set (see `run_band_group`). Even though blend_list was input to the
+    function, we return it since, the blend catalogs now include additional
+    columns that flag if an object was not drawn and object centers in pixel
+    coordinates.
+
+    If Args.seed_per_blend is True and batch_index is input, the global numpy
+    random state is set before each blend is drawn from the seed, batch_index
+    and the index of the blend in the batch (see
+    `btk.create_blend_generator.get_random_state`).
 
     Args:
         Args: Class containing input parameters.
-        blend_list: List of catalogs with entries corresponding to one blend.
+        blend_list: `btk.blend_batch.Blend_batch` of blends in the mini-batch,
+            with the fields returned by `get_batch_fields`.
         obs_cond (list): List of `descwl.survey.Survey` class describing
-            observing conditions in differnt bands.
+            observing conditions in differnt bands, or list of them for each
+            blend in blend_list.
+        blend_images: If input, array the blend images of the mini-batch are
+            written to, instead of being returned.
+        isolated_images: If input, array of zeros the isolated galaxy images
+            of the mini-batch are written to, instead of being returned. Only
+            the footprint of each galaxy is written.
+        stamp_cache: `Stamp_cache` to draw galaxies rendered before from.
+        batch_index (int): Index of the batch of the mini-batch.
+        start (int): Index in the batch of the first blend of the mini-batch.
 
     Returns:
         `numpy.ndarray` of blend images and isolated galaxy images, along with
-        list of blend catalogs.
+        the catalog of each blend. Images are None if written to the input
+        arrays.
     """
     mini_batch_outputs = []
+    per_blend = is_per_blend(obs_cond)
+    dx, dy = get_center_in_pixels(Args, blend_list.data)
+    blend_list.data['dx'] = dx
+    blend_list.data['dy'] = dy
+    if per_blend:
+        for i in range(len(blend_list)):
+            blend_list[i]['size'] = get_size(Args, blend_list[i],
+                                             obs_cond[i][3])
+    else:
+        blend_list.data['size'] = get_size(Args, blend_list.data,
+                                           obs_cond[3])
+    stamp_size = np.int(Args.stamp_size / Args.pixel_scale)
+    band_groups = None
     for i in range(len(blend_list)):
-        dx, dy = get_center_in_pixels(Args, blend_list[i])
-        blend_list[i].add_column(dx)
-        blend_list[i].add_column(dy)
-        size = get_size(Args, blend_list[i], obs_cond[3])
-        blend_list[i].add_column(size)
-        stamp_size = np.int(Args.stamp_size / Args.pixel_scale)
-        iso_image_multi = np.zeros(
-            (Args.max_number, stamp_size, stamp_size,
-             len(Args.bands)))
-        blend_image_multi = np.zeros(
-                    (stamp_size, stamp_size, len(Args.bands)))
-        for j in range(len(Args.bands)):
-            single_band_output = run_single_band(Args, blend_list[i],
-                                                 obs_cond[j], Args.bands[j])
+        blend_catalog = blend_list[i]
+        if isolated_images is not None:
+            iso_image_multi = isolated_images[i]
+        else:
+            iso_image_multi = np.zeros(
+                (Args.max_number, stamp_size, stamp_size,
+                 len(Args.bands)))
+        if blend_images is not None:
+            blend_image_multi = blend_images[i]
+        else:
+            blend_image_multi = np.zeros(
+                        (stamp_size, stamp_size, len(Args.bands)))
+        blend_obs_cond = obs_cond[i] if per_blend else obs_cond
+        if batch_index is not None:
+            btk.create_blend_generator.set_random_state(
+                Args, batch_index, start + i,
+                btk.create_blend_generator.DRAW_STREAM)
+        if per_blend or band_groups is None:
+            band_groups = get_band_groups(Args, blend_obs_cond)
+        for group in band_groups:
+            if len(group) > 1:
+                group_output = run_band_group(
+                    Args, blend_catalog, [blend_obs_cond[j] for j in group],
+                    [Args.bands[j] for j in group])
+                blend_image_multi[:, :, group] = group_output[0]
+                iso_image_multi[:, :, :, group] = group_output[1]
+                continue
+            j = group[0]
+            # isolated images are written in place, within their footprint.
+            single_band_output = run_single_band(
+                Args, blend_catalog, blend_obs_cond[j], Args.bands[j],
+                stamp_cache=stamp_cache,
+                iso_image=iso_image_multi[:, :, :, j])
             blend_image_multi[:, :, j] = single_band_output[0]
-            iso_image_multi[:, :, :, j] = single_band_output[1]
+        if blend_images is not None:
+            blend_image_multi = None
+        if isolated_images is not None:
+            iso_image_multi = None
         mini_batch_outputs.append([blend_image_multi, iso_image_multi,
-                                   blend_list[i]])
+                                   blend_catalog])
     return mini_batch_outputs
 
 
+def get_sky_level(obs_cond):
+    """Returns array of the mean sky level per pixel in each band, with shape
+    [bands], or [number of blends, 1, 1, bands] if obs_cond has observing
+    conditions for each blend, so that it broadcasts with the blend images.
+
+    Args:
+        obs_cond (list): List of `descwl.survey.Survey` class describing
+            observing conditions in different bands, or list of them for each
+            blend.
+    """
+    if is_per_blend(obs_cond):
+        return np.array([[survey.mean_sky_level for survey in blend_obs_cond]
+                         for blend_obs_cond in obs_cond])[:, None, None, :]
+    return np.array([survey.mean_sky_level for survey in obs_cond])
+
+
+def add_noise(blend_images, sky_level, rng=None, realizations=None):
+    """Returns blend images with Poisson noise of the galaxies and the sky
+    background, drawn with a single call for all pixels of all bands.
+
+    As with `galsim.PoissonNoise`, each pixel is drawn from a Poisson
+    distribution with mean of the pixel value plus the sky level, and the sky
+    level is then subtracted.
+
+    Args:
+        blend_images: Array of noiseless blend images [number of blends,
+            height, width, bands].
+        sky_level: Mean sky level per pixel, that broadcasts with blend_images
+            (see `get_sky_level`).
+        rng: `numpy.random.Generator` (or `numpy.random.RandomState`) to draw
+            noise with. If None, the global numpy random state is used.
+        realizations (int): If not None, number of independent noise
+            realizations to draw, stacked along a new first axis.
+
+    Returns:
+        `numpy.ndarray` of noisy blend images.
+    """
+    if rng is None:
+        rng = np.random
+    mean = np.clip(blend_images + sky_level, 0, None)
+    if realizations is not None:
+        mean = np.broadcast_to(mean, (realizations,) + mean.shape)
+    return rng.poisson(mean) - sky_level
+
+
+def add_batch_noise(Args, blend_images, obs_cond, rng=None,
+                    batch_index=None):
+    """Returns blend images of a batch with noise added by `add_noise`.
+
+    If Args.seed_per_blend is True and batch_index is input, the noise of
+    each blend is drawn from its own `numpy.random.Generator`, seeded from
+    the seed, batch_index and the index of the blend (see
+    `btk.create_blend_generator.get_seed_sequence`). Otherwise the noise of
+    the batch is drawn with rng in a single call.
+
+    Args:
+        Args: Class containing input parameters.
+        blend_images: Array of noiseless blend images of the batch.
+        obs_cond (list): Observing conditions of the batch.
+        rng: `numpy.random.Generator` to draw noise with. If None, the global
+            numpy random state is used.
+        batch_index (int): Index of the batch.
+    """
+    sky_level = get_sky_level(obs_cond)
+    if batch_index is None or not getattr(Args, 'seed_per_blend', False):
+        return add_noise(blend_images, sky_level, rng)
+    noisy_images = np.empty(blend_images.shape)
+    for i in range(len(blend_images)):
+        seed_sequence = btk.create_blend_generator.get_seed_sequence(
+            Args, batch_index, i, btk.create_blend_generator.NOISE_STREAM)
+        noisy_images[i] = add_noise(
+            blend_images[i], sky_level[i] if sky_level.ndim > 1 else
+            sky_level, np.random.default_rng(seed_sequence))
+    return noisy_images
+
+
+# Input parameters and observing conditions of a pool worker process of
+# `generate`, set by `init_worker`.
+WORKER_STATE = {}
+
+
+def get_image_shapes(Args):
+    """Returns shapes of the arrays of blend images and isolated galaxy
+    images of a batch."""
+    stamp_size = np.int(Args.stamp_size / Args.pixel_scale)
+    return ((Args.batch_size, stamp_size, stamp_size, len(Args.bands)),
+            (Args.batch_size, Args.max_number, stamp_size, stamp_size,
+             len(Args.bands)))
+
+
+def create_shared_images(Args):
+    """Returns `multiprocessing.shared_memory.SharedMemory` blocks large
+    enough for the blend images and isolated galaxy images of a batch, or None
+    if shared memory is not available (python < 3.8)."""
+    if shared_memory is None:
+        return None
+    return [shared_memory.SharedMemory(
+        create=True, size=int(np.prod(shape)) * np.dtype(np.float64).itemsize)
+        for shape in get_image_shapes(Args)]
+
+
+def get_shared_images(Args, shared_images):
+    """Returns arrays of blend images and isolated galaxy images of a batch
+    stored in the shared memory blocks."""
+    return [np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+            for shape, block in zip(get_image_shapes(Args), shared_images)]
+
+
+def close_worker_shared_images():
+    """Closes the shared memory blocks attached by a pool worker when it
+    exits. The blocks are unlinked by the main process."""
+    WORKER_STATE['images'] = None
+    for block in WORKER_STATE.pop('shared_images', []):
+        block.close()
+
+
+def init_worker(Args, obs_cond, shared_image_names=None, stamp_cache=None):
+    """Stores the input parameters and observing conditions in a pool worker
+    process, so that they are not sent with each mini-batch.
+
+    Args:
+        Args: Class containing input parameters.
+        obs_cond (list): List of `descwl.survey.Survey` class describing
+            observing conditions in different bands.
+        shared_image_names: Names of the shared memory blocks images are
+            written to (see `create_shared_images`). If None, images are
+            returned to the main process.
+        stamp_cache: `Stamp_cache` of the worker.
+    """
+    WORKER_STATE['Args'] = Args
+    WORKER_STATE['obs_cond'] = obs_cond
+    WORKER_STATE['stamp_cache'] = stamp_cache
+    WORKER_STATE['images'] = None
+    if shared_image_names is not None:
+        blocks = [shared_memory.SharedMemory(name=name)
+                  for name in shared_image_names]
+        WORKER_STATE['shared_images'] = blocks
+        WORKER_STATE['images'] = get_shared_images(Args, blocks)
+        Finalize(None, close_worker_shared_images, exitpriority=10)
+
+
+def run_worker_mini_batch(blend_list, obs_cond, seed, start,
+                          batch_index=None):
+    """Runs `run_mini_batch` in a pool worker process.
+
+    If the worker has shared memory images, the images are written to them
+    and only the blend catalogs are returned.
+
+    Args:
+        blend_list: `btk.blend_batch.Blend_batch` of blends in the mini-batch.
+        obs_cond (list): Observing conditions of the mini-batch. If None,
+            those stored by `init_worker` are used.
+        seed: Seed of the global numpy random state to draw with, drawn for
+            each mini-batch in the main process, or None if no random numbers
+            are drawn.
+        start: Index in the batch of the first blend of the mini-batch.
+        batch_index: Index of the batch of the mini-batch.
+    """
+    if obs_cond is None:
+        obs_cond = WORKER_STATE['obs_cond']
+    if seed is not None:
+        np.random.seed(seed)
+    images = WORKER_STATE['images']
+    stamp_cache = WORKER_STATE['stamp_cache']
+    if images is None:
+        return run_mini_batch(WORKER_STATE['Args'], blend_list, obs_cond,
+                              stamp_cache=stamp_cache,
+                              batch_index=batch_index, start=start)
+    stop = start + len(blend_list)
+    # the shared images are reused for each batch.
+    images[1][start:stop] = 0
+    return run_mini_batch(WORKER_STATE['Args'], blend_list, obs_cond,
+                          blend_images=images[0][start:stop],
+                          isolated_images=images[1][start:stop],
+                          stamp_cache=stamp_cache, batch_index=batch_index,
+                          start=start)
+
+
+def is_same_obs_cond(obs_cond, other_obs_cond):
+    """Returns True if the two lists of observing conditions in each band are
+    the same objects."""
+    if other_obs_cond is None or len(obs_cond) != len(other_obs_cond):
+        return False
+    return all(a is b for a, b in zip(obs_cond, other_obs_cond))
+
+
 def generate(Args, blend_genrator, observing_generator,
-             multiprocessing=False, cpus=1):
+             multiprocessing=False, cpus=1, stamp_cache=None, batch_index=0):
     """Generates images of blended objects, individual isolated objects, for
     each blend in the batch.
 
@@ -199,55 +831,160 @@ def generate(Args, blend_genrator, observing_generator,
     dict with results of entire batch. If multiprocessing is true, then each of
     the mini-batches are run in parallel.
 
+    With multiprocessing, a pool of cpus processes is started at the first
+    batch and used for all batches. Args and the observing conditions are sent
+    to the workers once, when the pool is started, and observing conditions
+    are sent again only if they change. The pool is shut down when the
+    generator is closed. If noise is added to each blend as it is drawn, the
+    workers draw each mini-batch with the global numpy random state seeded
+    with a seed drawn for that mini-batch in the main process, so that the
+    noise of each mini-batch and batch is different and depends only on the
+    random state of the main process. Workers write images to shared
+    memory buffers allocated with the pool (python >= 3.8), so only blend
+    catalogs are sent back to the main process.
+
+    If Args.batch_noise is True, blends are drawn without noise, and if
+    Args.add_noise is True, noise is added to the whole batch with
+    `add_noise`, drawn from a `numpy.random.Generator` seeded with Args.seed.
+    The noiseless images are output as 'blend_images_noiseless'.
+
+    If Args.seed_per_blend is True, each blend is drawn with random numbers
+    derived from the seed, the index of the batch and the index of the blend
+    only (see `btk.create_blend_generator.get_random_state`), so that images
+    are the same whatever multiprocessing and cpus are, and whichever batches
+    are drawn before. The blend and observing generators must have been
+    created with the same batch_index.
+
     Args:
         Args: Class containing parameters to create blends
         blend_genrator: Generator to create blended object
         observing_genrator: Creates observing conditions for each entry in
-            batch.
+            batch. It yields either one list of observing conditions in each
+            band for the batch or one such list for each blend.
         multiprocessing: Divides batch of blends to draw into mini-batches and
-            runs each on different core
+            runs each on different core. The worker pool is forked when the
+            first batch is drawn, before a
+            `btk.get_input_catalog.Catalog_reservoir` starts drawing samples
+            in a background thread.
         cpus: If multiprocessing, then number of parallel processes to run.
+        stamp_cache: `Stamp_cache` to reuse images of galaxies drawn before.
+            With multiprocessing, each worker has its own copy of the cache,
+            which draws the same images, and its hits and misses are not
+            counted in stamp_cache.
+        batch_index (int): Index of the first batch to draw.
 
     Yields:
         Dictionary with blend images, isolated object images, blend catalog,
-        and observing conditions.
+        and observing conditions. The blend catalogs are given as a list of
+        astropy tables ('blend_list') and as a `btk.blend_batch.Blend_batch`
+        ('blend_batch').
 
     To do:
         Add data augmentation.
     """
-    while True:
-        batch_blend_cat, batch_obs_cond = [], []
-        stamp_size = np.int(Args.stamp_size / Args.pixel_scale)
-        blend_images = np.zeros((Args.batch_size, stamp_size, stamp_size,
-                                 len(Args.bands)))
-        isolated_images = np.zeros((Args.batch_size, Args.max_number,
-                                    stamp_size, stamp_size, len(Args.bands)))
-        in_batch_blend_cat = next(blend_genrator)
-        obs_cond = next(observing_generator)
-        mini_batch_size = Args.batch_size//cpus
-        in_args = [(Args, in_batch_blend_cat[i:i+mini_batch_size],
-                    copy.deepcopy(obs_cond)) for i in range(
-                        0, Args.batch_size, mini_batch_size)]
-        if multiprocessing:
-            if Args.verbose:
-                print("Running mini-batch of size {0} \
-                    with multiprocessing with pool {1}".format(
-                        len(in_args), cpus))
-            with mp.Pool(processes=cpus) as pool:
-                mini_batch_results = pool.starmap(run_mini_batch, in_args)
-        else:
-            if Args.verbose:
-                print("Running mini-batch of size {0} \
-                    serial {1} times".format(len(in_args), cpus))
-            mini_batch_results = list(starmap(run_mini_batch, in_args))
-        batch_results = list(chain(*mini_batch_results))
-        for i in range(Args.batch_size):
-            blend_images[i] = batch_results[i][0]
-            isolated_images[i] = batch_results[i][1]
-            batch_blend_cat.append(batch_results[i][2])
-            batch_obs_cond.append(obs_cond)
-        output = {'blend_images': blend_images,
-                  'isolated_images': isolated_images,
-                  'blend_list': batch_blend_cat,
-                  'obs_condition': batch_obs_cond}
-        yield output
+    pool, pool_obs_cond, shared_images = None, None, None
+    noise_rng = None
+    if Args.add_noise and getattr(Args, 'batch_noise', False):
+        noise_rng = np.random.default_rng(Args.seed)
+    try:
+        while True:
+            batch_obs_cond = []
+            stamp_size = np.int(Args.stamp_size / Args.pixel_scale)
+            blend_images = np.zeros((Args.batch_size, stamp_size, stamp_size,
+                                     len(Args.bands)))
+            isolated_images = np.zeros((Args.batch_size, Args.max_number,
+                                        stamp_size, stamp_size,
+                                        len(Args.bands)))
+            in_batch_blend_cat = next(blend_genrator)
+            blend_batch = btk.blend_batch.Blend_batch.from_tables(
+                in_batch_blend_cat, fields=get_batch_fields(Args))
+            obs_cond = next(observing_generator)
+            per_blend = is_per_blend(obs_cond)
+            mini_batch_size = Args.batch_size//cpus
+            in_args = [(Args, blend_batch.get_blends(i, i+mini_batch_size),
+                        obs_cond[i:i+mini_batch_size] if per_blend
+                        else obs_cond) for i in range(
+                            0, Args.batch_size, mini_batch_size)]
+            if multiprocessing:
+                if Args.verbose:
+                    print("Running mini-batch of size {0} \
+                        with multiprocessing with pool {1}".format(
+                            len(in_args), cpus))
+                if pool is None:
+                    pool_obs_cond = None if per_blend else obs_cond
+                    shared_images = create_shared_images(Args)
+                    shared_image_names = None
+                    if shared_images is not None:
+                        shared_image_names = [block.name for block
+                                              in shared_images]
+                    pool = mp.Pool(processes=cpus, initializer=init_worker,
+                                   initargs=(Args, pool_obs_cond,
+                                             shared_image_names,
+                                             stamp_cache))
+                # observing conditions already sent to the workers are not
+                # sent again.
+                if not per_blend and is_same_obs_cond(obs_cond,
+                                                      pool_obs_cond):
+                    in_args = [(blend_list, None) for _, blend_list, _
+                               in in_args]
+                else:
+                    in_args = [(blend_list, mini_batch_obs_cond) for
+                               _, blend_list, mini_batch_obs_cond in in_args]
+                # random numbers are only drawn by workers for the noise of
+                # each blend, and drawing the seeds advances the random state
+                # of the main process for the next batch.
+                seeds = [None] * len(in_args)
+                if (Args.add_noise and not getattr(Args, 'batch_noise', False)
+                        and not getattr(Args, 'seed_per_blend', False)):
+                    seeds = [int(seed) for seed in np.random.randint(
+                        2**32, size=len(in_args), dtype=np.uint64)]
+                mini_batch_results = pool.starmap(
+                    run_worker_mini_batch,
+                    [args + (seeds[i], i * mini_batch_size, batch_index)
+                     for i, args in enumerate(in_args)])
+                if shared_images is not None:
+                    # copy so that images are not overwritten by next batch.
+                    blend_images[:], isolated_images[:] = get_shared_images(
+                        Args, shared_images)
+            else:
+                if Args.verbose:
+                    print("Running mini-batch of size {0} \
+                        serial {1} times".format(len(in_args), cpus))
+                # images are written in place to the arrays of the batch.
+                mini_batches = [slice(i * mini_batch_size,
+                                      (i + 1) * mini_batch_size)
+                                for i in range(len(in_args))]
+                mini_batch_results = [
+                    run_mini_batch(*args, blend_images=blend_images[rows],
+                                   isolated_images=isolated_images[rows],
+                                   stamp_cache=stamp_cache,
+                                   batch_index=batch_index,
+                                   start=rows.start)
+                    for args, rows in zip(in_args, mini_batches)]
+            batch_results = list(chain(*mini_batch_results))
+            for i in range(Args.batch_size):
+                if batch_results[i][0] is not None:
+                    blend_images[i] = batch_results[i][0]
+                    isolated_images[i] = batch_results[i][1]
+                # catalogs are copies if drawn in a different process.
+                blend_batch[i][:] = batch_results[i][2]
+                batch_obs_cond.append(obs_cond[i] if per_blend else obs_cond)
+            output = {'blend_images': blend_images,
+                      'isolated_images': isolated_images,
+                      'blend_list': blend_batch.to_tables(),
+                      'blend_batch': blend_batch,
+                      'obs_condition': batch_obs_cond}
+            if noise_rng is not None:
+                output['blend_images_noiseless'] = blend_images
+                output['blend_images'] = add_batch_noise(
+                    Args, blend_images, obs_cond, noise_rng, batch_index)
+            batch_index += 1
+            yield output
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if shared_images is not None:
+            for block in shared_images:
+                block.close()
+                block.unlink()
@@ -0,0 +1,292 @@
+import os
+import json
+import shutil
+import descwl
+import numpy as np
+import btk.blend_batch
+import btk.draw_blends
+import btk.get_input_catalog
+
+
+def get_obs_keys(obs_cond):
+    """Returns list with the string of the btk_key of the observing conditions
+    in each band, or None for surveys without a key."""
+    keys = []
+    for survey in obs_cond:
+        key = getattr(survey, 'btk_key', None)
+        keys.append(None if key is None else repr(key))
+    return keys
+
+
+def build_library(Args, catalog, obs_cond, path):
+    """Renders each galaxy of the catalog once in each band at the center of
+    the postage stamp, and saves the images in a library at path.
+
+    The library directory contains:
+        stamps.npy: float32 array [number of galaxies, height, width, bands]
+            of galaxy images, written as a memory-mapped file.
+        galtileid.npy: galtileid of each galaxy.
+        not_drawn.npy: boolean array [number of galaxies, bands], True if the
+            galaxy was not drawn by descwl in the band.
+        library.json: parameters the library was rendered with.
+    The library is built in a temporary directory that replaces the directory
+    at path once the library is complete, so that an interrupted build does
+    not leave a partial library at path.
+
+    Args:
+        Args: Class containing input parameters.
+        catalog: CatSim-like catalog of galaxies to render. It must have all
+            the galaxies blends are sampled from, so a
+            `btk.get_input_catalog.Catalog_reservoir` (whose sample is
+            replaced) or a `btk.get_input_catalog.Multi_catalog` are not
+            accepted.
+        obs_cond (list): List of `descwl.survey.Survey` class describing
+            observing conditions in different bands.
+        path: Directory to save the library in.
+
+    Returns:
+        `Galaxy_library` saved at path.
+    """
+    if isinstance(catalog, (btk.get_input_catalog.Catalog_reservoir,
+                            btk.get_input_catalog.Multi_catalog)):
+        raise ValueError("Galaxy library must be built from a catalog "
+                         "table, not a {0}".format(type(catalog).__name__))
+    final_path, path = path, path.rstrip(os.sep) + '.tmp'
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    stamp_size = np.int(Args.stamp_size / Args.pixel_scale)
+    stamps = np.lib.format.open_memmap(
+        os.path.join(path, 'stamps.npy'), mode='w+', dtype=np.float32,
+        shape=(len(catalog), stamp_size, stamp_size, len(Args.bands)))
+    not_drawn = np.zeros((len(catalog), len(Args.bands)), dtype=bool)
+    for j, band in enumerate(Args.bands):
+        if Args.verbose:
+            print(f"Rendering galaxy library in {band} band")
+        galaxy_builder = descwl.model.GalaxyBuilder(
+            obs_cond[j], no_disk=False, no_bulge=False,
+            no_agn=False, verbose_model=False)
+        render_engine = btk.draw_blends.get_render_engine(Args, obs_cond[j])
+        for i, entry in enumerate(catalog):
+            try:
+                galaxy = galaxy_builder.from_catalog(entry, 0., 0., band)
+                stamps[i, :, :, j] = btk.draw_blends.draw_isolated(
+                    Args, galaxy, render_engine).array
+            except descwl.render.SourceNotVisible:
+                not_drawn[i, j] = True
+    stamps.flush()
+    del stamps
+    np.save(os.path.join(path, 'galtileid.npy'),
+            np.asarray(catalog['galtileid']))
+    np.save(os.path.join(path, 'not_drawn.npy'), not_drawn)
+    metadata = {'catalog_name': str(Args.catalog_name),
+                'survey_name': Args.survey_name,
+                'bands': list(Args.bands),
+                'stamp_size': Args.stamp_size,
+                'pixel_scale': Args.pixel_scale,
+                'center': (stamp_size - 1) / 2.,
+                'obs_keys': get_obs_keys(obs_cond)}
+    with open(os.path.join(path, 'library.json'), 'w') as f:
+        json.dump(metadata, f, indent=1)
+    if os.path.isdir(final_path):
+        shutil.rmtree(final_path)
+    os.replace(path, final_path)
+    return Galaxy_library(final_path)
+
+
+def is_library(path):
+    """Returns True if path is the directory of a complete galaxy library
+    built by `build_library`."""
+    return os.path.isfile(os.path.join(path, 'library.json'))
+
+
+def shift_images(images, shift_x, shift_y, pad=0):
+    """Returns images shifted by sub-pixel offsets with a Fourier phase shift.
+
+    The images are zero-padded by pad pixels on each side before the shift,
+    so that flux shifted past the edge of an image is kept in the padding
+    instead of wrapping around to the opposite edge. The padded images are
+    returned.
+
+    Args:
+        images: Array [number of images, height, width, bands].
+        shift_x: Shift of each image along the width in pixels.
+        shift_y: Shift of each image along the height in pixels.
+        pad (int): Number of pixels of zeros added on each side of the images.
+
+    Returns:
+        Array [number of images, height + 2 * pad, width + 2 * pad, bands].
+    """
+    if pad > 0:
+        images = np.pad(images, ((0, 0), (pad, pad), (pad, pad), (0, 0)))
+    height, width = images.shape[1:3]
+    ky = np.fft.fftfreq(height)[np.newaxis, :, np.newaxis]
+    kx = np.fft.rfftfreq(width)[np.newaxis, np.newaxis, :]
+    phase = np.exp(-2j * np.pi * (ky * shift_y[:, np.newaxis, np.newaxis] +
+                                  kx * shift_x[:, np.newaxis, np.newaxis]))
+    fourier_images = np.fft.rfft2(images, axes=(1, 2))
+    fourier_images *= phase[..., np.newaxis]
+    return np.fft.irfft2(fourier_images, s=(height, width), axes=(1, 2))
+
+
+def add_at_offset(image, stamp, row, col):
+    """Adds stamp to image with its first pixel at (row, col), ignoring the
+    part of the stamp outside the image."""
+    rows = slice(max(row, 0), min(row + stamp.shape[0], image.shape[0]))
+    cols = slice(max(col, 0), min(col + stamp.shape[1], image.shape[1]))
+    if rows.start < rows.stop and cols.start < cols.stop:
+        image[rows, cols] += stamp[rows.start - row:rows.stop - row,
+                                   cols.start - col:cols.stop - col]
+
+
+class Galaxy_library(object):
+    """Memory-mapped library of galaxy images built by `build_library`, from
+    which blends are assembled without rendering galaxies.
+
+    Attributes:
+        path: Directory of the library.
+        metadata: dict of parameters the library was rendered with.
+        stamps: Memory-mapped array of galaxy images.
+        galtileid: galtileid of each galaxy in stamps.
+        not_drawn: Flags of galaxies not drawn in each band.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'library.json')) as f:
+            self.metadata = json.load(f)
+        self.stamps = np.load(os.path.join(path, 'stamps.npy'), mmap_mode='r')
+        self.galtileid = np.load(os.path.join(path, 'galtileid.npy'))
+        self.not_drawn = np.load(os.path.join(path, 'not_drawn.npy'))
+        self._order = np.argsort(self.galtileid, kind='stable')
+        self._sorted_id = self.galtileid[self._order]
+
+    def get_rows(self, galtileid):
+        """Returns index in the library of each input galtileid.
+
+        Raises KeyError if a galaxy is not in the library.
+        """
+        galtileid = np.asarray(galtileid)
+        index = np.searchsorted(self._sorted_id, galtileid)
+        index = np.minimum(index, len(self._sorted_id) - 1)
+        missing = self._sorted_id[index] != galtileid
+        if np.any(missing):
+            raise KeyError("Galaxies not in library {0}: {1}".format(
+                self.path, galtileid[missing]))
+        return self._order[index]
+
+    def check_parameters(self, Args, obs_cond):
+        """Raises ValueError if the library was rendered with different
+        parameters or observing conditions than those input."""
+        if self.metadata['catalog_name'] != str(Args.catalog_name):
+            raise ValueError("library catalog_name does not match input "
+                             "catalog_name: {0} == {1}".format(
+                                 self.metadata['catalog_name'],
+                                 Args.catalog_name))
+        for name in ['survey_name', 'stamp_size', 'pixel_scale']:
+            if self.metadata[name] != getattr(Args, name):
+                raise ValueError("library {0} does not match input {0}: "
+                                 "{1} == {2}".format(name, self.metadata[name],
+                                                     getattr(Args, name)))
+        if self.metadata['bands'] != list(Args.bands):
+            raise ValueError("library bands do not match input bands: "
+                             "{0} == {1}".format(self.metadata['bands'],
+                                                 Args.bands))
+        for key, obs_key in zip(self.metadata['obs_keys'],
+                                get_obs_keys(obs_cond)):
+            if key is not None and obs_key is not None and key != obs_key:
+                raise ValueError("library observing conditions do not match "
+                                 "input observing conditions")
+
+    def assemble(self, Args, blend_batch, obs_cond, batch_index=None):
+        """Returns blend and isolated galaxy images of the blends in the batch
+        assembled from the library images.
+
+        Each galaxy image is shifted from the stamp center to the galaxy
+        center by a sub-pixel Fourier shift followed by an integer pixel
+        offset. Library images are zero-padded by a quarter of the stamp on
+        each side before the Fourier shift (see `shift_images`), and the
+        padded images are cropped to the postage stamp when they are placed
+        in it. Blend images are the sum of the isolated images, with Poisson
+        noise of the galaxy and sky background added if Args.add_noise. The
+        fields of the blend catalogs added when drawing blends (see
+        `btk.draw_blends.get_batch_fields`) are set.
+
+        Args:
+            Args: Class containing input parameters.
+            blend_batch: `btk.blend_batch.Blend_batch` of blends to assemble.
+            obs_cond (list): List of `descwl.survey.Survey` class describing
+                observing conditions in different bands.
+            batch_index (int): Index of the batch, to draw noise of each blend
+                from its own seed if Args.seed_per_blend is True (see
+                `btk.draw_blends.add_batch_noise`).
+
+        Returns:
+            `numpy.ndarray` of blend images and isolated galaxy images.
+        """
+        data = blend_batch.data
+        dx, dy = btk.draw_blends.get_center_in_pixels(Args, data)
+        data['dx'], data['dy'] = dx, dy
+        data['size'] = btk.draw_blends.get_size(Args, data, obs_cond[3])
+        rows = self.get_rows(data['galtileid'])
+        for j, band in enumerate(Args.bands):
+            data['not_drawn_' + band] = self.not_drawn[rows, j]
+        shift_x = np.asarray(dx) - self.metadata['center']
+        shift_y = np.asarray(dy) - self.metadata['center']
+        offset_x = np.floor(shift_x).astype(int)
+        offset_y = np.floor(shift_y).astype(int)
+        stamp_size = self.stamps.shape[1]
+        pad = stamp_size // 4
+        stamps = shift_images(self.stamps[rows].astype(np.float64),
+                              shift_x - offset_x, shift_y - offset_y,
+                              pad=pad)
+        isolated_images = np.zeros((len(blend_batch), Args.max_number,
+                                    stamp_size, stamp_size, len(Args.bands)))
+        blend_index = blend_batch.blend_index
+        object_index = np.arange(len(data)) - blend_batch.offsets[blend_index]
+        for k in range(len(data)):
+            add_at_offset(isolated_images[blend_index[k], object_index[k]],
+                          stamps[k], offset_y[k] - pad, offset_x[k] - pad)
+        blend_images = isolated_images.sum(axis=1)
+        if Args.add_noise:
+            blend_images = btk.draw_blends.add_batch_noise(
+                Args, blend_images, obs_cond, batch_index=batch_index)
+        return blend_images, isolated_images
+
+
+def generate(Args, blend_genrator, observing_generator, library,
+             batch_index=0):
+    """Generates blend images assembled from a galaxy library, with the same
+    output as `btk.draw_blends.generate`.
+
+    Args:
+        Args: Class containing parameters to create blends
+        blend_genrator: Generator to create blended object
+        observing_genrator: Creates observing conditions for each entry in
+            batch. Observing conditions must be the same as those the library
+            was rendered with.
+        library: `Galaxy_library` to assemble blends from.
+        batch_index (int): Index of the first batch to assemble.
+
+    Yields:
+        Dictionary with blend images, isolated object images, blend catalog,
+        and observing conditions.
+    """
+    while True:
+        blend_batch = btk.blend_batch.Blend_batch.from_tables(
+            next(blend_genrator),
+            fields=btk.draw_blends.get_batch_fields(Args))
+        obs_cond = next(observing_generator)
+        if btk.draw_blends.is_per_blend(obs_cond):
+            raise ValueError("Blends assembled from a galaxy library must "
+                             "have the same observing conditions")
+        library.check_parameters(Args, obs_cond)
+        blend_images, isolated_images = library.assemble(
+            Args, blend_batch, obs_cond, batch_index=batch_index)
+        batch_index += 1
+        output = {'blend_images': blend_images,
+                  'isolated_images': isolated_images,
+                  'blend_list': blend_batch.to_tables(),
+                  'blend_batch': blend_batch,
+                  'obs_condition': [obs_cond] * Args.batch_size}
+        yield output
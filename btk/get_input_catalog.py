@@ -1,30 +1,339 @@
 import os
+import copy
+import json
+import hashlib
+import threading
+import numpy as np
+import fitsio
 import astropy.table
 
+# Columns of a CatSim-like catalog used by descwl to model galaxies and by the
+# btk selection and sampling functions, in addition to the magnitudes in each
+# simulated band.
+REQUIRED_COLUMNS = ('galtileid', 'ra', 'dec', 'redshift', 'fluxnorm_bulge',
+                    'fluxnorm_disk', 'fluxnorm_agn', 'a_b', 'a_d', 'b_b',
+                    'b_d', 'pa_bulge', 'pa_disk', 'r_ab', 'i_ab')
 
-def load_catalog(Args, selection_function=None):
+
+def get_required_columns(Args):
+    """Returns names of catalog columns required to simulate blends.
+
+    Args:
+        Args: Class containing input parameters.
+        Args.bands: Filters in which images are simulated. The AB magnitude
+            column of each band is required.
+
+    Returns:
+        list of column names.
+    """
+    columns = list(REQUIRED_COLUMNS)
+    for band in Args.bands:
+        if band + '_ab' not in columns:
+            columns.append(band + '_ab')
+    return columns
+
+
+def check_columns(colnames, columns, catalog_name):
+    """Raises KeyError if any of the input columns is not in colnames.
+
+    Args:
+        colnames: Names of columns in the catalog.
+        columns: Names of columns required to be in the catalog.
+        catalog_name: Name of catalog file, used in the error message.
+    """
+    missing = [name for name in columns if name not in colnames]
+    if missing:
+        raise KeyError(f"Catalog {catalog_name} is missing required columns: "
+                       f"{missing}")
+
+
+def get_bulge_fraction(catalog):
+    """Returns fraction of the bulge flux in the bulge + disk flux of each
+    galaxy in the catalog.
+
+    If the catalog already has a 'btk_bulge_frac' column (see
+    `add_derived_columns`), that column is returned.
+
+    Args:
+        catalog: CatSim-like catalog.
+    """
+    if 'btk_bulge_frac' in catalog.dtype.names:
+        return catalog['btk_bulge_frac']
+    return catalog['fluxnorm_bulge']/(catalog['fluxnorm_disk'] +
+                                      catalog['fluxnorm_bulge'])
+
+
+def get_r_sec(catalog):
+    """Returns second moments size (r_sec) of each galaxy in the catalog.
+
+    r_sec is computed from the half light radius sqrt(a*b) of the disk and
+    bulge as described in A1 of Chang et.al 2012. If the catalog already has a
+    'btk_r_sec' column (see `add_derived_columns`), that column is returned.
+
+    Args:
+        catalog: CatSim-like catalog.
+    """
+    if 'btk_r_sec' in catalog.dtype.names:
+        return catalog['btk_r_sec']
+    f = get_bulge_fraction(catalog)
+    hlr_d = np.sqrt(catalog['a_d']*catalog['b_d'])
+    hlr_b = np.sqrt(catalog['a_b']*catalog['b_b'])
+    return np.hypot(hlr_d*(1-f)**0.5*4.66, hlr_b*f**0.5*1.46)
+
+
+def get_r_sec_major(catalog):
+    """Returns second moments size of each galaxy in the catalog computed
+    with the semi-major axis of the disk and bulge instead of the half light
+    radius.
+
+    If the catalog already has a 'btk_r_sec_major' column (see
+    `add_derived_columns`), that column is returned.
+
+    Args:
+        catalog: CatSim-like catalog.
+    """
+    if 'btk_r_sec_major' in catalog.dtype.names:
+        return catalog['btk_r_sec_major']
+    f = get_bulge_fraction(catalog)
+    return np.hypot(catalog['a_d']*(1-f)**0.5*4.66,
+                    catalog['a_b']*f**0.5*1.46)
+
+
+def get_major_axis(catalog):
+    """Returns quadrature sum of the disk and bulge semi-major axis of each
+    galaxy in the catalog.
+
+    If the catalog already has a 'btk_major_axis' column (see
+    `add_derived_columns`), that column is returned.
+
+    Args:
+        catalog: CatSim-like catalog.
+    """
+    if 'btk_major_axis' in catalog.dtype.names:
+        return catalog['btk_major_axis']
+    return np.hypot(catalog['a_d'], catalog['a_b'])
+
+
+# Derived columns added by add_derived_columns and the functions computing
+# them, in the order they are computed.
+DERIVED_COLUMNS = (('btk_bulge_frac', get_bulge_fraction),
+                   ('btk_r_sec', get_r_sec),
+                   ('btk_r_sec_major', get_r_sec_major),
+                   ('btk_major_axis', get_major_axis))
+
+
+def add_derived_columns(catalog):
+    """Adds columns with quantities derived from the catalog parameters that
+    are used by the selection, sampling and drawing functions.
+
+    The derived quantities are computed once for the full catalog, so that
+    they are not recomputed for each blend. Columns already present in the
+    catalog are not recomputed.
+
+    Args:
+        catalog: CatSim-like catalog. Columns 'btk_bulge_frac', 'btk_r_sec',
+            'btk_r_sec_major' and 'btk_major_axis' are added to it.
+    """
+    for name, get_column in DERIVED_COLUMNS:
+        if name not in catalog.colnames:
+            catalog[name] = np.asarray(get_column(catalog))
+
+
+def get_cache_path(catalog_name, cache_dir):
+    """Returns directory where the column store of the input catalog is cached.
+
+    The directory name is keyed by the absolute path, size and modification
+    time of the catalog file, so that a modified catalog is never read from a
+    stale cache.
+
+    Args:
+        catalog_name: Name of CatSim-like catalog file.
+        cache_dir: Directory under which catalog caches are stored.
+
+    Returns:
+        string with the path to the column store of the catalog.
+    """
+    stat = os.stat(catalog_name)
+    key = "{0}:{1}:{2}".format(os.path.abspath(catalog_name), stat.st_size,
+                               stat.st_mtime_ns)
+    name = os.path.splitext(os.path.basename(catalog_name))[0]
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, name + '_' + digest)
+
+
+def write_column_store(table, cache_path):
+    """Writes each column of the input table to a separate .npy file.
+
+    Columns are first written to a temporary directory that is renamed to
+    cache_path once complete, so a partially written cache is never read.
+
+    Args:
+        table: `astropy.table.Table` to store.
+        cache_path: Directory to save the column files in.
+    """
+    tmp_path = cache_path + '.tmp{0}'.format(os.getpid())
+    os.makedirs(tmp_path)
+    units = {}
+    for name in table.colnames:
+        np.save(os.path.join(tmp_path, name + '.npy'),
+                np.asarray(table[name]))
+        if table[name].unit is not None:
+            units[name] = str(table[name].unit)
+    with open(os.path.join(tmp_path, 'columns.json'), 'w') as outfile:
+        json.dump({'columns': table.colnames, 'units': units}, outfile)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process cached the same catalog in the meantime.
+        for name in os.listdir(tmp_path):
+            os.remove(os.path.join(tmp_path, name))
+        os.rmdir(tmp_path)
+
+
+def append_column_store(table, cache_path):
+    """Adds columns of the input table that are not already in the column
+    store to it.
+
+    Args:
+        table: `astropy.table.Table` with columns to add.
+        cache_path: Directory with the column files.
+    """
+    info_name = os.path.join(cache_path, 'columns.json')
+    with open(info_name, 'r') as infile:
+        info = json.load(infile)
+    new_columns = [name for name in table.colnames
+                   if name not in info['columns']]
+    if not new_columns:
+        return
+    tmp_ext = '.tmp{0}'.format(os.getpid())
+    for name in new_columns:
+        # np.save appends .npy to names not ending with it.
+        tmp_name = os.path.join(cache_path, name + tmp_ext + '.npy')
+        np.save(tmp_name, np.asarray(table[name]))
+        os.replace(tmp_name, os.path.join(cache_path, name + '.npy'))
+    info['columns'].extend(new_columns)
+    with open(info_name + tmp_ext, 'w') as outfile:
+        json.dump(info, outfile)
+    os.replace(info_name + tmp_ext, info_name)
+
+
+def read_column_store(cache_path, columns=None):
+    """Returns astropy table with columns memory-mapped from the column store.
+
+    The columns are opened read-only and are not copied into memory, so pages
+    are loaded lazily and shared between processes reading the same cache.
+
+    Args:
+        cache_path: Directory with the column files.
+        columns: Names of columns to read. If None, all columns are read.
+
+    Returns:
+        `astropy.table.Table` with memory-mapped columns.
+    """
+    with open(os.path.join(cache_path, 'columns.json'), 'r') as infile:
+        info = json.load(infile)
+    if columns is None:
+        columns = info['columns']
+    check_columns(info['columns'], columns, cache_path)
+    data = [np.load(os.path.join(cache_path, name + '.npy'),
+                    mmap_mode='r') for name in columns]
+    table = astropy.table.Table(data, names=columns, copy=False)
+    for name, unit in info['units'].items():
+        if name in columns:
+            table[name].unit = unit
+    return table
+
+
+def read_catalog(catalog_name, columns=None):
+    """Returns astropy table read from FITS or ascii catalog file.
+
+    If columns is input, only those columns are read. FITS catalogs are then
+    read with fitsio, which reads the column subset without loading the other
+    columns.
+
+    Args:
+        catalog_name: Name of CatSim-like catalog file.
+        columns: Names of columns to read. If None, all columns are read.
+    """
+    name, ext = os.path.splitext(catalog_name)
+    if ext == '.fits':
+        if columns is not None:
+            with fitsio.FITS(catalog_name) as fits:
+                check_columns(fits[1].get_colnames(), columns, catalog_name)
+                data = fits[1].read(columns=columns)
+            return astropy.table.Table(data)[columns]
+        table = astropy.table.Table.read(catalog_name,
+                                         format='fits')
+    else:
+        table = astropy.table.Table.read(catalog_name,
+                                         format='ascii.basic')
+    if columns is not None:
+        check_columns(table.colnames, columns, catalog_name)
+        table = table[columns]
+    return table
+
+
+def load_catalog(Args, selection_function=None, cache_dir=None,
+                 columns=None, derived_columns=False):
     """Returns astropy table with catalog name from input class.
 
+    If cache_dir is input, the catalog is converted on first load into a store
+    of per-column .npy files in cache_dir. Subsequent loads memory-map these
+    files instead of parsing the catalog again.
+
+    If columns is input, only those columns are loaded. A KeyError is raised if
+    any of them is not in the catalog. Use `get_required_columns` to load only
+    the columns btk needs to simulate blends.
+
+    If derived_columns is True, columns with quantities derived from the
+    catalog (see `add_derived_columns`) are added before the selection function
+    is applied. If the catalog is cached, they are saved in the cache too.
+
     Args:
         Args: Class containing input parameters.
         Args.catalog_name: Name of CatSim-like catalog to draw galaxies from.
         sampling_function: Selection cuts (if input) to place on input catalog.
+        cache_dir: Directory to cache the catalog column store in. If None,
+            the catalog is read without caching.
+        columns: Names of columns to load. If None, all columns are loaded.
+        derived_columns: If True, adds columns with derived quantities.
 
     Returns:
         astropy.table: CatSim-like catalog with a selection criteria applied if
         provided.
 
+    If Args.catalog_name is a list or dict of catalog names, each catalog is
+    loaded separately and a `Multi_catalog` is returned (see
+    `load_multi_catalog`).
+
+    For catalogs too large to be loaded in memory, use `Catalog_reservoir`.
+
     Todo:
         Add script to load DC2 catalog
-        Add option to load multiple catalogs(e.g. star , galaxy)
     """
-    name, ext = os.path.splitext(Args.catalog_name)
-    if ext == '.fits':
-        table = astropy.table.Table.read(Args.catalog_name,
-                                         format='fits')
+    if isinstance(Args.catalog_name, (list, tuple, dict)):
+        return load_multi_catalog(
+            Args, selection_function=selection_function, cache_dir=cache_dir,
+            columns=columns, derived_columns=derived_columns)
+    if cache_dir:
+        cache_path = get_cache_path(Args.catalog_name, cache_dir)
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            write_column_store(read_catalog(Args.catalog_name), cache_path)
+            if Args.verbose:
+                print(f"Catalog column store written to {cache_path}")
+        if derived_columns:
+            table = read_column_store(cache_path)
+            add_derived_columns(table)
+            append_column_store(table, cache_path)
+            if columns is not None:
+                columns = list(columns) + [name for name, _ in DERIVED_COLUMNS
+                                           if name not in columns]
+        table = read_column_store(cache_path, columns=columns)
     else:
-        table = astropy.table.Table.read(Args.catalog_name,
-                                         format='ascii.basic')
+        table = read_catalog(Args.catalog_name, columns=columns)
+        if derived_columns:
+            add_derived_columns(table)
     if Args.verbose:
         print("Catalog loaded")
     if selection_function:
@@ -32,3 +341,314 @@ def load_catalog(Args, selection_function=None):
             print("Selection criterion applied to input catalog")
         return selection_function(table)
     return table
+
+
+class Multi_catalog(object):
+    """Catalogs of several types of objects (e.g. stars and galaxies) that are
+    sampled together without being concatenated.
+
+    Each catalog keeps its own table. Rows of the combined catalog are numbered
+    by a global index, with the rows of each type following those of the
+    previous type, so objects of all types can be selected with one index
+    array and gathered into a blend catalog with `take`.
+
+    Attributes:
+        tables: dict of `astropy.table.Table` of each type, in input order.
+        types: Names of the object types.
+        offsets: Global index of the first row of each type, followed by the
+            total number of rows.
+    """
+
+    def __init__(self, tables):
+        self.tables = dict(tables)
+        self.types = list(self.tables)
+        lengths = [len(table) for table in self.tables.values()]
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(int)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, type_name):
+        return self.tables[type_name]
+
+    def get_type_index(self, rows):
+        """Returns index in types of the catalog of each global row index."""
+        return np.searchsorted(self.offsets, rows, side='right') - 1
+
+    def get_dtype(self):
+        """Returns list of (name, dtype, shape) of the union of the columns of
+        all catalogs, in the order they first appear."""
+        dtypes = {}
+        for table in self.tables.values():
+            for name in table.colnames:
+                column = np.asarray(table[name])
+                if name in dtypes:
+                    dtype = np.result_type(dtypes[name][0], column.dtype)
+                    dtypes[name] = (dtype, dtypes[name][1])
+                else:
+                    dtypes[name] = (column.dtype, column.shape[1:])
+        return [(name, dtype, shape) for name, (dtype, shape)
+                in dtypes.items()]
+
+    def take(self, rows):
+        """Returns catalog with the entries at input global row indices.
+
+        The returned catalog has the columns of all catalogs, with zeros where
+        a column is not in the catalog of an entry, and a column btk_type with
+        the type of each entry.
+
+        Args:
+            rows: Global row indices of entries.
+
+        Returns:
+            `astropy.table.Table` with entries in the order of rows.
+        """
+        rows = np.asarray(rows, dtype=int)
+        type_index = self.get_type_index(rows)
+        type_length = max(len(name) for name in self.types)
+        dtype = self.get_dtype() + [('btk_type', f'U{type_length}', ())]
+        data = np.zeros(len(rows), dtype=dtype)
+        for i, name in enumerate(self.types):
+            select = type_index == i
+            if not np.any(select):
+                continue
+            entries = self.tables[name][rows[select] - self.offsets[i]]
+            for column in entries.colnames:
+                data[column][select] = entries[column]
+            data['btk_type'][select] = name
+        return astropy.table.Table(data)
+
+
+def get_type_value(value, type_name):
+    """Returns value[type_name] if value is a dict, otherwise value."""
+    if isinstance(value, dict):
+        return value.get(type_name)
+    return value
+
+
+def load_multi_catalog(Args, selection_function=None, cache_dir=None,
+                       columns=None, derived_columns=False):
+    """Returns `Multi_catalog` with catalogs of several types of objects.
+
+    Args.catalog_name is a dict of catalog names keyed by object type, or a
+    list of catalog names, in which case the type is the file name without
+    extension. Each catalog is loaded with `load_catalog`. The
+    selection_function, columns and derived_columns inputs are either applied
+    to all catalogs or are dicts keyed by object type, since e.g. galaxy
+    selection functions and derived columns do not apply to star catalogs.
+
+    Args:
+        Args: Class containing input parameters.
+        selection_function: Selection cuts (if input) to place on the
+            catalogs.
+        cache_dir: Directory to cache the catalog column stores in.
+        columns: Names of columns to load.
+        derived_columns: If True, adds columns with derived quantities.
+
+    Returns:
+        `Multi_catalog` of the input catalogs.
+    """
+    catalog_names = Args.catalog_name
+    if not isinstance(catalog_names, dict):
+        catalog_names = {os.path.splitext(os.path.basename(name))[0]: name
+                         for name in catalog_names}
+    tables = {}
+    for type_name, catalog_name in catalog_names.items():
+        type_args = copy.copy(Args)
+        type_args.catalog_name = catalog_name
+        tables[type_name] = load_catalog(
+            type_args,
+            selection_function=get_type_value(selection_function, type_name),
+            cache_dir=cache_dir, columns=get_type_value(columns, type_name),
+            derived_columns=bool(get_type_value(derived_columns, type_name)))
+    return Multi_catalog(tables)
+
+
+def read_catalog_chunks(catalog_name, chunk_size, columns=None):
+    """Yields consecutive chunks of rows of the catalog as astropy tables.
+
+    Rows of FITS catalogs are read chunk by chunk with fitsio, so only one
+    chunk is held in memory at a time. Ascii catalogs cannot be read by rows
+    and are read in full before being split into chunks.
+
+    Args:
+        catalog_name: Name of CatSim-like catalog file.
+        chunk_size: Number of rows per chunk.
+        columns: Names of columns to read. If None, all columns are read.
+
+    Yields:
+        `astropy.table.Table` with at most chunk_size rows.
+    """
+    name, ext = os.path.splitext(catalog_name)
+    if ext != '.fits':
+        table = read_catalog(catalog_name, columns=columns)
+        for start in range(0, len(table), chunk_size):
+            yield table[start:start + chunk_size]
+        return
+    with fitsio.FITS(catalog_name) as fits:
+        colnames = fits[1].get_colnames()
+        check_columns(colnames, columns or [], catalog_name)
+        nrows = fits[1].get_nrows()
+        for start in range(0, nrows, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, nrows))
+            data = fits[1].read(rows=rows, columns=columns)
+            yield astropy.table.Table(data)[columns or colnames]
+
+
+class Catalog_reservoir(object):
+    """Random sample of bounded size of a catalog that is read in chunks, for
+    catalogs too large to be loaded in memory.
+
+    The catalog is streamed with `read_catalog_chunks`, the selection function
+    is applied to each chunk, and a uniform random sample of size rows of the
+    selected entries is kept with reservoir sampling. Memory use is set by size
+    and chunk_size, irrespective of the catalog size.
+
+    If refresh_batches is set, blends of batch i are sampled from sample
+    number i // refresh_batches (see `get_catalog`). Each sample is drawn with
+    a random state seeded from Args.seed and the sample number only, so the
+    sample of a batch does not depend on timing or on the batches generated
+    before. The next sample is drawn in a background thread while the current
+    one is used. The thread is first started when the sample of a batch after
+    the first one is requested, so that no thread runs while the worker pool
+    of `btk.draw_blends.generate` is forked for the first batch. Processes
+    forked later (e.g. a pool started after the first batch) should use a
+    'spawn' or 'forkserver' context. `btk.create_blend_generator.generate`
+    accepts a Catalog_reservoir as catalog.
+
+    Attributes:
+        catalog: `astropy.table.Table` with the current sample.
+        version: Number of the current sample.
+    """
+
+    def __init__(self, Args, size, chunk_size=100000, selection_function=None,
+                 columns=None, derived_columns=False, refresh_batches=None,
+                 batch_index=0):
+        """Draws the sample of the catalog Args.catalog_name of the first
+        batch batch_index.
+
+        Args:
+            Args: Class containing input parameters.
+            size: Number of catalog entries in the sample.
+            chunk_size: Number of rows read from the catalog at a time.
+            selection_function: Selection cuts (if input) to place on each
+                chunk of the catalog.
+            columns: Names of columns to load. If None, all columns are
+                loaded.
+            derived_columns: If True, adds columns with derived quantities
+                (see `add_derived_columns`) to each chunk.
+            refresh_batches: Number of batches sampled from each sample. If
+                None, the first sample is used for all batches.
+            batch_index (int): Index of the first batch blends are sampled
+                for, so that generation resumed at a later batch draws the
+                sample of that batch first.
+        """
+        if refresh_batches is not None and int(refresh_batches) < 1:
+            raise ValueError("refresh_batches must be at least 1: "
+                             "{0}".format(refresh_batches))
+        self.catalog_name = Args.catalog_name
+        self.seed = Args.seed
+        self.size = size
+        self.chunk_size = chunk_size
+        self.selection_function = selection_function
+        self.columns = columns
+        self.derived_columns = derived_columns
+        self.refresh_batches = refresh_batches
+        self.verbose = Args.verbose
+        self.version = 0
+        if refresh_batches is not None:
+            self.version = batch_index // int(refresh_batches)
+        self.catalog = self.sample(self.version)
+        self.first_batch = batch_index
+        self._next = None
+
+    def sample(self, version=0):
+        """Returns `astropy.table.Table` with a random sample of the catalog
+        drawn with reservoir sampling.
+
+        Args:
+            version: Number of the sample, used with the seed to seed the
+                random state of the sample.
+        """
+        random_state = np.random.RandomState(np.random.MT19937(
+            np.random.SeedSequence([self.seed, version])))
+        reservoir, seen = None, 0
+        for chunk in read_catalog_chunks(self.catalog_name, self.chunk_size,
+                                         columns=self.columns):
+            if self.derived_columns:
+                add_derived_columns(chunk)
+            if self.selection_function:
+                chunk = self.selection_function(chunk)
+            data = np.asarray(chunk.as_array())
+            if reservoir is None:
+                reservoir = np.zeros(self.size, dtype=data.dtype)
+            # index in the stream of each entry in the chunk.
+            index = seen + np.arange(len(data))
+            fill = index < self.size
+            reservoir[index[fill]] = data[fill]
+            # entry t replaces a random slot with probability size/(t+1).
+            slot = np.floor(random_state.random_sample(len(data)) *
+                            (index + 1)).astype(int)
+            replace, = np.where(~fill & (slot < self.size))
+            # if a slot is replaced more than once, the last entry is kept.
+            _, last = np.unique(slot[replace][::-1], return_index=True)
+            replace = replace[len(replace) - 1 - last]
+            reservoir[slot[replace]] = data[replace]
+            seen += len(data)
+        if reservoir is None or seen == 0:
+            raise ValueError("No entries of catalog {0} to sample".format(
+                self.catalog_name))
+        if self.verbose:
+            print(f"Sampled {min(seen, self.size)} of {seen} catalog entries")
+        return astropy.table.Table(reservoir[:min(seen, self.size)])
+
+    def _prefetch(self, version):
+        """Draws sample version in a background thread."""
+        result = {}
+
+        def run():
+            try:
+                result['catalog'] = self.sample(version)
+            except Exception as e:
+                result['error'] = e
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self._next = (version, thread, result)
+
+    def get_catalog(self, batch_index):
+        """Returns the sample blends of batch batch_index are sampled from.
+
+        The sample is replaced every refresh_batches batches, with the sample
+        drawn in the background if it is the next one. For batches after the
+        first one, the following sample starts being drawn in the background
+        if it is not already.
+        """
+        if self.refresh_batches is None:
+            return self.catalog
+        version = batch_index // int(self.refresh_batches)
+        if version != self.version:
+            catalog = None
+            if self._next is not None:
+                next_version, thread, result = self._next
+                thread.join()
+                self._next = None
+                if next_version == version:
+                    if 'error' in result:
+                        raise result['error']
+                    catalog = result['catalog']
+            if catalog is None:
+                catalog = self.sample(version)
+            self.catalog, self.version = catalog, version
+        # no thread is started for the first batch, while processes may be
+        # forked to draw it.
+        if self._next is None and batch_index > self.first_batch:
+            self._prefetch(self.version + 1)
+        return self.catalog
+
+    def stop(self):
+        """Waits for the sample drawn in the background and stops drawing
+        new ones."""
+        self.refresh_batches = None
+        if self._next is not None:
+            self._next[1].join()
+            self._next = None
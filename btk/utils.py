@@ -3,8 +3,11 @@
 """
 from btk import measure
 import btk.create_blend_generator
+import btk.get_input_catalog
+import btk.create_observing_generator
 import numpy as np
 import astropy.table
+import scipy.spatial
 import skimage.feature
 
 
@@ -44,19 +47,17 @@ class Stack_params(measure.Measurement_params):
 
     def get_psf_sky(self, obs_cond):
         """Returns postage stamp image of the PSF and mean background sky
-        level value saved in the input obs_cond class
+        level value saved in the input obs_cond class. The PSF image is drawn
+        once for each PSF and is read-only.
         Args:
             obs_cond:`descwl.survey.Survey` class describing observing
                       conditions.
 
         """
-        mean_sky_level = obs_cond.mean_sky_level
-        psf = obs_cond.psf_model
-        psf_image = psf.drawImage(
-            scale=obs_cond.pixel_scale,
-            nx=self.psf_stamp_size,
-            ny=self.psf_stamp_size).array
-        return psf_image, mean_sky_level
+        psf_artifacts = btk.create_observing_generator.get_psf_artifacts(
+            obs_cond)
+        psf_image = psf_artifacts.get_stamp(self.psf_stamp_size)
+        return psf_image, psf_artifacts.mean_sky_level
 
     def make_measurement(self, data, index):
         """Perform detection, deblending and measurement on the i band image of
@@ -235,7 +236,9 @@ class Scarlet_params(measure.Measurement_params):
         else:
             peaks = np.stack((blend_cat['dx'], blend_cat['dy']), axis=1)
         bg_rms = np.array(
-            [data['obs_condition'][index][i].mean_sky_level**0.5 for i in range(len(images))])
+            [btk.create_observing_generator.get_psf_artifacts(
+                data['obs_condition'][index][i]).sky_rms
+             for i in range(len(images))])
         blend, rejected_sources = self.scarlet_initialize(images, peaks,
                                                           bg_rms, self.iters,
                                                           self.e_rel)
@@ -278,27 +281,40 @@ def basic_selection_function(catalog):
     Returns:
         CatSim-like catalog after applying selection cuts.
     """
-    f = catalog['fluxnorm_bulge']/(catalog['fluxnorm_disk']+catalog['fluxnorm_bulge'])
-    r_sec = np.hypot(catalog['a_d']*(1-f)**0.5*4.66,
-                     catalog['a_b']*f**0.5*1.46)
+    r_sec = btk.get_input_catalog.get_r_sec_major(catalog)
     q, = np.where((r_sec <= 4) & (catalog['i_ab'] <= 27))
     return catalog[q]
 
 
-def basic_sampling_function(Args, catalog):
+def basic_sampling_function(Args, catalog, sampling_index=None):
     """Randomly picks entries from input catalog that are brighter than 25.3
     mag in the i band. The centers are randomly distributed within 1/5 of the
     stamp size.
     At least one bright galaxy (i<=24) is always selected.
+
+    If sampling_index (`btk.create_blend_generator.Sampling_index` of the
+    catalog) is input, the magnitude and size cuts are read from it instead of
+    being computed on the full catalog.
     """
     number_of_objects = np.random.randint(0, Args.max_number)
-    a = np.hypot(catalog['a_d'], catalog['a_b'])
-    cond = (a <= 2) & (a > 0.2)
-    q_bright, = np.where(cond & (catalog['i_ab'] <= 24))
-    if np.random.random() >= 0.9:
-        q, = np.where(cond & (catalog['i_ab'] < 28))
+    if sampling_index is not None:
+        if 'basic_size' not in sampling_index.masks:
+            a = btk.get_input_catalog.get_major_axis(catalog)
+            sampling_index.set_mask('basic_size', (a <= 2) & (a > 0.2))
+        q_bright = sampling_index.get_rows(24, mask='basic_size')
+        if np.random.random() >= 0.9:
+            q = sampling_index.get_rows(28, inclusive=False,
+                                        mask='basic_size')
+        else:
+            q = sampling_index.get_rows(25.3, mask='basic_size')
     else:
-        q, = np.where(cond & (catalog['i_ab'] <= 25.3))
+        a = btk.get_input_catalog.get_major_axis(catalog)
+        cond = (a <= 2) & (a > 0.2)
+        q_bright, = np.where(cond & (catalog['i_ab'] <= 24))
+        if np.random.random() >= 0.9:
+            q, = np.where(cond & (catalog['i_ab'] < 28))
+        else:
+            q, = np.where(cond & (catalog['i_ab'] <= 25.3))
     blend_catalog = astropy.table.vstack(
         [catalog[np.random.choice(q_bright, size=1)],
          catalog[np.random.choice(q, size=number_of_objects)]])
@@ -312,7 +328,183 @@ def basic_sampling_function(Args, catalog):
     return blend_catalog
 
 
-def group_sampling_function(Args, catalog):
+def basic_batch_sampling_function(Args, catalog, sampling_index=None):
+    """Samples all blends of the batch as in `basic_sampling_function`, with
+    the random draws for the whole batch made in a few vectorized calls.
+
+    Use as batch_sampling_function in `btk.create_blend_generator.generate`.
+
+    Args:
+        Args: Class containing input parameters.
+        catalog: CatSim-like catalog from which to sample galaxies.
+        sampling_index: `btk.create_blend_generator.Sampling_index` of the
+            catalog. If None, an index is built for this call.
+
+    Returns:
+        List of Args.batch_size catalogs with entries corresponding to one
+        blend.
+    """
+    if sampling_index is None:
+        sampling_index = btk.create_blend_generator.Sampling_index(catalog)
+    if 'basic_size' not in sampling_index.masks:
+        a = btk.get_input_catalog.get_major_axis(catalog)
+        sampling_index.set_mask('basic_size', (a <= 2) & (a > 0.2))
+    q_bright = sampling_index.get_rows(24, mask='basic_size')
+    q_faint = sampling_index.get_rows(28, inclusive=False, mask='basic_size')
+    q = sampling_index.get_rows(25.3, mask='basic_size')
+    number_of_objects = np.random.randint(0, Args.max_number,
+                                          size=Args.batch_size)
+    use_faint = np.random.random(size=Args.batch_size) >= 0.9
+    # first entry of each blend is a bright galaxy, followed by
+    # number_of_objects galaxies from q or q_faint.
+    blend_size = number_of_objects + 1
+    offsets = np.concatenate(([0], np.cumsum(blend_size)))
+    is_bright = np.zeros(offsets[-1], dtype=bool)
+    is_bright[offsets[:-1]] = True
+    rows = np.empty(offsets[-1], dtype=int)
+    rows[is_bright] = np.random.choice(q_bright, size=Args.batch_size)
+    faint = np.repeat(use_faint, number_of_objects)
+    other_rows = np.empty(len(faint), dtype=int)
+    other_rows[faint] = np.random.choice(q_faint, size=faint.sum())
+    other_rows[~faint] = np.random.choice(q, size=(~faint).sum())
+    rows[~is_bright] = other_rows
+    batch_catalog = catalog[rows]
+    # keep number density of objects constant
+    maxshift = Args.stamp_size/30.*number_of_objects**0.5
+    maxshift[number_of_objects == 0] = Args.stamp_size / 10.
+    maxshift = np.repeat(maxshift, blend_size)
+    batch_catalog['ra'] = np.random.uniform(-1, 1, size=len(rows))*maxshift
+    batch_catalog['dec'] = np.random.uniform(-1, 1, size=len(rows))*maxshift
+    return btk.create_blend_generator.split_batch_catalog(batch_catalog,
+                                                         blend_size)
+
+
+def multi_catalog_batch_sampling_function(Args, catalog, sampling_index=None):
+    """Samples all blends of the batch from a
+    `btk.get_input_catalog.Multi_catalog` with objects of several types (e.g.
+    stars and galaxies).
+
+    Number of objects per blend is set at a random integer between 1 and
+    Args.max_number. The type of each object is drawn with probabilities
+    Args.type_fraction (dict of fraction keyed by type) if set, otherwise in
+    proportion to the number of objects of each type brighter than 25.3 mag in
+    the i band. Entries of each type are drawn from that catalog with a single
+    call and all entries of the batch are gathered with one
+    `Multi_catalog.take`, which adds a btk_type column. The centers are
+    randomly distributed within 1/10th of the stamp size.
+
+    Use as batch_sampling_function in `btk.create_blend_generator.generate`.
+
+    Args:
+        Args: Class containing input parameters.
+        catalog: `btk.get_input_catalog.Multi_catalog` from which to sample
+            objects.
+        sampling_index: dict of `btk.create_blend_generator.Sampling_index`
+            of the catalog of each type. If None, the magnitude cut is computed
+            on the catalogs.
+
+    Returns:
+        List of Args.batch_size catalogs with entries corresponding to one
+        blend.
+    """
+    type_rows = []
+    for name in catalog.types:
+        if sampling_index is not None:
+            q = sampling_index[name].get_rows(25.3)
+        else:
+            q, = np.where(catalog[name]['i_ab'] <= 25.3)
+        type_rows.append(q)
+    type_fraction = getattr(Args, 'type_fraction', None)
+    if type_fraction:
+        p = np.array([type_fraction.get(name, 0.) for name in catalog.types])
+    else:
+        p = np.array([len(q) for q in type_rows], dtype=float)
+    number_of_objects = np.random.randint(1, Args.max_number + 1,
+                                          size=Args.batch_size)
+    total = number_of_objects.sum()
+    type_index = np.random.choice(len(catalog.types), size=total,
+                                  p=p / p.sum())
+    rows = np.empty(total, dtype=int)
+    for i, q in enumerate(type_rows):
+        select = type_index == i
+        rows[select] = catalog.offsets[i] + np.random.choice(
+            q, size=select.sum())
+    batch_catalog = catalog.take(rows)
+    batch_catalog['ra'], batch_catalog['dec'] = \
+        btk.create_blend_generator.get_random_center_shift(Args, total)
+    return btk.create_blend_generator.split_batch_catalog(batch_catalog,
+                                                         number_of_objects)
+
+
+class Group_index(object):
+    """Index of the groups in a pre-run WLD catalog and of the rows of the
+    CatSim-like catalog by galtileid, built once so that sampling a group does
+    not scan either catalog.
+
+    Group members and catalog rows are looked up with binary searches on ids
+    sorted with a stable sort, so they are returned in the same order as
+    boolean masks on the catalogs would select them.
+
+    Attributes:
+        group_ids: Ids of groups with two or more members.
+    """
+
+    def __init__(self, wld_catalog, catalog):
+        grp_id = np.asarray(wld_catalog['grp_id'])
+        self.group_ids = np.unique(
+            grp_id[np.asarray(wld_catalog['grp_size']) >= 2])
+        self.member_order = np.argsort(grp_id, kind='stable')
+        self.sorted_grp_id = grp_id[self.member_order]
+        self.db_id = np.asarray(wld_catalog['db_id'])
+        galtileid = np.asarray(catalog['galtileid'])
+        self.row_order = np.argsort(galtileid, kind='stable')
+        self.sorted_galtileid = galtileid[self.row_order]
+
+    def get_members(self, group_id):
+        """Returns db_id of galaxies in the WLD catalog belonging to the group.
+        """
+        start = np.searchsorted(self.sorted_grp_id, group_id, side='left')
+        stop = np.searchsorted(self.sorted_grp_id, group_id, side='right')
+        return self.db_id[self.member_order[start:stop]]
+
+    def get_rows(self, ids):
+        """Returns indices of catalog rows with galtileid in ids."""
+        if len(ids) == 0:
+            return np.zeros(0, dtype=int)
+        start = np.searchsorted(self.sorted_galtileid, ids, side='left')
+        stop = np.searchsorted(self.sorted_galtileid, ids, side='right')
+        return np.concatenate([self.row_order[i:j]
+                               for i, j in zip(start, stop)])
+
+
+def get_group_index(Args, catalog, sampling_index=None):
+    """Returns `Group_index` of the pre-run WLD catalog Args.wld_catalog_name
+    and the input catalog.
+
+    If sampling_index is input, the group index is built once and stored in
+    the sampling index cache.
+
+    Args:
+        Args: Class containing input parameters.
+        catalog: CatSim-like catalog from which to sample galaxies.
+        sampling_index: `btk.create_blend_generator.Sampling_index` of the
+            catalog.
+    """
+    if not hasattr(Args, 'wld_catalog_name'):
+        raise Exception("A pre-run WLD catalog  name should be input as "
+                        "Args.wld_catalog_name")
+    key = ('group_index', Args.wld_catalog_name)
+    if sampling_index is not None and key in sampling_index.cache:
+        return sampling_index.cache[key]
+    wld_catalog = astropy.table.Table.read(Args.wld_catalog_name,
+                                           format='fits')
+    group_index = Group_index(wld_catalog, catalog)
+    if sampling_index is not None:
+        sampling_index.cache[key] = group_index
+    return group_index
+
+
+def group_sampling_function(Args, catalog, sampling_index=None):
     """Blends are defined from *groups* of galaxies from the CatSim
     catalog previously analyzed with WLD.
 
@@ -322,20 +514,18 @@ def group_sampling_function(Args, catalog):
 
     Note: the pre-run WLD images are not used here. We only use the pre-run
     catalog (in i band) to identify galaxies that belong to a group.
+
+    If sampling_index (`btk.create_blend_generator.Sampling_index` of the
+    catalog) is input, the WLD catalog is read and indexed only once (see
+    `get_group_index`).
     """
-    if not hasattr(Args, 'wld_catalog_name'):
-        raise Exception("A pre-run WLD catalog  name should be input as "
-                        "Args.wld_catalog_name")
-    else:
-        wld_catalog = astropy.table.Table.read(Args.wld_catalog_name,
-                                               format='fits')
+    group_index = get_group_index(Args, catalog,
+                                  sampling_index=sampling_index)
     # randomly sample a group.
-    group_ids = np.unique(wld_catalog['grp_id'][wld_catalog['grp_size'] >= 2])
-    group_id = np.random.choice(group_ids, replace=False)
+    group_id = np.random.choice(group_index.group_ids, replace=False)
     # get all galaxies belonging to the group.
-    ids = wld_catalog['db_id'][wld_catalog['grp_id'] == group_id]
-    blend_catalog = astropy.table.vstack(
-        [catalog[catalog['galtileid'] == i] for i in ids])
+    ids = group_index.get_members(group_id)
+    blend_catalog = catalog[group_index.get_rows(ids)]
     # Set mean x and y coordinates of the group galaxies to the center of the
     # postage stamp.
     blend_catalog['ra'] -= np.mean(blend_catalog['ra'])
@@ -362,6 +552,109 @@ def group_sampling_function(Args, catalog):
     return no_boundary[select]
 
 
+class Sky_index(object):
+    """KD-tree of the sky positions of the catalog galaxies, used to find
+    galaxies within a radius of a position on the sky.
+
+    The tree is built on the unit vectors of the positions, so that distances
+    are correct at all declinations and across ra = 0.
+
+    Attributes:
+        tree: `scipy.spatial.cKDTree` of the positions.
+    """
+
+    def __init__(self, catalog):
+        self.tree = scipy.spatial.cKDTree(
+            get_unit_vectors(catalog['ra'], catalog['dec']))
+
+    def query(self, ra, dec, radius):
+        """Returns indices of catalog rows within radius of the position.
+
+        Args:
+            ra: Right ascension of position in degrees.
+            dec: Declination of position in degrees.
+            radius: Radius in arcseconds.
+        """
+        chord = 2 * np.sin(np.radians(radius / 3600.) / 2)
+        rows = self.tree.query_ball_point(get_unit_vectors(ra, dec), chord)
+        return np.sort(np.array(rows, dtype=int))
+
+
+def get_unit_vectors(ra, dec):
+    """Returns unit vectors pointing to input ra, dec in degrees."""
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra),
+                     np.sin(dec)], axis=-1)
+
+
+def get_sky_index(catalog, sampling_index=None):
+    """Returns `Sky_index` of the catalog.
+
+    If sampling_index is input, the KD-tree is built once and stored in the
+    sampling index cache.
+
+    Args:
+        catalog: CatSim-like catalog from which to sample galaxies.
+        sampling_index: `btk.create_blend_generator.Sampling_index` of the
+            catalog.
+    """
+    if sampling_index is not None and 'sky_index' in sampling_index.cache:
+        return sampling_index.cache['sky_index']
+    sky_index = Sky_index(catalog)
+    if sampling_index is not None:
+        sampling_index.cache['sky_index'] = sky_index
+    return sky_index
+
+
+def sky_sampling_function(Args, catalog, sampling_index=None):
+    """Blends are defined by the galaxies that lie around a randomly selected
+    galaxy on the sky, so that their relative positions are those in the
+    catalog.
+
+    A galaxy brighter than 24 mag in the i band is randomly picked as the
+    center of the blend. All galaxies in the catalog that would lie within the
+    postage stamp are found with a KD-tree query (see `Sky_index`), and their
+    ra dec are converted to arcseconds relative to the center as in
+    `group_sampling_function`. Galaxies too close to the stamp edge are
+    removed, and if more than Args.max_number remain, the central galaxy and
+    a random selection of the others are returned.
+
+    If sampling_index (`btk.create_blend_generator.Sampling_index` of the
+    catalog) is input, the KD-tree is built only once.
+    """
+    sky_index = get_sky_index(catalog, sampling_index=sampling_index)
+    if sampling_index is not None:
+        q_bright = sampling_index.get_rows(24)
+    else:
+        q_bright, = np.where(catalog['i_ab'] <= 24)
+    center = np.random.choice(q_bright)
+    ra0, dec0 = catalog['ra'][center], catalog['dec'][center]
+    rows = sky_index.query(ra0, dec0, Args.stamp_size / 2. * 2**0.5)
+    # put central galaxy first
+    rows = np.concatenate(([center], rows[rows != center]))
+    blend_catalog = catalog[rows]
+    # convert ra dec from degrees to arcsec relative to the center
+    dra = (blend_catalog['ra'] - ra0 + 180) % 360 - 180
+    blend_catalog['ra'] = dra * np.cos(np.radians(dec0)) * 3600
+    blend_catalog['dec'] = (blend_catalog['dec'] - dec0) * 3600
+    # Add small random shift so that center does not perfectly align with
+    # the stamp center
+    dx, dy = btk.create_blend_generator.get_random_center_shift(
+        Args, 1, maxshift=3 * Args.pixel_scale)
+    blend_catalog['ra'] += dx
+    blend_catalog['dec'] += dy
+    # make sure galaxy centers don't lie too close to edge
+    cond1 = np.abs(blend_catalog['ra']) < Args.stamp_size / 2. - 3
+    cond2 = np.abs(blend_catalog['dec']) < Args.stamp_size / 2. - 3
+    no_boundary = blend_catalog[cond1 & cond2]
+    if len(no_boundary) <= Args.max_number:
+        return no_boundary
+    # keep the central galaxy and randomly select max_number - 1 others.
+    select = np.random.choice(range(1, len(no_boundary)), Args.max_number - 1,
+                              replace=False)
+    return no_boundary[np.concatenate(([0], select))]
+
+
 class Basic_measure_params(measure.Measurement_params):
     """Class to perform detection and deblending with SEP"""
 
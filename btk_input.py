@@ -2,11 +2,25 @@ import yaml
 import types
 import btk
 import os
+import json
+import glob
 import numpy as np
 import imp
 import dill
 import subprocess
 
+# Environment variables with the rank and size of MPI-style jobs, used to set
+# the shard of the generate command if it is not input.
+SHARD_ENVIRONMENT_VARIABLES = [
+    ('OMPI_COMM_WORLD_RANK', 'OMPI_COMM_WORLD_SIZE'),
+    ('PMI_RANK', 'PMI_SIZE'),
+    ('SLURM_PROCID', 'SLURM_NTASKS')]
+# Maximum number of blends in each chunk of the datasets written by the
+# generate command if dataset_chunk_size is not set in user_input. Chunks
+# are also limited by the size of their images (see
+# `btk.blend_dataset.Dataset_writer`).
+DATASET_CHUNK_SIZE = 4096
+
 
 def parse_config(config_gen, simulation, verbose):
     """Parses the config generator with the config yaml file information.
@@ -92,7 +106,9 @@ def get_config_class(config_dict, catalog_name, verbose):
     return config
 
 
-def get_catalog(param, selection_function_name, verbose):
+def get_catalog(param, selection_function_name, verbose, cache_dir=None,
+                columns=None, derived_columns=False, reservoir_size=None,
+                reservoir_refresh_batches=None, batch_index=0):
     """Returns catalog from which objects are simulated by btk
 
     Args:
@@ -100,10 +116,25 @@ def get_catalog(param, selection_function_name, verbose):
         selection_function_name (str): Name of the selection function in
             btk/utils.py.
         verbose (bool): If True prints description at multiple steps.
+        cache_dir (str): Directory to cache the catalog column store in. If
+            None, the catalog is read without caching.
+        columns: Names of catalog columns to load. If 'required', only the
+            columns btk needs to simulate blends are loaded. If None, all
+            columns are loaded.
+        derived_columns (bool): If True, quantities derived from the catalog
+            and used by btk are computed once and added as columns.
+        reservoir_size (int): If not None, the catalog is streamed from disk
+            and a random sample of reservoir_size entries is kept in memory
+            (see `btk.get_input_catalog.Catalog_reservoir`).
+        reservoir_refresh_batches (int): If not None, a new sample of the
+            catalog is drawn every reservoir_refresh_batches batches.
+        batch_index (int): Index of the first batch to generate, which sets
+            the first catalog sample drawn if reservoir_size is not None.
 
     Returns:
         `astropy.table.Table` with parameters corresponding to objects being
-        simulated.
+        simulated, or `btk.get_input_catalog.Catalog_reservoir` if
+        reservoir_size is not None.
     """
     if selection_function_name != "None":
         btk_utils = os.path.join(os.path.dirname(btk.__file__), 'utils.py')
@@ -111,8 +142,19 @@ def get_catalog(param, selection_function_name, verbose):
         selection_function = getattr(utils, selection_function_name)
     else:
         selection_function = None
-    catalog = btk.get_input_catalog.load_catalog(
-        param, selection_function=selection_function)
+    if columns == 'required':
+        columns = btk.get_input_catalog.get_required_columns(param)
+    if reservoir_size is not None:
+        catalog = btk.get_input_catalog.Catalog_reservoir(
+            param, int(reservoir_size), selection_function=selection_function,
+            columns=columns, derived_columns=derived_columns,
+            refresh_batches=reservoir_refresh_batches,
+            batch_index=batch_index)
+    else:
+        catalog = btk.get_input_catalog.load_catalog(
+            param, selection_function=selection_function,
+            cache_dir=cache_dir, columns=columns,
+            derived_columns=derived_columns)
     if verbose:
         print(f"Loaded {param.catalog_name} catalog with "
               f"{selection_function_name} selection "
@@ -120,7 +162,8 @@ def get_catalog(param, selection_function_name, verbose):
     return catalog
 
 
-def get_blend_generator(param, catalog, sampling_function_name, verbose):
+def get_blend_generator(param, catalog, sampling_function_name, verbose,
+                        batch_sampling_function_name="None", batch_index=0):
     """Returns generator object that generates catalog describing blended
     objects.
 
@@ -132,18 +175,30 @@ def get_blend_generator(param, catalog, sampling_function_name, verbose):
             btk/utils.py that determines how objects are drawn from the catalog
             to create blends.
         verbose (bool): If True prints description at multiple steps.
+        batch_sampling_function_name (str): Name of the function in
+            btk/utils.py that samples all blends of a batch at once. If not
+            "None", it is used instead of the sampling function.
+        batch_index (int): Index of the first batch to generate.
 
     Returns:
         Generator objects that draws the blend scene.
     """
+    btk_utils = os.path.join(os.path.dirname(btk.__file__), 'utils.py')
     if sampling_function_name != "None":
-        btk_utils = os.path.join(os.path.dirname(btk.__file__), 'utils.py')
         utils = imp.load_source("", btk_utils)
         sampling_function = getattr(utils, sampling_function_name)
     else:
         sampling_function = None
-    blend_generator = btk.create_blend_generator.generate(param, catalog,
-                                                          sampling_function)
+    if batch_sampling_function_name != "None":
+        utils = imp.load_source("", btk_utils)
+        batch_sampling_function = getattr(utils, batch_sampling_function_name)
+        sampling_function_name = batch_sampling_function_name
+    else:
+        batch_sampling_function = None
+    blend_generator = btk.create_blend_generator.generate(
+        param, catalog, sampling_function,
+        batch_sampling_function=batch_sampling_function,
+        batch_index=batch_index)
     if verbose:
         print(f"Blend generator draws from {param.catalog_name} catalog "
               f"with {sampling_function_name} sampling function defined "
@@ -151,7 +206,7 @@ def get_blend_generator(param, catalog, sampling_function_name, verbose):
     return blend_generator
 
 
-def get_obs_generator(param, observe_function_name, verbose):
+def get_obs_generator(param, observe_function_name, verbose, batch_index=0):
     """Returns generator object that generates class describing the observing
     conditions.
 
@@ -162,6 +217,7 @@ def get_obs_generator(param, observe_function_name, verbose):
         observe_function_name (str): Name of the function in btk/utils.py to
             set the observing conditions under which the galaxies are drawn.
         verbose (bool): If True prints description at multiple steps.
+        batch_index (int): Index of the first batch to generate.
 
     Returns:
         Generator objects that generates class with the observing conditions.
@@ -173,14 +229,90 @@ def get_obs_generator(param, observe_function_name, verbose):
     else:
         observe_function = None
     observing_generator = btk.create_observing_generator.generate(
-        param, observe_function)
+        param, observe_function, batch_index=batch_index)
     if verbose:
         print(f"Observing conditions generated using {observe_function_name}"
               " function defined in btk/utils.py")
     return observing_generator
 
 
-def make_draw_generator(param, user_config_dict, simulation_config_dict):
+def get_simulation_catalog(param, user_config_dict, simulation_config_dict,
+                           batch_index=0, reservoir=True):
+    """Returns catalog from which objects are simulated, with the options in
+    the config dictionaries.
+
+    Args:
+        param (class): Parameter values for btk simulations.
+        user_config_dict: Dictionary with information to run user defined
+            functions (filenames, file location of user algorithms).
+        simulation_config_dict (dict): Dictionary which sets the parameter
+            values of simulations of the blend scene.
+        batch_index (int): Index of the first batch to generate.
+        reservoir (bool): If False, the catalog reservoir options are ignored
+            and the full catalog is loaded.
+    """
+    cache_dir = user_config_dict.get('catalog_cache_dir', 'None')
+    if str(cache_dir) == 'None':
+        cache_dir = None
+    columns = simulation_config_dict.get('columns', 'None')
+    if str(columns) == 'None':
+        columns = None
+    derived_columns = simulation_config_dict.get('derived_columns', False)
+    reservoir_size = user_config_dict.get('catalog_reservoir_size', 'None')
+    if str(reservoir_size) == 'None' or not reservoir:
+        reservoir_size = None
+    refresh_batches = user_config_dict.get(
+        'catalog_reservoir_refresh_batches', 'None')
+    if str(refresh_batches) == 'None':
+        refresh_batches = None
+    return get_catalog(
+        param, str(simulation_config_dict['selection_function']),
+        param.verbose, cache_dir=cache_dir, columns=columns,
+        derived_columns=derived_columns is True,
+        reservoir_size=reservoir_size,
+        reservoir_refresh_batches=refresh_batches, batch_index=batch_index)
+
+
+def get_library_path(user_config_dict, simulation):
+    """Returns path of the galaxy library of the simulation, or None if no
+    galaxy library directory is set in user_config_dict."""
+    library_dir = user_config_dict.get('galaxy_library_dir', 'None')
+    if str(library_dir) == 'None':
+        return None
+    return os.path.join(library_dir, simulation)
+
+
+def build_library(param, user_config_dict, simulation_config_dict,
+                  simulation):
+    """Renders the galaxies of the simulation catalog and saves them in a
+    galaxy library, from which blends are assembled when btk is run.
+
+    Args:
+        param (class): Parameter values for btk simulations.
+        user_config_dict: Dictionary with information to run user defined
+            functions (filenames, file location of user algorithms).
+        simulation_config_dict (dict): Dictionary which sets the parameter
+            values of simulations of the blend scene.
+        simulation: Name of simulation to build the library of.
+    """
+    library_path = get_library_path(user_config_dict, simulation)
+    if library_path is None:
+        raise ValueError("galaxy_library_dir must be set in user_input to "
+                         "build a galaxy library")
+    # blends may be sampled from any entry of the catalog, so the library is
+    # built from the full catalog even if blends are sampled from a reservoir.
+    catalog = get_simulation_catalog(param, user_config_dict,
+                                     simulation_config_dict, reservoir=False)
+    observing_genrator = get_obs_generator(
+        param, str(simulation_config_dict['observe_function']),
+        param.verbose)
+    btk.galaxy_library.build_library(param, catalog, next(observing_genrator),
+                                     library_path)
+    print("Galaxy library saved at", library_path)
+
+
+def make_draw_generator(param, user_config_dict, simulation_config_dict,
+                        library_path=None, batch_index=0):
     """Returns a generator that yields simulations of blend scenes.
 
     Args:
@@ -189,26 +321,41 @@ def make_draw_generator(param, user_config_dict, simulation_config_dict):
             functions (filenames, file location of user algorithms).
         simulation_config_dict (dict): Dictionary which sets the parameter
             values of simulations of the blend scene.
+        library_path (str): Path of galaxy library. If a complete library
+            exists at library_path, blends are assembled from it instead of
+            being drawn (see `btk.galaxy_library`).
+        batch_index (int): Index of the first batch to generate.
 
     Returns:
         Generator objects that generates output of blend scene.
 
     """
     # Load catalog to simulate objects from
-    catalog = get_catalog(
-        param, str(simulation_config_dict['selection_function']),
-        param.verbose)
+    catalog = get_simulation_catalog(param, user_config_dict,
+                                     simulation_config_dict,
+                                     batch_index=batch_index)
     # Generate catalogs of blended objects
     blend_genrator = get_blend_generator(
         param, catalog, str(simulation_config_dict['sampling_function']),
-        param.verbose)
+        param.verbose, batch_sampling_function_name=str(
+            simulation_config_dict.get('batch_sampling_function', 'None')),
+        batch_index=batch_index)
     # Generate observing conditions
     observing_genrator = get_obs_generator(
         param, str(simulation_config_dict['observe_function']),
-        param.verbose)
+        param.verbose, batch_index=batch_index)
     # Generate images of blends in all the observing bands
+    if (library_path is not None and
+            btk.galaxy_library.is_library(library_path)):
+        library = btk.galaxy_library.Galaxy_library(library_path)
+        if param.verbose:
+            print(f"Blends assembled from galaxy library {library_path}")
+        return btk.galaxy_library.generate(param, blend_genrator,
+                                           observing_genrator, library,
+                                           batch_index=batch_index)
     draw_blend_generator = btk.draw_blends.generate(param, blend_genrator,
-                                                    observing_genrator)
+                                                    observing_genrator,
+                                                    batch_index=batch_index)
     return draw_blend_generator
 
 
@@ -363,10 +510,261 @@ def save_config_file(param, user_config_dict, simulation_config_dict,
     print("Configuration file saved at", output_name)
 
 
+def get_shard(args):
+    """Returns index and number of shards of the generate command.
+
+    The shard is set by args.shard_index and args.shard_count if input, else
+    by the rank and size of MPI-style jobs in SHARD_ENVIRONMENT_VARIABLES, and
+    else there is a single shard.
+
+    Args:
+        args: Class with parameters controlling how btk should be run.
+    """
+    shard_index = getattr(args, 'shard_index', None)
+    shard_count = getattr(args, 'shard_count', None)
+    if shard_index is None and shard_count is None:
+        for rank_name, size_name in SHARD_ENVIRONMENT_VARIABLES:
+            if rank_name in os.environ and size_name in os.environ:
+                shard_index = os.environ[rank_name]
+                shard_count = os.environ[size_name]
+                break
+        else:
+            shard_index, shard_count = 0, 1
+    if shard_index is None or shard_count is None:
+        raise ValueError("shard_index and shard_count must be input together")
+    shard_index, shard_count = int(shard_index), int(shard_count)
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("shard_index must be between 0 and shard_count: "
+                         "0 <= {0} < {1}".format(shard_index, shard_count))
+    return shard_index, shard_count
+
+
+def get_shard_batches(number_of_batches, shard_index, shard_count):
+    """Returns range of indices of the batches generated by a shard.
+
+    Batches are split in shard_count contiguous ranges that differ in length
+    by at most one batch.
+    """
+    return range(number_of_batches * shard_index // shard_count,
+                 number_of_batches * (shard_index + 1) // shard_count)
+
+
+def get_dataset_path(user_config_dict, simulation, verbose):
+    """Returns path of the directory the dataset of the simulation is
+    generated in, inside the btk output path."""
+    dataset_path = os.path.join(get_ouput_path(user_config_dict, verbose),
+                                simulation + '_dataset')
+    os.makedirs(dataset_path, exist_ok=True)
+    return dataset_path
+
+
+def get_shard_manifest_name(dataset_path, shard_index, shard_count):
+    """Returns name of the manifest file of a shard."""
+    return os.path.join(dataset_path, 'shard_{0:05d}_of_{1:05d}.json'.format(
+        shard_index, shard_count))
+
+
+def get_dataset_options(user_config_dict):
+    """Returns maximum number of blends in each chunk and whether chunks are
+    compressed for datasets written by the generate command, set by
+    dataset_chunk_size and dataset_compress in user_input."""
+    chunk_size = user_config_dict.get('dataset_chunk_size', 'None')
+    if str(chunk_size) == 'None':
+        chunk_size = DATASET_CHUNK_SIZE
+    compress = user_config_dict.get('dataset_compress', 'None')
+    if str(compress) == 'None':
+        compress = True
+    if int(chunk_size) <= 0:
+        raise ValueError("dataset_chunk_size must be positive: {0}".format(
+            chunk_size))
+    return int(chunk_size), compress is True
+
+
+def write_json(data, filename):
+    """Writes data to a json file, replacing it only once it is written so
+    that a file is never left partially written."""
+    with open(filename + '.tmp', 'w') as outfile:
+        json.dump(data, outfile, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def generate_shard(param, user_config_dict, simulation_config_dict,
+                   simulation, shard_index, shard_count):
+    """Generates the batches of a shard of the dataset of the simulation and
+    writes them to a chunked dataset in the dataset directory.
+
+    The test_size batches of the simulation are split between shard_count
+    shards (see `get_shard_batches`). Blends are seeded per blend (see
+    `btk.config.Simulation_params`), so each batch is the same whichever
+    shard generates it. Each shard writes its batches to its own
+    `btk.blend_dataset.Dataset_writer` directory, in chunks of at most
+    dataset_chunk_size blends (see `get_dataset_options`). A manifest of the
+    shard, with the number of batches added so far, is updated after each
+    batch.
+
+    If the shard was generated before but is not complete (e.g. the job
+    generating it was killed), its dataset is reopened and the shard is
+    resumed from the first blend that was not written. A shard that is
+    complete is skipped, so that the command can be run again after a job
+    was killed.
+
+    Args:
+        param (class): Parameter values for btk simulations.
+        user_config_dict: Dictionary with information to run user defined
+            functions (filenames, file location of user algorithms).
+        simulation_config_dict (dict): Dictionary which sets the parameter
+            values of simulations of the blend scene.
+        simulation: Name of simulation to generate.
+        shard_index (int): Index of the shard.
+        shard_count (int): Number of shards.
+
+    Returns:
+        dict with the manifest of the shard.
+    """
+    param.seed_per_blend = True
+    chunk_size, compress = get_dataset_options(user_config_dict)
+    number_of_batches = int(simulation_config_dict['test_size'])
+    batches = get_shard_batches(number_of_batches, shard_index, shard_count)
+    dataset_path = get_dataset_path(user_config_dict, simulation,
+                                    param.verbose)
+    manifest_name = get_shard_manifest_name(dataset_path, shard_index,
+                                            shard_count)
+    manifest = {'simulation': simulation,
+                'seed': int(param.seed),
+                'batch_size': int(param.batch_size),
+                'number_of_batches': number_of_batches,
+                'shard_index': shard_index,
+                'shard_count': shard_count,
+                'batches': [batches.start, batches.stop],
+                'directory': os.path.splitext(
+                    os.path.basename(manifest_name))[0],
+                'batches_written': 0,
+                'complete': False}
+    shard_path = os.path.join(dataset_path, manifest['directory'])
+    if os.path.isfile(manifest_name):
+        with open(manifest_name) as infile:
+            previous_manifest = json.load(infile)
+        if previous_manifest['complete']:
+            print(f"Shard {shard_index} of {shard_count} was already "
+                  f"generated at {shard_path}")
+            return previous_manifest
+    metadata_name = os.path.join(shard_path, 'metadata.json')
+    resume = os.path.isfile(metadata_name)
+    if resume:
+        with open(metadata_name) as infile:
+            # job killed after the dataset was closed.
+            if json.load(infile)['complete']:
+                manifest.update(batches_written=len(batches), complete=True)
+                write_json(manifest, manifest_name)
+                return manifest
+    write_json(manifest, manifest_name)
+    with btk.blend_dataset.Dataset_writer(
+            shard_path, param, chunk_size=chunk_size, compress=compress,
+            resume=resume) as writer:
+        # blends already written by a previous job of the shard.
+        blends_written = writer.metadata['number_of_blends']
+        first_batch = batches.start + blends_written // param.batch_size
+        start = blends_written % param.batch_size
+        manifest['batches_written'] = first_batch - batches.start
+        if resume:
+            print(f"Resuming shard {shard_index} of {shard_count} at batch "
+                  f"{first_batch}, blend {start}")
+        if first_batch < batches.stop:
+            draw_blend_generator = make_draw_generator(
+                param, user_config_dict, simulation_config_dict,
+                library_path=get_library_path(user_config_dict, simulation),
+                batch_index=first_batch)
+            for batch_index in range(first_batch, batches.stop):
+                writer.append(next(draw_blend_generator), start=start)
+                start = 0
+                manifest['batches_written'] += 1
+                write_json(manifest, manifest_name)
+                if param.verbose:
+                    print(f"Batch {batch_index} saved at {writer.path}")
+            draw_blend_generator.close()
+    manifest['complete'] = True
+    write_json(manifest, manifest_name)
+    print(f"Shard {shard_index} of {shard_count} saved at {dataset_path}")
+    return manifest
+
+
+def merge_shards(user_config_dict, simulation_config_dict, simulation,
+                 verbose):
+    """Checks that the shards of the dataset of the simulation are complete
+    and merges them into one dataset (see `btk.blend_dataset.merge_datasets`)
+    without copying them.
+
+    Args:
+        user_config_dict: Dictionary with information to run user defined
+            functions (filenames, file location of user algorithms).
+        simulation_config_dict (dict): Dictionary which sets the parameter
+            values of simulations of the blend scene.
+        simulation: Name of simulation to merge.
+        verbose (bool): If True prints description at multiple steps.
+
+    Returns:
+        dict with the manifest of the dataset.
+    """
+    dataset_path = get_dataset_path(user_config_dict, simulation, verbose)
+    number_of_batches = int(simulation_config_dict['test_size'])
+    shards = []
+    for manifest_name in sorted(glob.glob(os.path.join(dataset_path,
+                                                       'shard_*_of_*.json'))):
+        with open(manifest_name) as infile:
+            shards.append(json.load(infile))
+    if not shards:
+        raise ValueError(f"No shards found in {dataset_path}")
+    shard_counts = set(shard['shard_count'] for shard in shards)
+    if len(shard_counts) != 1:
+        raise ValueError("Shards were generated with different shard counts: "
+                         "{0}".format(sorted(shard_counts)))
+    shard_count = shard_counts.pop()
+    missing = (set(range(shard_count)) -
+               set(shard['shard_index'] for shard in shards))
+    if missing:
+        raise ValueError(f"Shards {sorted(missing)} of {shard_count} are "
+                         "missing")
+    shards = sorted(shards, key=lambda shard: shard['shard_index'])
+    for shard in shards:
+        for name in ['seed', 'batch_size', 'number_of_batches']:
+            if shard[name] != shards[0][name]:
+                raise ValueError("Shards were generated with different "
+                                 f"{name}")
+        if not shard['complete']:
+            raise ValueError(f"Shard {shard['shard_index']} is not complete")
+        batches = get_shard_batches(number_of_batches, shard['shard_index'],
+                                    shard_count)
+        if (shard['batches'] != [batches.start, batches.stop] or
+                shard['batches_written'] != len(batches)):
+            raise ValueError(f"Shard {shard['shard_index']} has "
+                             f"{shard['batches_written']} batches in "
+                             f"{shard['batches']}, expected "
+                             f"{[batches.start, batches.stop]}")
+    directories = [shard['directory'] for shard in shards
+                   if shard['batches_written'] > 0]
+    metadata = btk.blend_dataset.merge_datasets(dataset_path, directories)
+    expected = number_of_batches * shards[0]['batch_size']
+    if metadata['number_of_blends'] != expected:
+        raise ValueError(f"Dataset has {metadata['number_of_blends']} "
+                         f"blends, expected {expected}")
+    manifest = dict(shards[0], shard_count=shard_count,
+                    directories=directories)
+    for name in ['shard_index', 'batches', 'directory', 'batches_written']:
+        del manifest[name]
+    write_json(manifest, os.path.join(dataset_path, 'manifest.json'))
+    print(f"Dataset of {number_of_batches} batches verified at "
+          f"{dataset_path}")
+    return manifest
+
+
 def main(args):
     """
     Runs btk test on simulation parameters and algorithm specified in input
-    yaml config file.
+    yaml config file. If args.command is 'build_library', galaxy libraries of
+    the simulations are built instead. If args.command is 'generate', a shard
+    of the dataset of the simulations is generated (see `generate_shard`),
+    and if it is 'merge', the shards are checked and merged (see
+    `merge_shards`).
 
     Args:
         args: Class with parameters controlling how btk should be run.
@@ -384,9 +782,22 @@ def main(args):
                                  catalog_name, args.verbose)
         # Set seed
         np.random.seed(int(param.seed))
+        command = getattr(args, 'command', 'run')
+        if command == 'build_library':
+            build_library(param, user_config_dict, simulation_config_dict, s)
+            continue
+        if command == 'generate':
+            generate_shard(param, user_config_dict, simulation_config_dict, s,
+                           *get_shard(args))
+            continue
+        if command == 'merge':
+            merge_shards(user_config_dict, simulation_config_dict, s,
+                         args.verbose)
+            continue
         # Generate images of blends in all the observing bands
         draw_blend_generator = make_draw_generator(
-            param, user_config_dict, simulation_config_dict)
+            param, user_config_dict, simulation_config_dict,
+            library_path=get_library_path(user_config_dict, s))
         # Create generator for measurement algorithm outputs
         measure_generator = make_measure_generator(param, user_config_dict,
                                                    draw_blend_generator)
@@ -408,6 +819,15 @@ def main(args):
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', default='run',
+                        choices=['run', 'build_library', 'generate',
+                                 'merge'],
+                        help='run simulates blends and runs the measurement '
+                        'and metrics algorithms; build_library renders the '
+                        'catalog galaxies once into galaxy_library_dir; '
+                        'generate saves a shard of test_size batches of '
+                        'blends; merge checks that all shards were generated '
+                        '[Default:"run"]')
     parser.add_argument('--simulation', default='two_gal',
                         choices=['two_gal', 'multi_gal', 'group', 'all'],
                         help='Name of the simulation to use, taken from '
@@ -420,6 +840,13 @@ if __name__ == '__main__':
     parser.add_argument('--name', default='test_1',
                         help='Name of the btk run. Output will be stored in '
                         'a directory under this name [Default: "test1"].')
+    parser.add_argument('--shard_index', type=int, default=None,
+                        help='Index of the shard saved by generate. If not '
+                        'input, the rank of MPI-style jobs is used '
+                        '[Default: 0]')
+    parser.add_argument('--shard_count', type=int, default=None,
+                        help='Number of shards of generate. If not input, '
+                        'the size of MPI-style jobs is used [Default: 1]')
     parser.add_argument('--verbose', action='store_true',
                         help='If True prints description at multiple steps')
     args = parser.parse_args()
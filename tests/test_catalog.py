@@ -0,0 +1,301 @@
+import numpy as np
+import astropy.table
+import pytest
+import btk
+import btk.config
+
+
+@pytest.mark.timeout(5)
+def test_catalog_cache(tmpdir):
+    """Checks that catalog read from the memory-mapped column store cache is
+    identical to the catalog read from the input file."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    cache_dir = str(tmpdir.join('cache'))
+    for i in range(2):
+        # first load writes the cache, second load reads from it.
+        cached_catalog = btk.get_input_catalog.load_catalog(
+            param, cache_dir=cache_dir)
+        assert cached_catalog.colnames == catalog.colnames, "Cached catalog "\
+            "must have the same columns as the input catalog"
+        for name in catalog.colnames:
+            np.testing.assert_array_equal(
+                cached_catalog[name], catalog[name],
+                err_msg=f"Cached column {name} does not match input catalog")
+    assert len(tmpdir.join('cache').listdir()) == 1, "Catalog must be cached "\
+        "only once"
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_catalog_columns(tmpdir):
+    """Checks that only the input columns are loaded from the catalog, and
+    that missing columns are reported before the catalog is read."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    columns = btk.get_input_catalog.get_required_columns(param)
+    for cache_dir in [None, str(tmpdir)]:
+        projected_catalog = btk.get_input_catalog.load_catalog(
+            param, cache_dir=cache_dir, columns=columns)
+        assert projected_catalog.colnames == columns, "Loaded catalog must "\
+            f"have columns {columns}, found {projected_catalog.colnames}"
+        for name in columns:
+            np.testing.assert_array_equal(
+                projected_catalog[name], catalog[name],
+                err_msg=f"Column {name} does not match input catalog")
+        with pytest.raises(KeyError):
+            btk.get_input_catalog.load_catalog(
+                param, cache_dir=cache_dir, columns=columns + ['e1'])
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_derived_columns(tmpdir):
+    """Checks that precomputed derived columns match the values computed from
+    the catalog parameters, and that they are saved in the catalog cache."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    get_functions = btk.get_input_catalog.DERIVED_COLUMNS
+    for cache_dir in [None, str(tmpdir)]:
+        derived_catalog = btk.get_input_catalog.load_catalog(
+            param, cache_dir=cache_dir, derived_columns=True)
+        for name, get_column in get_functions:
+            np.testing.assert_array_equal(
+                derived_catalog[name], get_column(catalog),
+                err_msg=f"Derived column {name} has incorrect values")
+    cached_catalog = btk.get_input_catalog.load_catalog(
+        param, cache_dir=str(tmpdir))
+    for name, _ in get_functions:
+        assert name in cached_catalog.colnames, f"Derived column {name} "\
+            "must be saved in catalog cache"
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_sampling_index():
+    """Checks that rows selected with the sampling index are the same as
+    those selected by cuts on the full catalog."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    sampling_index = btk.create_blend_generator.Sampling_index(catalog)
+    a = np.hypot(catalog['a_d'], catalog['a_b'])
+    sampling_index.set_mask('size', a <= 1)
+    for max_mag in [23, 24, 25.3, 28]:
+        q, = np.where(catalog['i_ab'] <= max_mag)
+        np.testing.assert_array_equal(
+            sampling_index.get_rows(max_mag), q,
+            err_msg=f"Incorrect rows selected for i_ab <= {max_mag}")
+        q, = np.where((catalog['i_ab'] < max_mag) & (a <= 1))
+        np.testing.assert_array_equal(
+            sampling_index.get_rows(max_mag, inclusive=False, mask='size'), q,
+            err_msg=f"Incorrect rows selected for i_ab < {max_mag} & a <= 1")
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_custom_catalog():
+    """Checks that blends are sampled with a custom sampling function from a
+    catalog without the magnitude column of the sampling index."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, max_number=2)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    catalog.remove_column('i_ab')
+
+    def sampling_function(Args, catalog):
+        blend_catalog = catalog[np.random.choice(len(catalog), size=2)]
+        blend_catalog['ra'], blend_catalog['dec'] = 0., 0.
+        return blend_catalog
+    np.random.seed(param.seed)
+    blend_generator = btk.create_blend_generator.generate(
+        param, catalog, sampling_function=sampling_function)
+    blend_list = next(blend_generator)
+    assert len(blend_list) == param.batch_size
+    assert 'i_ab' not in blend_list[0].colnames
+    assert btk.create_blend_generator.get_sampling_index(catalog) is None, \
+        "No sampling index must be built without the magnitude column"
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_batch_sampling():
+    """Checks that batch sampling returns batch_size blend catalogs that
+    satisfy the same cuts as the per blend sampling function."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, max_number=6,
+                                         batch_size=32)
+    np.random.seed(param.seed)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    blend_generator = btk.create_blend_generator.generate(
+        param, catalog,
+        batch_sampling_function=btk.utils.basic_batch_sampling_function)
+    blend_list = next(blend_generator)
+    assert len(blend_list) == 32, "Batch must have 32 blend catalogs"
+    for blend_catalog in blend_list:
+        assert 1 <= len(blend_catalog) <= 6, "Blend must have between 1 and "\
+            f"max_number objects, found {len(blend_catalog)}"
+        assert blend_catalog['i_ab'][0] <= 24, "First object in blend must "\
+            "be brighter than 24 mag"
+        a = np.hypot(blend_catalog['a_d'], blend_catalog['a_b'])
+        assert np.all((a <= 2) & (a > 0.2)), "Sampled objects must satisfy "\
+            "size cut"
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_group_index():
+    """Checks that group members and catalog rows found with the group index
+    are the same as those selected by masks on the catalogs."""
+    catalog_name = 'data/sample_group_input_catalog.fits'
+    param = btk.config.Simulation_params(
+        catalog_name, wld_catalog_name='data/sample_group_catalog.fits')
+    catalog = btk.get_input_catalog.load_catalog(param)
+    wld_catalog = astropy.table.Table.read(param.wld_catalog_name,
+                                           format='fits')
+    group_index = btk.utils.get_group_index(param, catalog)
+    for group_id in group_index.group_ids:
+        ids = wld_catalog['db_id'][wld_catalog['grp_id'] == group_id]
+        np.testing.assert_array_equal(group_index.get_members(group_id), ids)
+        rows = np.concatenate([np.where(catalog['galtileid'] == i)[0]
+                               for i in ids])
+        np.testing.assert_array_equal(group_index.get_rows(ids), rows)
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_sky_sampling():
+    """Checks that galaxies sampled around a position on the sky lie within
+    the postage stamp and keep their relative separations."""
+    catalog_name = 'data/sample_group_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, max_number=6)
+    np.random.seed(param.seed)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    blend_generator = btk.create_blend_generator.generate(
+        param, catalog, btk.utils.sky_sampling_function)
+    for blend_catalog in next(blend_generator):
+        assert 1 <= len(blend_catalog) <= 6, "Blend must have between 1 and "\
+            f"max_number objects, found {len(blend_catalog)}"
+        assert np.all(np.abs(blend_catalog['ra']) < param.stamp_size / 2.)
+        assert np.all(np.abs(blend_catalog['dec']) < param.stamp_size / 2.)
+        rows = [np.where(catalog['galtileid'] == i)[0][0]
+                for i in blend_catalog['galtileid']]
+        sky = btk.utils.get_unit_vectors(catalog['ra'][rows],
+                                         catalog['dec'][rows])
+        chord = np.linalg.norm(sky - sky[0], axis=1)
+        sky_dist = np.degrees(2 * np.arcsin(chord / 2)) * 3600
+        dist = np.hypot(blend_catalog['ra'] - blend_catalog['ra'][0],
+                        blend_catalog['dec'] - blend_catalog['dec'][0])
+        np.testing.assert_array_almost_equal(
+            dist, sky_dist, decimal=3,
+            err_msg="Separations in blend must match those on the sky")
+    pass
+
+
+@pytest.mark.timeout(10)
+def test_catalog_reservoir():
+    """Checks that the catalog sample streamed in chunks has the requested
+    size, satisfies the selection cuts and has no repeated entries."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name)
+    catalog = btk.get_input_catalog.load_catalog(
+        param, selection_function=btk.utils.basic_selection_function)
+    for size in [20, 1000]:
+        reservoir = btk.get_input_catalog.Catalog_reservoir(
+            param, size, chunk_size=7,
+            selection_function=btk.utils.basic_selection_function)
+        sample = reservoir.catalog
+        assert len(sample) == min(size, len(catalog)), "Incorrect number of "\
+            f"sampled entries: {len(sample)}"
+        assert len(np.unique(sample['galtileid'])) == len(sample), "Sampled "\
+            "entries must not be repeated"
+        assert np.all(np.isin(sample['galtileid'], catalog['galtileid'])), \
+            "Sampled entries must satisfy the selection cuts"
+    np.random.seed(param.seed)
+    blend_generator = btk.create_blend_generator.generate(param, reservoir)
+    for blend_catalog in next(blend_generator):
+        assert np.all(np.isin(blend_catalog['galtileid'],
+                              sample['galtileid'])), "Blends must be sampled "\
+            "from the catalog sample"
+    with pytest.raises(ValueError):
+        btk.get_input_catalog.Catalog_reservoir(
+            param, 20, selection_function=lambda catalog: catalog[:0])
+    pass
+
+
+@pytest.mark.timeout(10)
+def test_catalog_reservoir_refresh():
+    """Checks that catalog samples are replaced every refresh_batches batches
+    with samples that only depend on the seed and the batch."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name)
+    reservoir = btk.get_input_catalog.Catalog_reservoir(
+        param, 20, chunk_size=7, refresh_batches=2)
+    samples = [reservoir.get_catalog(batch_index)
+               for batch_index in range(5)]
+    assert samples[0] is samples[1] and samples[2] is samples[3]
+    assert reservoir.version == 2
+    assert not np.array_equal(samples[0]['galtileid'],
+                              samples[2]['galtileid'])
+    reservoir.stop()
+    other_reservoir = btk.get_input_catalog.Catalog_reservoir(
+        param, 20, chunk_size=7, refresh_batches=2)
+    np.testing.assert_array_equal(
+        other_reservoir.get_catalog(4)['galtileid'], samples[4]['galtileid'])
+    other_reservoir.stop()
+    # generation resumed at batch 4 starts with the sample of that batch.
+    resumed_reservoir = btk.get_input_catalog.Catalog_reservoir(
+        param, 20, chunk_size=7, refresh_batches=2, batch_index=4)
+    assert resumed_reservoir.version == 2
+    np.testing.assert_array_equal(resumed_reservoir.catalog['galtileid'],
+                                  samples[4]['galtileid'])
+    assert resumed_reservoir.get_catalog(4) is resumed_reservoir.catalog
+    assert resumed_reservoir._next is None, "No sample must be prefetched "\
+        "before the first batch is drawn"
+    resumed_reservoir.get_catalog(5)
+    assert resumed_reservoir._next[0] == 3, "Next sample must be prefetched"
+    resumed_reservoir.stop()
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_multi_catalog(tmpdir):
+    """Checks that blends sampled from a star and a galaxy catalog have entries
+    of both types with the values of the input catalogs."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    galaxies = astropy.table.Table.read(catalog_name, format='fits')
+    stars = astropy.table.Table()
+    stars['galtileid'] = np.arange(100) + 1e12
+    stars['ra'] = np.zeros(100)
+    stars['dec'] = np.zeros(100)
+    for band in ['u', 'g', 'r', 'i', 'z', 'y']:
+        stars[band + '_ab'] = np.linspace(18, 26, 100)
+    star_catalog_name = str(tmpdir.join('stars.fits'))
+    stars.write(star_catalog_name, format='fits')
+    param = btk.config.Simulation_params(
+        {'galaxy': catalog_name, 'star': star_catalog_name}, max_number=6,
+        batch_size=32)
+    np.random.seed(param.seed)
+    catalog = btk.get_input_catalog.load_catalog(
+        param, selection_function={'galaxy':
+                                   btk.utils.basic_selection_function})
+    assert catalog.types == ['galaxy', 'star']
+    assert len(catalog) == len(catalog['galaxy']) + 100
+    sampling_function = btk.utils.multi_catalog_batch_sampling_function
+    blend_generator = btk.create_blend_generator.generate(
+        param, catalog, batch_sampling_function=sampling_function)
+    blend_list = next(blend_generator)
+    batch_catalog = astropy.table.vstack(blend_list)
+    for name, table in [('galaxy', galaxies), ('star', stars)]:
+        entries = batch_catalog[batch_catalog['btk_type'] == name]
+        assert len(entries) > 0, f"Blends must have entries of type {name}"
+        for entry in entries:
+            row, = np.where(table['galtileid'] == entry['galtileid'])
+            assert entry['i_ab'] == table['i_ab'][row[0]], "Sampled entry "\
+                "must have the values of the input catalog"
+            if name == 'star':
+                assert entry['fluxnorm_disk'] == 0, "Columns missing from "\
+                    "the input catalog must be zero"
+    pass
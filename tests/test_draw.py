@@ -3,6 +3,12 @@ import pytest
 import btk
 import btk.config
 import multiprocessing as mp
+import copy
+import descwl
+import os
+import tempfile
+import warnings
+import galsim
 
 
 def get_draw_generator(batch_size=8, cpus=1,
@@ -99,3 +105,754 @@ def test_multi_processing():
     np.testing.assert_array_equal(parallel_im['isolated_images'],
                                   serial_im['isolated_images'])
     pass
+
+
+@pytest.mark.timeout(15)
+def test_persistent_pool():
+    """Checks that images drawn in several batches by the same worker pool
+    match those drawn serially, and that the pool is shut down when the
+    generator is closed."""
+    parallel_im_gen = get_draw_generator(8, 2, multiprocessing=True,
+                                         add_noise=False)
+    parallel_im = [next(parallel_im_gen) for i in range(2)]
+    parallel_im_gen.close()
+    assert mp.active_children() == [], "Worker pool must be shut down"
+    serial_im_gen = get_draw_generator(8, 2, multiprocessing=False,
+                                       add_noise=False)
+    for parallel_output in parallel_im:
+        serial_output = next(serial_im_gen)
+        np.testing.assert_array_equal(parallel_output['blend_images'],
+                                      serial_output['blend_images'])
+        np.testing.assert_array_equal(parallel_output['isolated_images'],
+                                      serial_output['isolated_images'])
+    pass
+
+
+@pytest.mark.timeout(30)
+def test_pool_noise():
+    """Checks that the noise drawn by the worker pool is different in each
+    mini-batch and batch, and is reproduced from the seed."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, batch_size=4,
+                                         max_number=1)
+
+    def fixed_sampling_function(Args, catalog):
+        blend_catalog = catalog[catalog['i_ab'] < 23][0:1]
+        blend_catalog['ra'], blend_catalog['dec'] = 0., 0.
+        return blend_catalog
+
+    def get_noise():
+        np.random.seed(param.seed)
+        catalog = btk.get_input_catalog.load_catalog(param)
+        draw_generator = btk.draw_blends.generate(
+            param, btk.create_blend_generator.generate(
+                param, catalog, fixed_sampling_function),
+            btk.create_observing_generator.generate(param),
+            multiprocessing=True, cpus=2)
+        outputs = [next(draw_generator) for _ in range(2)]
+        draw_generator.close()
+        return np.concatenate([output['blend_images'] -
+                               output['isolated_images'].sum(axis=1)
+                               for output in outputs])
+    noise = get_noise()
+    for i in range(len(noise)):
+        for j in range(i):
+            assert not np.array_equal(noise[i], noise[j]), "Blends must "\
+                f"have different noise: {i}, {j}"
+    np.testing.assert_array_equal(get_noise(), noise)
+    pass
+
+
+@pytest.mark.timeout(30)
+def test_shared_images(monkeypatch):
+    """Checks that images written by the workers to shared memory match those
+    drawn serially, that the shared memory is released when the generator is
+    closed, and that images are sent back to the main process when shared
+    memory is not available. The workers must close their shared memory
+    blocks when they exit."""
+    serial_im_gen = get_draw_generator(8, 2, multiprocessing=False,
+                                       add_noise=False)
+    serial_im = [next(serial_im_gen) for i in range(2)]
+    create_shared_images = btk.draw_blends.create_shared_images
+    shared_image_names = []
+
+    def recording_create_shared_images(Args):
+        shared_images = create_shared_images(Args)
+        if shared_images is not None:
+            shared_image_names.extend(block.name for block in shared_images)
+        return shared_images
+    monkeypatch.setattr(btk.draw_blends, 'create_shared_images',
+                        recording_create_shared_images)
+    close_worker_shared_images = btk.draw_blends.close_worker_shared_images
+    closed_workers = mp.Value('i', 0)
+
+    def counting_close_worker_shared_images():
+        close_worker_shared_images()
+        with closed_workers.get_lock():
+            closed_workers.value += 1
+    monkeypatch.setattr(btk.draw_blends, 'close_worker_shared_images',
+                        counting_close_worker_shared_images)
+    for shared_memory in [btk.draw_blends.shared_memory, None]:
+        if shared_memory is None:
+            monkeypatch.setattr(btk.draw_blends, 'shared_memory', None)
+        elif btk.draw_blends.shared_memory is None:
+            continue
+        parallel_im_gen = get_draw_generator(8, 2, multiprocessing=True,
+                                             add_noise=False)
+        for serial_output in serial_im:
+            parallel_output = next(parallel_im_gen)
+            np.testing.assert_array_equal(parallel_output['blend_images'],
+                                          serial_output['blend_images'])
+            np.testing.assert_array_equal(parallel_output['isolated_images'],
+                                          serial_output['isolated_images'])
+        parallel_im_gen.close()
+        if shared_memory is not None:
+            assert len(shared_image_names) == 2
+            for name in shared_image_names:
+                with pytest.raises(FileNotFoundError):
+                    shared_memory.SharedMemory(name=name)
+            if mp.get_start_method() == 'fork':
+                assert closed_workers.value > 0, "Workers must close the "\
+                    "shared memory blocks"
+        else:
+            assert len(shared_image_names) == 2, "Shared memory must not "\
+                "be used if it is not available"
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_blend_batch():
+    """Checks that blend catalogs are unchanged when converted to and from a
+    Blend_batch, and that fields written to the batch are seen in each blend.
+    """
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, max_number=4)
+    np.random.seed(param.seed)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    blend_generator = btk.create_blend_generator.generate(param, catalog)
+    blend_list = next(blend_generator)
+    # the batch built from the sampled tables is drawn as is.
+    assert not blend_list.is_accessed()
+    assert btk.blend_batch.Blend_batch.from_tables(blend_list).data.dtype == \
+        blend_list.blend_batch.data.dtype
+    blend_batch = btk.blend_batch.Blend_batch.from_tables(
+        blend_list, fields=[('dx', np.float64)])
+    assert len(blend_batch) == len(blend_list), "Blend_batch must have one "\
+        "entry per blend"
+    blend_batch.data['dx'] = np.arange(len(blend_batch.data))
+    for i, table in enumerate(blend_batch.to_tables()):
+        assert len(table) == len(blend_list[i]), "Incorrect number of objects"
+        for name in blend_list[i].colnames:
+            np.testing.assert_array_equal(table[name], blend_list[i][name])
+        np.testing.assert_array_equal(
+            table['dx'], blend_batch.data['dx'][blend_batch.blend_index == i])
+    # blends sampled for the whole batch are not split into tables.
+    blend_generator = btk.create_blend_generator.generate(
+        param, catalog,
+        batch_sampling_function=btk.create_blend_generator.
+        default_batch_sampling)
+    blend_list = next(blend_generator)
+    blend_batch = btk.blend_batch.Blend_batch.from_tables(
+        blend_list, fields=[('dx', np.float64)])
+    assert blend_list._tables == [None] * len(blend_list)
+    np.testing.assert_array_equal(blend_batch.data['galtileid'],
+                                  blend_list.blend_batch.data['galtileid'])
+    np.testing.assert_array_equal(blend_list[-1]['galtileid'],
+                                  blend_batch[len(blend_batch) - 1][
+                                      'galtileid'])
+    assert [len(table) for table in blend_list[:2]] == list(
+        blend_batch.number_of_objects[:2])
+    pass
+
+
+@pytest.mark.timeout(10)
+def test_blend_list_edits():
+    """Checks that changes made to the yielded blend catalogs are drawn."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, batch_size=4,
+                                         add_noise=False)
+    np.random.seed(param.seed)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    blend_generator = btk.create_blend_generator.generate(
+        param, catalog,
+        batch_sampling_function=btk.create_blend_generator.
+        default_batch_sampling)
+    edited_ra = []
+
+    def edit_blends():
+        for blend_list in blend_generator:
+            for table in blend_list:
+                table['ra'] += 5.
+                table['mine'] = np.arange(len(table))
+            edited_ra.append(np.concatenate([table['ra']
+                                             for table in blend_list]))
+            yield blend_list
+    observing_generator = btk.create_observing_generator.generate(param)
+    draw_generator = btk.draw_blends.generate(param, edit_blends(),
+                                              observing_generator)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        draw_output = next(draw_generator)
+    blend_batch = draw_output['blend_batch']
+    np.testing.assert_array_equal(blend_batch.data['ra'], edited_ra[0])
+    np.testing.assert_array_equal(
+        blend_batch.data['mine'],
+        np.arange(len(blend_batch.data)) - blend_batch.offsets[
+            blend_batch.blend_index])
+    for table in draw_output['blend_list']:
+        assert 'mine' in table.colnames, "Added column must be drawn"
+
+
+@pytest.mark.timeout(5)
+def test_survey_cache():
+    """Checks that surveys are built once for the same observing conditions
+    and rebuilt for observing conditions that vary per batch."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name)
+    observing_generator = btk.create_observing_generator.generate(param)
+    first, second = next(observing_generator), next(observing_generator)
+    for band, survey, cached_survey in zip(param.bands, first, second):
+        assert survey is cached_survey, "Default survey must be reused"
+        assert survey.filter_band == band
+    exposure_time = iter([1000., 1000., 2000.])
+
+    def obs_function(Args, band):
+        survey = btk.create_observing_generator.default_obs_conditions(
+            Args, band)
+        survey['exposure_time'] = next(exposure_time)
+        return survey
+    param.bands = ('i',)
+    observing_generator = btk.create_observing_generator.generate(
+        param, obs_function)
+    surveys = [next(observing_generator)[0] for i in range(3)]
+    assert surveys[0] is surveys[1], "Survey must be reused for the same "\
+        "observing conditions"
+    assert surveys[2].exposure_time == 2000., "Survey must be rebuilt for "\
+        "new observing conditions"
+    obs_function.varies_per_batch = True
+    exposure_time = iter([1000., 1000.])
+    observing_generator = btk.create_observing_generator.generate(
+        param, obs_function)
+    assert next(observing_generator)[0] is not \
+        next(observing_generator)[0], "Survey must be rebuilt for each batch"
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_psf_artifacts():
+    """Checks that cached PSF quantities match those computed from the PSF
+    model and are shared by copies of the observing conditions."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name)
+    obs_cond = next(btk.create_observing_generator.generate(param))[3]
+    psf_artifacts = btk.create_observing_generator.get_psf_artifacts(
+        obs_cond)
+    np.testing.assert_almost_equal(
+        psf_artifacts.moment_radius,
+        obs_cond.psf_model.calculateMomentRadius())
+    np.testing.assert_array_equal(
+        psf_artifacts.get_stamp(41),
+        obs_cond.psf_model.drawImage(scale=obs_cond.pixel_scale, nx=41,
+                                     ny=41).array)
+    assert psf_artifacts.sky_rms == obs_cond.mean_sky_level**0.5
+    copied_obs_cond = copy.deepcopy(obs_cond)
+    assert btk.create_observing_generator.get_psf_artifacts(
+        copied_obs_cond) is psf_artifacts, "PSF artifacts must be shared "\
+        "by copies of the observing conditions"
+    pass
+
+
+@pytest.mark.timeout(10)
+def test_obs_grid():
+    """Checks that each blend is drawn with observing conditions at the grid
+    node nearest to its sampled conditions, and that interpolated PSF stamps
+    lie between those at the grid nodes."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, batch_size=4)
+    np.random.seed(param.seed)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    obs_grid = btk.create_observing_generator.Obs_grid(
+        param, fwhm_scale=[0.8, 1., 1.2])
+    blend_generator = btk.create_blend_generator.generate(param, catalog)
+    observing_generator = btk.create_observing_generator.generate(
+        param, obs_grid=obs_grid)
+    draw_generator = btk.draw_blends.generate(param, blend_generator,
+                                              observing_generator)
+    draw_output = next(draw_generator)
+    assert len(draw_output['obs_condition']) == 4
+    for obs_cond in draw_output['obs_condition']:
+        assert [survey.filter_band for survey in obs_cond] == \
+            list(param.bands)
+        assert any(survey is obs_cond[3] for survey in
+                   obs_grid.surveys.values()), "Blend must be drawn with "\
+            "observing conditions from the grid"
+    surveys = obs_grid.get_surveys({'fwhm_scale': [0.85, 1.15],
+                                    'sky_offset': [0, 0],
+                                    'exposure_scale': [1, 1]})
+    assert surveys[0][3] is obs_grid.surveys[('i', 0, 0, 0)]
+    assert surveys[1][3] is obs_grid.surveys[('i', 2, 0, 0)]
+    stamps = [obs_grid.get_psf_stamp('i', scale, 41)
+              for scale in [0.8, 0.9, 1.]]
+    np.testing.assert_array_almost_equal(stamps[1],
+                                         (stamps[0] + stamps[2]) / 2)
+    pass
+
+
+@pytest.mark.timeout(5)
+def test_render_engine():
+    """Checks that galaxies are drawn without modifying the observing
+    conditions, and that isolated images sum to the noiseless blend image."""
+    draw_generator = get_draw_generator(4, add_noise=False)
+    draw_output = next(draw_generator)
+    for obs_cond in draw_output['obs_condition'][0]:
+        assert not obs_cond.image.array.any(), "Drawing must not modify the "\
+            "observing conditions"
+    np.testing.assert_array_almost_equal(
+        draw_output['isolated_images'].sum(axis=1),
+        draw_output['blend_images'])
+    pass
+
+
+@pytest.mark.timeout(10)
+def test_footprint():
+    """Checks that only the footprint of the previous galaxy is reset when
+    galaxies are drawn one after the other with the same render engine."""
+    image = np.zeros((5, 6))
+    assert btk.draw_blends.get_footprint(image) is None
+    image[1, 4], image[3, 2] = 1., 2.
+    assert btk.draw_blends.get_footprint(image) == (slice(1, 4), slice(2, 5))
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, add_noise=False)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    catalog = catalog[catalog['i_ab'] < 23][0:2]
+    obs_cond = btk.create_observing_generator.default_obs_conditions(
+        param, 'r')
+    survey = btk.create_observing_generator.get_survey(param, 'r', obs_cond)
+    galaxy_builder = descwl.model.GalaxyBuilder(
+        survey, no_disk=False, no_bulge=False, no_agn=False,
+        verbose_model=False)
+    shared_engine = btk.draw_blends.get_render_engine(param, survey)
+    for entry, dx in zip(catalog, [-2., 2.]):
+        galaxy = galaxy_builder.from_catalog(entry, dx, 0., 'r')
+        image = btk.draw_blends.draw_isolated(param, galaxy, shared_engine)
+        expected = btk.draw_blends.draw_isolated(
+            param, galaxy, btk.draw_blends.get_render_engine(param, survey))
+        np.testing.assert_array_equal(image.array, expected.array)
+        footprint = shared_engine.btk_footprint
+        assert image.btk_bounds is not None
+        assert footprint == image.get_footprint()
+        outside = image.array.copy()
+        outside[footprint] = 0
+        assert not outside.any()
+    footprint_image = btk.draw_blends.Footprint_image(np.zeros((5, 6)))
+    footprint_image[galsim.BoundsI(3, 4, 2, 2)] += galsim.Image(
+        np.ones((1, 2)), xmin=3, ymin=2)
+    assert footprint_image.get_footprint() == (slice(1, 2), slice(2, 4))
+    pass
+
+
+@pytest.mark.timeout(30)
+def test_stamp_cache():
+    """Checks that images of a galaxy drawn from the stamp cache at integer
+    pixel shifts match the rendered images, and that they are the same with
+    multiprocessing."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, batch_size=4,
+                                         max_number=1, add_noise=False)
+    catalog = btk.get_input_catalog.load_catalog(param)
+
+    def shifted_sampling_function(Args, catalog):
+        blend_catalog = catalog[catalog['i_ab'] < 23][0:1]
+        shift = np.random.randint(-5, 6) * Args.pixel_scale
+        # centers at multiples of 1/10 pixel are not rounded by the cache.
+        blend_catalog['ra'], blend_catalog['dec'] = shift + 0.02, -0.04
+        return blend_catalog
+    outputs = []
+    for stamp_cache, multiprocessing in [
+            (btk.draw_blends.Stamp_cache(), True), (None, False),
+            (btk.draw_blends.Stamp_cache(), False)]:
+        np.random.seed(param.seed)
+        blend_generator = btk.create_blend_generator.generate(
+            param, catalog, shifted_sampling_function)
+        observing_generator = btk.create_observing_generator.generate(param)
+        draw_generator = btk.draw_blends.generate(
+            param, blend_generator, observing_generator,
+            multiprocessing=multiprocessing, cpus=2, stamp_cache=stamp_cache)
+        outputs.append(next(draw_generator))
+        draw_generator.close()
+    np.testing.assert_array_equal(outputs[0]['isolated_images'],
+                                  outputs[2]['isolated_images'])
+    outputs = outputs[1:]
+    assert stamp_cache.misses == len(param.bands), "Galaxy must be rendered "\
+        "once in each band"
+    assert stamp_cache.hits == 3 * len(param.bands)
+    np.testing.assert_array_almost_equal(outputs[0]['isolated_images'],
+                                         outputs[1]['isolated_images'])
+    np.testing.assert_array_almost_equal(outputs[0]['blend_images'],
+                                         outputs[1]['blend_images'])
+    entry = outputs[1]['blend_batch'].data[0].copy()
+    entry['galtileid'] = 0
+    assert stamp_cache.get_key(entry, 'i', outputs[1]['obs_condition'][0][
+        3]) is None, "Galaxies without galtileid must not be cached"
+    pass
+
+
+@pytest.mark.timeout(15)
+def test_galaxy_library(tmpdir):
+    """Checks that blends assembled from the galaxy library match the blends
+    drawn with descwl."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, batch_size=4,
+                                         max_number=3, add_noise=False)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    catalog = catalog[catalog['i_ab'] < 24][:20]
+    obs_cond = next(btk.create_observing_generator.generate(param))
+    library_path = os.path.join(str(tmpdir), 'library')
+    # directory left by an interrupted build.
+    os.makedirs(library_path)
+    assert not btk.galaxy_library.is_library(library_path)
+    library = btk.galaxy_library.build_library(param, catalog, obs_cond,
+                                               library_path)
+    assert btk.galaxy_library.is_library(library_path)
+    assert not os.path.exists(library_path + '.tmp')
+    other_param = copy.deepcopy(param)
+    other_param.catalog_name = 'data/other_catalog.fits'
+    with pytest.raises(ValueError):
+        library.check_parameters(other_param, obs_cond)
+
+    def shifted_sampling_function(Args, catalog):
+        number_of_objects = np.random.randint(1, Args.max_number + 1)
+        blend_catalog = catalog[np.random.choice(len(catalog),
+                                                 number_of_objects)]
+        for name in ['ra', 'dec']:
+            blend_catalog[name] = np.random.randint(
+                -8, 9, size=number_of_objects) * Args.pixel_scale
+        return blend_catalog
+    outputs = []
+    for draw_generate in [btk.draw_blends.generate,
+                          btk.galaxy_library.generate]:
+        np.random.seed(param.seed)
+        blend_generator = btk.create_blend_generator.generate(
+            param, catalog, shifted_sampling_function)
+        observing_generator = btk.create_observing_generator.generate(param)
+        args = (param, blend_generator, observing_generator)
+        if draw_generate is btk.galaxy_library.generate:
+            args += (library,)
+        outputs.append(next(draw_generate(*args)))
+    for name in ['blend_images', 'isolated_images']:
+        np.testing.assert_allclose(
+            outputs[1][name], outputs[0][name],
+            atol=1e-3 * outputs[0][name].max(),
+            err_msg=f"Assembled {name} do not match drawn {name}")
+    pass
+
+
+@pytest.mark.timeout(15)
+def test_galaxy_library_subpixel(tmpdir):
+    """Checks that blends assembled from the galaxy library with sub-pixel
+    Fourier shifts match the blends drawn with descwl, to 1% of the peak
+    pixel value and 0.1% of the total flux, for galaxies up to 40 pixels off
+    the stamp center, and that shifted flux does not wrap around the stamp
+    edges."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, batch_size=4,
+                                         max_number=3, add_noise=False)
+    catalog = btk.get_input_catalog.load_catalog(param)
+    catalog = catalog[catalog['i_ab'] < 24][:20]
+    obs_cond = next(btk.create_observing_generator.generate(param))
+    library = btk.galaxy_library.build_library(
+        param, catalog, obs_cond, os.path.join(str(tmpdir), 'library'))
+
+    def subpixel_sampling_function(Args, catalog):
+        number_of_objects = np.random.randint(1, Args.max_number + 1)
+        blend_catalog = catalog[np.random.choice(len(catalog),
+                                                 number_of_objects)]
+        for name in ['ra', 'dec']:
+            blend_catalog[name] = np.random.uniform(
+                -40, 40, size=number_of_objects) * Args.pixel_scale
+        return blend_catalog
+    outputs = []
+    for draw_generate in [btk.draw_blends.generate,
+                          btk.galaxy_library.generate]:
+        np.random.seed(param.seed)
+        blend_generator = btk.create_blend_generator.generate(
+            param, catalog, subpixel_sampling_function)
+        observing_generator = btk.create_observing_generator.generate(param)
+        args = (param, blend_generator, observing_generator)
+        if draw_generate is btk.galaxy_library.generate:
+            args += (library,)
+        outputs.append(next(draw_generate(*args)))
+    data = outputs[1]['blend_batch'].data
+    center = library.metadata['center']
+    assert np.all((data['dx'] - center) % 1 != 0)
+    for name in ['blend_images', 'isolated_images']:
+        np.testing.assert_allclose(
+            outputs[1][name], outputs[0][name],
+            atol=1e-2 * outputs[0][name].max(),
+            err_msg=f"Assembled {name} do not match drawn {name}")
+        np.testing.assert_allclose(outputs[1][name].sum(),
+                                   outputs[0][name].sum(), rtol=1e-3)
+    # flux shifted past the right edge of a stamp is kept in the padding.
+    images = np.random.uniform(size=(1, 20, 20, 1))
+    shifted = btk.galaxy_library.shift_images(images, np.array([1.]),
+                                              np.array([0.]), pad=5)
+    assert shifted.shape == (1, 30, 30, 1)
+    np.testing.assert_allclose(shifted[0, 5:25, 6:26], images[0], atol=1e-12)
+    assert np.abs(shifted[0, :, :6]).max() < 1e-12, \
+        "Shifted flux must not wrap around the stamp"
+    pass
+
+
+@pytest.mark.timeout(15)
+def test_band_group():
+    """Checks that galaxies rendered once for bands with the same PSF and
+    scaled by the flux in each band match galaxies rendered in each band."""
+    catalog_name = 'data/sample_input_catalog.fits'
+
+    def same_psf_obs_function(Args, band):
+        survey = btk.create_observing_generator.default_obs_conditions(
+            Args, band)
+        survey['zenith_psf_fwhm'] = 0.7
+        return survey
+    outputs = []
+    for psf_tolerance in [None, 0.]:
+        param = btk.config.Simulation_params(catalog_name, batch_size=4,
+                                             add_noise=False,
+                                             psf_tolerance=psf_tolerance)
+        np.random.seed(param.seed)
+        catalog = btk.get_input_catalog.load_catalog(param)
+        blend_generator = btk.create_blend_generator.generate(param, catalog)
+        observing_generator = btk.create_observing_generator.generate(
+            param, same_psf_obs_function)
+        draw_generator = btk.draw_blends.generate(param, blend_generator,
+                                                  observing_generator)
+        outputs.append(next(draw_generator))
+    obs_cond = outputs[1]['obs_condition'][0]
+    assert btk.draw_blends.get_band_groups(param, obs_cond) == \
+        [list(range(len(param.bands)))], "Bands with the same PSF must be "\
+        "drawn together"
+    for name in ['blend_images', 'isolated_images']:
+        np.testing.assert_allclose(
+            outputs[1][name], outputs[0][name],
+            atol=1e-5 * outputs[0][name].max(),
+            err_msg=f"{name} drawn together do not match those drawn in "
+            "each band")
+    for blend_list in zip(outputs[0]['blend_list'], outputs[1]['blend_list']):
+        for band in param.bands:
+            np.testing.assert_array_equal(
+                blend_list[0]['not_drawn_' + band],
+                blend_list[1]['not_drawn_' + band])
+    pass
+
+
+@pytest.mark.timeout(10)
+def test_batch_noise():
+    """Checks that with batch_noise the noiseless blend images are output
+    and noise is drawn for the whole batch."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    outputs = []
+    for add_noise in [False, True]:
+        np.random.seed(0)
+        param = btk.config.Simulation_params(catalog_name, batch_size=4,
+                                             add_noise=add_noise,
+                                             batch_noise=True)
+        catalog = btk.get_input_catalog.load_catalog(param)
+        blend_generator = btk.create_blend_generator.generate(param, catalog)
+        observing_generator = btk.create_observing_generator.generate(param)
+        draw_generator = btk.draw_blends.generate(
+            param, blend_generator, observing_generator)
+        outputs.append(next(draw_generator))
+    assert 'blend_images_noiseless' not in outputs[0]
+    np.testing.assert_array_equal(outputs[1]['blend_images_noiseless'],
+                                  outputs[0]['blend_images'])
+    sky_level = btk.draw_blends.get_sky_level(outputs[1]['obs_condition'][0])
+    noise = outputs[1]['blend_images'] - outputs[0]['blend_images']
+    assert np.all(np.abs(noise.mean(axis=(0, 1, 2))) < 0.1 * sky_level**0.5)
+    realizations = btk.draw_blends.add_noise(
+        outputs[0]['blend_images'], sky_level, np.random.default_rng(0),
+        realizations=3)
+    assert realizations.shape == (3,) + outputs[0]['blend_images'].shape
+    assert not np.array_equal(realizations[0], realizations[1])
+    pass
+
+
+@pytest.mark.timeout(30)
+def test_seed_per_blend():
+    """Checks that with seed_per_blend blends do not depend on
+    multiprocessing or on the batches drawn before."""
+    catalog_name = 'data/sample_input_catalog.fits'
+    param = btk.config.Simulation_params(catalog_name, batch_size=4,
+                                         max_number=3, seed_per_blend=True)
+    catalog = btk.get_input_catalog.load_catalog(param)
+
+    def get_output(batch_index, skip, multiprocessing, cpus):
+        np.random.seed(skip)
+        blend_generator = btk.create_blend_generator.generate(
+            param, catalog, batch_index=batch_index)
+        observing_generator = btk.create_observing_generator.generate(
+            param, batch_index=batch_index)
+        draw_generator = btk.draw_blends.generate(
+            param, blend_generator, observing_generator,
+            multiprocessing=multiprocessing, cpus=cpus,
+            batch_index=batch_index)
+        for _ in range(skip):
+            next(draw_generator)
+        output = next(draw_generator)
+        draw_generator.close()
+        return output
+    outputs = [get_output(0, 1, False, 1), get_output(1, 0, False, 1),
+               get_output(1, 0, True, 2)]
+    for output in outputs[1:]:
+        np.testing.assert_array_equal(output['blend_images'],
+                                      outputs[0]['blend_images'])
+        np.testing.assert_array_equal(output['blend_batch'].data,
+                                      outputs[0]['blend_batch'].data)
+    pass
+
+
+@pytest.mark.timeout(20)
+def test_dataset_writer():
+    """Checks that blends written to a chunked dataset are those of the draw
+    generator, and that observing conditions are written once."""
+    draw_generator = get_draw_generator(4, add_noise=False)
+    draw_outputs = [next(draw_generator) for _ in range(2)]
+    with tempfile.TemporaryDirectory() as path:
+        param = btk.config.Simulation_params('data/sample_input_catalog.fits',
+                                             batch_size=4)
+        with btk.blend_dataset.Dataset_writer(path, param, chunk_size=3,
+                                              compress=False) as writer:
+            for draw_output in draw_outputs:
+                writer.append(draw_output)
+            assert writer.number_of_buffered_blends == 2
+        metadata = writer.metadata
+        assert metadata['complete']
+        assert [chunk['blends'] for chunk in metadata['chunks']] == [3, 3, 2]
+        assert metadata['number_of_obs_conditions'] == 1
+
+        def read(name):
+            return np.concatenate([np.load(btk.blend_dataset.get_chunk_name(
+                path, name, chunk['index'], False))
+                for chunk in metadata['chunks']])
+        for name in ['blend_images', 'isolated_images']:
+            np.testing.assert_array_equal(
+                read(name), np.concatenate([draw_output[name] for draw_output
+                                            in draw_outputs]))
+        catalog = np.concatenate([draw_output['blend_batch'].data
+                                  for draw_output in draw_outputs])
+        np.testing.assert_array_equal(read('catalog/galtileid'),
+                                      catalog['galtileid'])
+        offsets = np.load(btk.blend_dataset.get_chunk_name(path, 'offsets', 1,
+                                                           False))
+        number_of_objects = np.concatenate(
+            [draw_output['blend_batch'].number_of_objects
+             for draw_output in draw_outputs])
+        np.testing.assert_array_equal(np.diff(offsets), number_of_objects[3:6])
+        assert not read('obs_index').any()
+        with pytest.raises(ValueError):
+            btk.blend_dataset.Dataset_writer(path, param, resume=True)
+    with tempfile.TemporaryDirectory() as path:
+        # writer of a dataset that is not closed.
+        writer = btk.blend_dataset.Dataset_writer(path, param, chunk_size=3)
+        writer.append(draw_outputs[0])
+        with pytest.raises(ValueError):
+            btk.blend_dataset.Dataset_writer(path, param, chunk_size=3)
+        with pytest.raises(ValueError):
+            btk.blend_dataset.Dataset_writer(path, param, compress=False,
+                                             resume=True)
+        with btk.blend_dataset.Dataset_writer(path, param, chunk_size=3,
+                                              resume=True) as writer:
+            assert writer.metadata['number_of_blends'] == 3
+            writer.append(draw_outputs[1])
+        assert [chunk['blends'] for chunk in writer.metadata['chunks']] == [
+            3, 3, 1]
+        assert writer.metadata['number_of_obs_conditions'] == 1
+        dataset = btk.blend_dataset.Blend_dataset(path)
+        np.testing.assert_array_equal(
+            dataset.get_blends(range(3, 7))['blend_images'],
+            draw_outputs[1]['blend_images'])
+    with tempfile.TemporaryDirectory() as path:
+        # chunks limited by the size of the images of 3 blends.
+        blend_bytes = sum(draw_outputs[0][name][0].nbytes for name in
+                          ['blend_images', 'isolated_images'])
+        with btk.blend_dataset.Dataset_writer(
+                path, param, max_chunk_bytes=3 * blend_bytes + 1) as writer:
+            writer.append(draw_outputs[0], start=1)
+            writer.append(draw_outputs[1])
+        assert writer.chunk_size == 3
+        assert [chunk['blends'] for chunk in writer.metadata['chunks']] == [
+            3, 3, 1]
+        blends = btk.blend_dataset.Blend_dataset(path).get_blends(range(7))
+        np.testing.assert_array_equal(
+            blends['isolated_images'],
+            np.concatenate([draw_output['isolated_images'] for draw_output
+                            in draw_outputs])[1:])
+        np.testing.assert_array_equal(
+            blends['blend_batch'].number_of_objects,
+            np.concatenate([draw_output['blend_batch'].number_of_objects
+                            for draw_output in draw_outputs])[1:])
+    pass
+
+
+@pytest.mark.timeout(20)
+def test_dataset_replay(monkeypatch):
+    """Checks that blends read from a dataset are those written to it, in
+    order or shuffled, that noise can be added to them, and that each chunk
+    is loaded once per batch."""
+    draw_generator = get_draw_generator(4, add_noise=False)
+    draw_outputs = [next(draw_generator) for _ in range(2)]
+    param = btk.config.Simulation_params('data/sample_input_catalog.fits',
+                                         batch_size=4, add_noise=False)
+    for compress in [False, True]:
+        with tempfile.TemporaryDirectory() as path:
+            with btk.blend_dataset.Dataset_writer(
+                    path, param, chunk_size=3, compress=compress) as writer:
+                for draw_output in draw_outputs:
+                    writer.append(draw_output)
+            replay_generator = btk.blend_dataset.generate(param, path)
+            for draw_output in draw_outputs:
+                replay_output = next(replay_generator)
+                for name in ['blend_images', 'isolated_images']:
+                    np.testing.assert_array_equal(replay_output[name],
+                                                  draw_output[name])
+                np.testing.assert_array_equal(
+                    replay_output['blend_batch'].data,
+                    draw_output['blend_batch'].data)
+                np.testing.assert_array_equal(
+                    replay_output['blend_batch'].offsets,
+                    draw_output['blend_batch'].offsets)
+                assert len(replay_output['blend_list']) == 4
+                assert len(replay_output['obs_condition']) == 4
+            shuffle_generator = btk.blend_dataset.generate(
+                param, path, shuffle=True, add_noise=True)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                shuffle_outputs = [next(shuffle_generator) for _ in range(2)]
+            assert compress == any('compressed' in str(warning.message)
+                                   for warning in caught)
+            dataset = btk.blend_dataset.Blend_dataset(path)
+            dataset.CHUNK_CACHE_SIZE = 2
+            loaded = []
+            load = np.load
+            monkeypatch.setattr(np, 'load', lambda filename, **kwargs: (
+                loaded.append(filename) or load(filename, **kwargs)))
+            blends = dataset.get_blends([7, 0, 4, 1])
+            monkeypatch.undo()
+            assert len(loaded) == len(set(loaded)) == 3 * (
+                4 + len(dataset.catalog_dtype.names))
+            # blends of the 3 chunks are read with 2 chunks kept open.
+            assert len(dataset._chunks) == 2
+            np.testing.assert_array_equal(
+                blends['blend_images'],
+                np.concatenate([draw_output['blend_images'] for draw_output
+                                in draw_outputs])[[7, 0, 4, 1]])
+    galtileid = np.concatenate([output['blend_batch'].data['galtileid']
+                                for output in draw_outputs])
+    shuffle_galtileid = np.concatenate(
+        [output['blend_batch'].data['galtileid']
+         for output in shuffle_outputs])
+    np.testing.assert_array_equal(np.sort(shuffle_galtileid),
+                                  np.sort(galtileid))
+    for output in shuffle_outputs:
+        assert not np.array_equal(output['blend_images'],
+                                  output['blend_images_noiseless'])
+    pass
@@ -6,6 +6,8 @@ import sys
 import numpy as np
 import astropy
 import dill
+import tempfile
+import btk
 
 
 @pytest.mark.timeout(5)
@@ -435,3 +437,121 @@ def test_metrics():
             delete_output_file(user_config_dict, simulation)
             print("deleted files")
         pass
+
+
+@pytest.mark.timeout(30)
+def test_generate_shards():
+    """Checks that batches generated by shards of the generate command are
+    the same as those generated by a single shard, that incomplete shards are
+    resumed and complete shards skipped, and that shards are merged only when
+    all of them were generated."""
+    args = Input_Args()
+    sys.path.append(os.getcwd())
+    btk_input = __import__('btk_input')
+    config_dict = btk_input.read_configfile(args.configfile, args.simulation,
+                                            args.verbose)
+    simulation_config_dict = config_dict['simulation'][args.simulation]
+    simulation_config_dict['test_size'] = 3
+    user_config_dict = config_dict['user_input']
+    # chunks that do not start at the start of a batch.
+    user_config_dict['dataset_chunk_size'] = 5
+    catalog_name = os.path.join(user_config_dict['data_dir'],
+                                simulation_config_dict['catalog'])
+    with tempfile.TemporaryDirectory() as output_dir:
+        outputs = []
+        for run_name, shard_count in [('single', 1), ('sharded', 2)]:
+            user_config_dict['output_dir'] = os.path.join(output_dir,
+                                                          run_name)
+            for shard_index in range(shard_count):
+                param = btk_input.get_config_class(
+                    simulation_config_dict, catalog_name, args.verbose)
+                np.random.seed(int(param.seed))
+                if shard_count > 1:
+                    # shard left incomplete by a job that was killed, with
+                    # the first chunk of its first batch written.
+                    dataset_path = btk_input.get_dataset_path(
+                        user_config_dict, args.simulation, args.verbose)
+                    shard_path = os.path.join(
+                        dataset_path, 'shard_{0:05d}_of_{1:05d}'.format(
+                            shard_index, shard_count))
+                    writer = btk.blend_dataset.Dataset_writer(
+                        shard_path, param, chunk_size=5)
+                    param.seed_per_blend = True
+                    draw_generator = btk_input.make_draw_generator(
+                        param, user_config_dict, simulation_config_dict,
+                        batch_index=btk_input.get_shard_batches(
+                            3, shard_index, shard_count).start)
+                    writer.append(next(draw_generator))
+                    draw_generator.close()
+                    assert writer.metadata['number_of_blends'] == 5
+                btk_input.generate_shard(param, user_config_dict,
+                                         simulation_config_dict,
+                                         args.simulation, shard_index,
+                                         shard_count)
+                manifest = btk_input.generate_shard(
+                    param, user_config_dict, simulation_config_dict,
+                    args.simulation, shard_index, shard_count)
+                assert manifest['complete']
+                if shard_index == 0 and shard_count > 1:
+                    with pytest.raises(ValueError):
+                        btk_input.merge_shards(
+                            user_config_dict, simulation_config_dict,
+                            args.simulation, args.verbose)
+            btk_input.merge_shards(user_config_dict, simulation_config_dict,
+                                   args.simulation, args.verbose)
+            dataset_path = btk_input.get_dataset_path(
+                user_config_dict, args.simulation, args.verbose)
+            dataset = btk.blend_dataset.Blend_dataset(dataset_path)
+            assert len(dataset) == 3 * param.batch_size
+            blends = dataset.get_blends(range(len(dataset)))
+            outputs.append([blends['blend_images'],
+                            blends['isolated_images'],
+                            blends['blend_batch'].offsets,
+                            blends['blend_batch'].data['galtileid']])
+        for single, sharded in zip(*outputs):
+            np.testing.assert_array_equal(single, sharded)
+    pass
+
+
+@pytest.mark.timeout(120)
+def test_library_reservoir():
+    """Checks that the galaxy library is built from the full catalog when the
+    catalog is sampled from a reservoir, so that blends sampled from later
+    samples are assembled from it."""
+    args = Input_Args()
+    sys.path.append(os.getcwd())
+    btk_input = __import__('btk_input')
+    config_dict = btk_input.read_configfile(args.configfile, args.simulation,
+                                            args.verbose)
+    simulation_config_dict = config_dict['simulation'][args.simulation]
+    simulation_config_dict['selection_function'] = 'basic_selection_function'
+    user_config_dict = config_dict['user_input']
+    user_config_dict['catalog_reservoir_size'] = 20
+    user_config_dict['catalog_reservoir_refresh_batches'] = 1
+    catalog_name = os.path.join(user_config_dict['data_dir'],
+                                simulation_config_dict['catalog'])
+    param = btk_input.get_config_class(simulation_config_dict, catalog_name,
+                                       args.verbose)
+    reservoir = btk_input.get_simulation_catalog(
+        param, user_config_dict, simulation_config_dict)
+    with pytest.raises(ValueError):
+        btk.galaxy_library.build_library(param, reservoir, None, 'library')
+    reservoir.stop()
+    with tempfile.TemporaryDirectory() as library_dir:
+        user_config_dict['galaxy_library_dir'] = library_dir
+        btk_input.build_library(param, user_config_dict,
+                                simulation_config_dict, args.simulation)
+        library_path = btk_input.get_library_path(user_config_dict,
+                                                  args.simulation)
+        library = btk.galaxy_library.Galaxy_library(library_path)
+        catalog = btk.get_input_catalog.load_catalog(
+            param, selection_function=btk.utils.basic_selection_function)
+        np.testing.assert_array_equal(library.galtileid, catalog['galtileid'])
+        np.random.seed(int(param.seed))
+        draw_blend_generator = btk_input.make_draw_generator(
+            param, user_config_dict, simulation_config_dict,
+            library_path=library_path)
+        for _ in range(2):
+            draw_output = next(draw_blend_generator)
+            assert len(draw_output['blend_list']) == param.batch_size
+    pass